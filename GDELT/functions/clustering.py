@@ -5,6 +5,7 @@ import numpy as np
 from sklearn.cluster import Birch, AgglomerativeClustering, KMeans
 
 from ..utils.utils import QueryExecutor, Utils
+from ..utils.query_plan import AggregateQuery, tone_impact
 from ..parametrs.date_parameters import MonthRangeParameter
 from ..parametrs.category_parameters import ActorTypeParameter, GenericCategoryParameter
 from ..parametrs.base_parameters import IntParameter
@@ -12,61 +13,68 @@ from .function import Function
 
 
 class Clustering(Function):
-    def __init__(self):
-        self.query = """
-            SELECT e.Actor1Geo_CountryCode AS Actor1Geo,
-                   e.Actor2Geo_CountryCode AS Actor2Geo,
-                   SUM((0.5 * e.AvgTone + e.GoldsteinScale) * e.NumMentions) / SUM(e.NumMentions) * COUNT(*) 
-                   / SQRT(AVG(a1.Actor1Count) * AVG(a2.Actor2Count)) * 1000 AS AvgTone
-            FROM `gdelt-bq.full.events` AS e
-            LEFT JOIN
-              (SELECT Actor1Geo_CountryCode AS Actor1, COUNT(*) Actor1Count
-               FROM `gdelt-bq.full.events`
-               WHERE MonthYear >= {start}
-               AND MonthYear < {end}
-               GROUP BY Actor1Geo_CountryCode) AS a1
-            ON e.Actor1Geo_CountryCode = a1.Actor1
-            LEFT JOIN
-              (SELECT Actor2Geo_CountryCode AS Actor2, COUNT(*) Actor2Count
-               FROM `gdelt-bq.full.events`
-               WHERE MonthYear >= {start}
-               AND MonthYear < {end}
-               GROUP BY Actor2Geo_CountryCode) AS a2
-            ON e.Actor2Geo_CountryCode = a2.Actor2
-            WHERE e.MonthYear >= {start}
-            AND e.MonthYear < {end}
-            AND e.Actor1Geo_CountryCode IS NOT NULL
-            AND e.Actor2Geo_CountryCode IS NOT NULL
-            GROUP BY e.Actor1Geo_CountryCode, e.Actor2Geo_CountryCode
-            ORDER BY e.Actor1Geo_CountryCode, e.Actor2Geo_CountryCode
-            """
+    supports_preview = True
+
+    def _build_query(self, parameters):
+        """
+        One scan of events gives aggregates of all country pairs,
+        including pairs with unknown country, which are needed for marginal counts
+        """
+        start, end = parameters['range'].value
+        return AggregateQuery(
+            keys=[('Actor1Geo', 'Actor1Geo_CountryCode'),
+                  ('Actor2Geo', 'Actor2Geo_CountryCode')],
+            measures=[('EventCount', 'count', None),
+                      ('WeightedTone', 'sum', tone_impact),
+                      ('Mentions', 'sum', 'NumMentions')],
+            filters=[('MonthYear', '>=', start),
+                     ('MonthYear', '<', end)],
+            order_by=['Actor1Geo', 'Actor2Geo'])
+
+    @staticmethod
+    def _normalize(df):
+        """
+        :param df: result of _build_query
+        :return: DataFrame with Actor1Geo, Actor2Geo (Categoricals of code dictionary) and AvgTone -
+        mentions weighted tone of pair normalized by event counts of both countries
+        """
+        code_dictionary = Utils().get_code_dictionary()
+        actor1 = code_dictionary.codes(df['Actor1Geo'])
+        actor2 = code_dictionary.codes(df['Actor2Geo'])
+        event_count = df['EventCount'].to_numpy()
+        # marginal counts by code, NULL country is counted at position 0
+        actor1_count = np.bincount(actor1 + 1, weights=event_count)
+        actor2_count = np.bincount(actor2 + 1, weights=event_count)
+        pairs = (actor1 >= 0) & (actor2 >= 0)
+        actor1, actor2 = actor1[pairs], actor2[pairs]
+        marginals = actor1_count[actor1 + 1] * actor2_count[actor2 + 1]
+        avg_tone = df['WeightedTone'].to_numpy()[pairs] / df['Mentions'].to_numpy()[pairs] \
+            * event_count[pairs] / np.sqrt(marginals) * 1000
+        return pd.DataFrame({'Actor1Geo': code_dictionary.categorical(actor1),
+                             'Actor2Geo': code_dictionary.categorical(actor2),
+                             'AvgTone': avg_tone})
+
+    def get_queries(self, parameters):
+        return [self._build_query(parameters)]
 
     def get_plot(self, parameters):
         qe = QueryExecutor()
-        query = self.query.format(
-            start=parameters['range'].value[0],
-            end=parameters['range'].value[1],
-        )
-        df = qe.get_result_dataframe(query)
-
-        countries_to_leave = Utils().get_valid_fips_countries(25000)
-        df = df[(df['Actor1Geo'].isin(countries_to_leave)) & (df['Actor2Geo'].isin(countries_to_leave))]
-        df.sort_values(['Actor1Geo', 'Actor2Geo'], inplace=True)
-
-        index = pd.MultiIndex.from_product((countries_to_leave, countries_to_leave),
-                                           names=['Actor1Geo', 'Actor2Geo'])
-        df.index = pd.MultiIndex.from_arrays((df['Actor1Geo'], df['Actor2Geo']),
-                                             names=['Actor1Geo', 'Actor2Geo'])
-        df.drop(['Actor1Geo', 'Actor2Geo'], axis=1, inplace=True)
-        df = df.reindex(index, fill_value=0.0).reset_index()
-        df.sort_values(['Actor1Geo', 'Actor2Geo'], inplace=True)
-
-        dist_matrix = df['AvgTone'].values.reshape((-1, df.groupby('Actor1Geo')['Actor2Geo'].count().unique()[0]))
+        df = self._normalize(qe.get_result_dataframe(self._build_query(parameters),
+                                                     categorical_cols=['Actor1Geo', 'Actor2Geo']))
+
+        code_dictionary = Utils().get_code_dictionary()
+        countries_to_leave = np.sort(np.array(Utils().get_valid_fips_countries(25000), dtype=object))
+        country_codes = code_dictionary.codes(countries_to_leave)
+        rows = code_dictionary.index_of(df['Actor1Geo'].cat.codes.to_numpy(), country_codes)
+        columns = code_dictionary.index_of(df['Actor2Geo'].cat.codes.to_numpy(), country_codes)
+        inside = (rows >= 0) & (columns >= 0)
+        dist_matrix = np.zeros((len(countries_to_leave), len(countries_to_leave)))
+        dist_matrix[rows[inside], columns[inside]] = df['AvgTone'].to_numpy()[inside]
 
         down_limit, up_limit = np.percentile(dist_matrix, (1, 99))
         dist_matrix = np.clip(dist_matrix, down_limit, up_limit)
 
-        labels_idx = pd.Series(df['Actor1Geo'].unique(), name='country_id')
+        labels_idx = pd.Series(countries_to_leave, name='country_id')
 
         n_clusters = parameters['n_clusters'].value
 
@@ -97,7 +105,7 @@ class Clustering(Function):
                                      on=['country_id'],
                                      how='right',
                                      ).fillna(-1)
-        cluster_df['country_name'] = cluster_df['country_id'].map(Utils().get_fips_country_id_to_name_mapping())
+        cluster_df['country_name'] = code_dictionary.decode_names(cluster_df['country_id'], 'fips_country')
         cluster_df.rename({'ISO': 'country_iso'}, axis=1, inplace=True)
         # Uncomment to write result to csv
         # cluster_df.groupby('cluster_id')['country_name'].apply(lambda countries: '; '.join(countries)).to_csv('clustering_result.csv')
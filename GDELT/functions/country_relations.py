@@ -4,41 +4,66 @@ import pandas as pd
 import numpy as np
 from itertools import product
 from ..utils.utils import QueryExecutor, Utils
+from ..utils.query_plan import AggregateQuery
 from ..parametrs.date_parameters import MonthRangeParameter
 from ..parametrs.category_parameters import FipsCountryParameter, ActorTypeParameter, TargetTypeParameter
 from .function import Function
 
 
+# target type -> measure column of query
+target_columns = {
+    1: 'Count',
+    2: 'Tone',
+    3: 'Mentions',
+    4: 'Goldstein',
+}
+
+
 class CountryRelations(Function):
-    def __init__(self):
-        self.query = """
-            SELECT MonthYear AS MonthYear, Actor{role_2}Geo_CountryCode AS Country, {target_type}AS Target
-            FROM `gdelt-bq.full.events`
-            WHERE MonthYear >= {start}
-            AND MonthYear < {end}
-            AND Actor{role_1}Geo_CountryCode = "{country}"
-            AND Actor{role_2}Geo_CountryCode IS NOT NULL
-            GROUP BY MonthYear, Actor{role_2}Geo_CountryCode
-            ORDER BY MonthYear, Actor{role_2}Geo_CountryCode
-            """
+    def _build_query(self, parameters):
+        """
+        All measures for country in both roles, so switching of target type or
+        actor type uses the same (cached) result
+        """
+        start, end = parameters['range'].value
+        country = parameters['country_id'].value
+        return AggregateQuery(
+            keys=[('MonthYear', 'MonthYear'),
+                  ('Actor1', 'Actor1Geo_CountryCode'),
+                  ('Actor2', 'Actor2Geo_CountryCode')],
+            measures=[('Count', 'count', None),
+                      ('Tone', 'avg', 'AvgTone'),
+                      ('Mentions', 'sum', 'NumMentions'),
+                      ('Goldstein', 'avg', 'GoldsteinScale')],
+            filters=[('MonthYear', '>=', start),
+                     ('MonthYear', '<', end),
+                     (None, 'or', [('Actor1Geo_CountryCode', '=', country),
+                                   ('Actor2Geo_CountryCode', '=', country)])],
+            order_by=['MonthYear', 'Actor1', 'Actor2'])
+
+    @staticmethod
+    def _select(df, parameters):
+        """
+        :param df: result of _build_query
+        :param parameters: dictionary of parameters
+        :return: DataFrame with MonthYear, Country (country of other role) and Target
+        for chosen role and target type
+        """
+        role_1 = parameters['actor_type'].value
+        role_2 = 3 - role_1
+        rows = (df['Actor{}'.format(role_1)].astype(str) == parameters['country_id'].value) & \
+            df['Actor{}'.format(role_2)].notna()
+        selected = df.loc[rows, ['MonthYear', 'Actor{}'.format(role_2),
+                                 target_columns[parameters['target_type'].value]]]
+        selected.columns = ['MonthYear', 'Country', 'Target']
+        return selected.reset_index(drop=True)
+
+    def get_queries(self, parameters):
+        return [self._build_query(parameters)]
 
     def get_plot(self, parameters):
-        target_dict = {
-            1: "COUNT(*)",
-            2: "AVG(AvgTone)",
-            3: "Sum(NumMentions)",
-            4: "AVG(GoldsteinScale)"
-        }
         qe = QueryExecutor()
-        query = self.query.format(
-            start=parameters['range'].value[0],
-            end=parameters['range'].value[1],
-            country=parameters['country_id'].value,
-            role_1=parameters['actor_type'].value,
-            role_2=(3 - parameters['actor_type'].value),
-            target_type=target_dict[parameters['target_type'].value],
-        )
-        df = qe.get_result_dataframe(query)
+        df = self._select(qe.get_result_dataframe(self._build_query(parameters)), parameters)
         df['country_iso'] = df['Country'].map(Utils().get_fips_iso_mapping())
         df.dropna(inplace=True)
 
@@ -1,7 +1,8 @@
 from plotly.offline import plot
 import plotly.graph_objs as go
-import numpy as np
+import pandas as pd
 from ..utils.utils import QueryExecutor
+from ..utils.query_plan import AggregateQuery, JoinQuery
 from ..parametrs.date_parameters import MonthRangeParameter
 from ..parametrs.category_parameters import FipsCountryParameter
 from .function import Function
@@ -9,40 +10,46 @@ from ..utils.utils import Utils
 
 
 class CountryConnectionCount(Function):
-    def __init__(self):
-        self.query = """
-        SELECT t1.ActorCountry AS ActorCountry, t1.CountryCount AS CountryCountAsActor1, t2.CountryCount AS CountryCountAsActor2
-        FROM
-          (SELECT Actor2Geo_CountryCode AS ActorCountry, count(*) AS CountryCount
-          FROM `gdelt-bq.full.events`
-          WHERE MonthYear >= {0}
-          AND MonthYear < {1}
-          AND Actor1Geo_CountryCode="{2}"
-          GROUP BY Actor2Geo_CountryCode) AS t1
-        JOIN
-          (SELECT Actor1Geo_CountryCode AS ActorCountry, count(*) AS CountryCount
-          FROM `gdelt-bq.full.events`
-          WHERE MonthYear >= {0} 
-          AND MonthYear < {1}
-          AND Actor2Geo_CountryCode="{2}"
-          GROUP BY Actor1Geo_CountryCode) as t2
-        ON t1.ActorCountry = t2.ActorCountry"""
+    @staticmethod
+    def _build_side_query(start, end, country_code, role):
+        """
+        :param role: role of country_code in events (1 or 2)
+        :return: query of event count with other countries
+        """
+        return AggregateQuery(
+            keys=[('ActorCountry', 'Actor{}Geo_CountryCode'.format(3 - role))],
+            measures=[('CountryCountAsActor{}'.format(role), 'count', None)],
+            filters=[('MonthYear', '>=', start),
+                     ('MonthYear', '<', end),
+                     ('Actor{}Geo_CountryCode'.format(role), '=', country_code)])
+
+    def _build_query(self, parameters):
+        start, end = parameters['range'].value
+        country_code = parameters['country_code'].value
+        return JoinQuery(self._build_side_query(start, end, country_code, 1),
+                         self._build_side_query(start, end, country_code, 2),
+                         on=['ActorCountry'])
+
+    def get_queries(self, parameters):
+        query = self._build_query(parameters)
+        return [query.left, query.right]
 
     def get_plot(self, parameters):
         qe = QueryExecutor()
-        start, end = parameters['range'].value
         country_code = parameters['country_code'].value
-        query = self.query.format(start, end, country_code)
-        df = qe.get_result_dataframe(query)
-        df.index = df['ActorCountry'].map(Utils().get_fips_country_id_to_name_mapping())
+        query = self._build_query(parameters)
+        # both sides are fetched concurrently and joined locally
+        left, right = qe.fetch_all([query.left, query.right], categorical_cols=['ActorCountry'])
+        df = query.join(left, right)
+        names = Utils().get_code_dictionary().decode_names(df['ActorCountry'], 'fips_country')
+        df.index = pd.Index(names, dtype=object).fillna('NONE')
+        df.drop('ActorCountry', axis=1, inplace=True)
 
         def get_data_for_plot(data, count_col):
             threshold = data[count_col].sum() * 0.015
             cat_df = data.copy()
             cat_df.loc['OTHER'] = cat_df.loc[cat_df[count_col] < threshold].sum()
             cat_df = cat_df.loc[cat_df[count_col] >= threshold]
-            cat_df.drop('ActorCountry', axis=1, inplace=True)
-            cat_df.rename({np.NaN: 'NONE'}, axis=0, inplace=True)
             return cat_df
 
         data_a1 = get_data_for_plot(df, 'CountryCountAsActor1')
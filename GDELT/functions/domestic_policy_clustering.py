@@ -5,6 +5,7 @@ import numpy as np
 from sklearn.cluster import Birch, AgglomerativeClustering, KMeans, AffinityPropagation
 
 from ..utils.utils import QueryExecutor, Utils
+from ..utils.query_plan import AggregateQuery, Column, tone_impact
 from ..parametrs.date_parameters import MonthRangeParameter
 from ..parametrs.category_parameters import GenericCategoryParameter
 from ..parametrs.base_parameters import IntParameter
@@ -12,55 +13,53 @@ from .function import Function
 
 
 class DomesticPolicyClustering(Function):
-    def __init__(self):
-        self.query = """
-            SELECT e.Actor1Geo_CountryCode AS ActorGeo,
-                   e.Actor1Type1Code AS Type1,
-                   e.Actor2Type1Code AS Type2,
-                   SUM((0.5 * e.AvgTone + e.GoldsteinScale) * e.NumMentions) / SUM(e.NumMentions) * COUNT(*) 
-                   / SQRT(AVG(t1.Type1Count) * AVG(t2.Type2Count)) * 1000 AS AvgTone
-            FROM `gdelt-bq.full.events` AS e
-            LEFT JOIN
-              (SELECT Actor1Geo_CountryCode AS Actor, Actor1Type1Code AS Type1, COUNT(*) Type1Count
-               FROM `gdelt-bq.full.events`
-               WHERE MonthYear >= {start}
-               AND MonthYear < {end}
-                AND Actor1Geo_CountryCode IS NOT NULL
-                AND Actor1Geo_CountryCode = Actor2Geo_CountryCode 
-                AND Actor1Type1Code IS NOT NULL
-                AND Actor2Type1Code IS NOT NULL
-               GROUP BY Actor1Geo_CountryCode, Actor1Type1Code) AS t1
-            ON e.Actor1Geo_CountryCode = t1.Actor
-            AND e.Actor1Type1Code = t1.Type1
-            LEFT JOIN
-              (SELECT Actor1Geo_CountryCode AS Actor, Actor2Type1Code AS Type2, COUNT(*) Type2Count
-               FROM `gdelt-bq.full.events`
-               WHERE MonthYear >= {start}
-               AND MonthYear < {end}
-                AND Actor1Geo_CountryCode IS NOT NULL
-                AND Actor1Geo_CountryCode = Actor2Geo_CountryCode 
-                AND Actor1Type1Code IS NOT NULL
-                AND Actor2Type1Code IS NOT NULL
-               GROUP BY Actor1Geo_CountryCode, Actor2Type1Code) AS t2
-            ON e.Actor1Geo_CountryCode = t2.Actor
-            AND e.Actor1Type1Code = t2.Type2
-            WHERE e.MonthYear >= {start}
-            AND e.MonthYear < {end}
-            AND e.Actor1Geo_CountryCode IS NOT NULL
-            AND e.Actor1Geo_CountryCode = e.Actor2Geo_CountryCode 
-            AND e.Actor1Type1Code IS NOT NULL
-            AND e.Actor2Type1Code IS NOT NULL
-            GROUP BY e.Actor1Geo_CountryCode, e.Actor1Type1Code, e.Actor2Type1Code
-            ORDER BY e.Actor1Geo_CountryCode, e.Actor1Type1Code, e.Actor2Type1Code
-            """
+    def _build_query(self, parameters):
+        """
+        One scan of domestic events (both actors from the same country)
+        gives aggregates of all type pairs, marginal counts are computed from them
+        """
+        start, end = parameters['range'].value
+        return AggregateQuery(
+            keys=[('ActorGeo', 'Actor1Geo_CountryCode'),
+                  ('Type1', 'Actor1Type1Code'),
+                  ('Type2', 'Actor2Type1Code')],
+            measures=[('EventCount', 'count', None),
+                      ('WeightedTone', 'sum', tone_impact),
+                      ('Mentions', 'sum', 'NumMentions')],
+            filters=[('MonthYear', '>=', start),
+                     ('MonthYear', '<', end),
+                     ('Actor1Geo_CountryCode', 'is not null', None),
+                     ('Actor1Geo_CountryCode', '=', Column('Actor2Geo_CountryCode')),
+                     ('Actor1Type1Code', 'is not null', None),
+                     ('Actor2Type1Code', 'is not null', None)],
+            order_by=['ActorGeo', 'Type1', 'Type2'])
+
+    @staticmethod
+    def _normalize(df):
+        """
+        :param df: result of _build_query
+        :return: DataFrame with ActorGeo, Type1, Type2 and AvgTone -
+        mentions weighted tone of type pair normalized by event counts of types.
+        Both counts are taken for Type1 value: events with it as first actor type
+        and events with it as second actor type
+        """
+        type1_count = df.groupby(['ActorGeo', 'Type1'])['EventCount'].sum()
+        type2_count = df.groupby(['ActorGeo', 'Type2'])['EventCount'].sum()
+        index = pd.MultiIndex.from_arrays([df['ActorGeo'], df['Type1']])
+        marginals = type1_count.reindex(index).values * type2_count.reindex(index).values
+        avg_tone = df['WeightedTone'].values / df['Mentions'].values * df['EventCount'].values \
+            / np.sqrt(marginals.astype(np.float64)) * 1000
+        return pd.DataFrame({'ActorGeo': df['ActorGeo'].values,
+                             'Type1': df['Type1'].values,
+                             'Type2': df['Type2'].values,
+                             'AvgTone': avg_tone})
+
+    def get_queries(self, parameters):
+        return [self._build_query(parameters)]
 
     def get_plot(self, parameters):
         qe = QueryExecutor()
-        query = self.query.format(
-            start=parameters['range'].value[0],
-            end=parameters['range'].value[1],
-        )
-        df = qe.get_result_dataframe(query)
+        df = self._normalize(qe.get_result_dataframe(self._build_query(parameters)))
 
         countries_to_leave = Utils().get_valid_fips_countries(25000)
         df = df[(df['ActorGeo'].isin(countries_to_leave))]
@@ -1,6 +1,7 @@
 from plotly.offline import plot
 import plotly.graph_objs as go
 from ..utils.utils import QueryExecutor
+from ..utils.query_plan import AggregateQuery
 from ..parametrs.date_parameters import MonthRangeParameter
 from ..parametrs.category_parameters import CameoCountryParameter, ActorTypeParameter
 from .function import Function
@@ -10,26 +11,24 @@ import pandas as pd
 
 
 class EventBaseType(Function):
-    def __init__(self):
-        self.query = """
-        SELECT MonthYear AS Date, EventRootCode AS EventCode, COUNT(*) AS EventCount
-        FROM `gdelt-bq.full.events`
-        WHERE MonthYear >= {start}
-        AND MonthYear < {end}
-        AND Actor{role}CountryCode = "{country}"
-        GROUP BY MonthYear, EventRootCode
-        ORDER BY MonthYear, EventRootCode
-        """
+    def _build_query(self, parameters):
+        start, end = parameters['range'].value
+        return AggregateQuery(
+            keys=[('Date', 'MonthYear'),
+                  ('EventCode', 'EventRootCode')],
+            measures=[('EventCount', 'count', None)],
+            filters=[('MonthYear', '>=', start),
+                     ('MonthYear', '<', end),
+                     ('Actor{}CountryCode'.format(parameters['actor_type'].value),
+                      '=', parameters['country'].value)],
+            order_by=['Date', 'EventCode'])
+
+    def get_queries(self, parameters):
+        return [self._build_query(parameters)]
 
     def get_plot(self, parameters):
         qe = QueryExecutor()
-        query = self.query.format(
-            start=parameters['range'].value[0],
-            end=parameters['range'].value[1],
-            country=parameters['country'].value,
-            role=parameters['actor_type'].value,
-        )
-        df = qe.get_result_dataframe(query)
+        df = qe.get_result_dataframe(self._build_query(parameters))
         df['EventCount'] = df['EventCount'].astype('int32')
         df['Date'] = df['Date'].astype('int32')
         event_count_sum = df.groupby("Date")['EventCount'].sum()
@@ -1,26 +1,27 @@
 from plotly.offline import plot
 import plotly_express as px
 from ..utils.utils import QueryExecutor
+from ..utils.query_plan import AggregateQuery
 from ..parametrs.date_parameters import DateRangeParameter
 from .function import Function
 
 
 class EventCount(Function):
-    def __init__(self):
-        self.query = """
-        SELECT MonthYear AS Date, COUNT(*) AS EventCount
-        FROM `gdelt-bq.full.events`
-        WHERE SQLDATE >= {}
-        AND SQLDATE < {}
-        GROUP BY MonthYear
-        ORDER BY MonthYear
-        """
+    def _build_query(self, parameters):
+        start, end = parameters['range'].value
+        return AggregateQuery(
+            keys=[('Date', 'MonthYear')],
+            measures=[('EventCount', 'count', None)],
+            filters=[('SQLDATE', '>=', start),
+                     ('SQLDATE', '<', end)],
+            order_by=['Date'])
+
+    def get_queries(self, parameters):
+        return [self._build_query(parameters)]
 
     def get_plot(self, parameters):
         qe = QueryExecutor()
-        start, end = parameters['range'].value
-        query = self.query.format(start, end)
-        df = qe.get_result_dataframe(query, month_year_cols=['Date'])
+        df = qe.get_result_dataframe(self._build_query(parameters), month_year_cols=['Date'])
         fig = px.line(df, x='Date', y='EventCount')
         return plot(fig, include_plotlyjs=True, output_type='div')
 
@@ -1,4 +1,5 @@
 from ..utils.utils import QueryExecutor
+from ..utils.query_plan import AggregateQuery
 from mapboxgl.utils import *
 from mapboxgl.viz import HeatmapViz
 from numpy import unique
@@ -12,27 +13,27 @@ import pandas as pd
 
 
 class EventDensityByCountry(Function):
+    supports_preview = True
+
     def _build_qeury(self, params):
-        query = """SELECT ActionGeo_Lat AS lat, ActionGeo_Long AS lon, COUNT(*) AS Target
-        FROM `gdelt-bq.full.events`
-        WHERE SQLDATE >= {0}
-        AND SQLDATE < {1}
-        AND ActionGeo_CountryCode = "{2}" """.format(
-            params['range'].value[0],
-            params['range'].value[1],
-            params['loc_country'].value)
+        filters = [('SQLDATE', '>=', params['range'].value[0]),
+                   ('SQLDATE', '<', params['range'].value[1]),
+                   ('ActionGeo_CountryCode', '=', params['loc_country'].value)]
         multiple_params = ['a1_country', 'a2_country', 'quad_class', 'event_code']
         column_names = ['Actor1Geo_CountryCode', 'Actor2Geo_CountryCode', 'QuadClass', 'EventRootCode']
         for param_name, column_name in zip(multiple_params, column_names):
             if 'All' in params[param_name].value:
                 continue
-            query += "\nAND {} IN UNNEST({})".format(
-                column_name, params[param_name].value
-            )
-        query += """
-        GROUP BY lat, lon
-        ORDER BY lat, lon"""
-        return query
+            filters.append((column_name, 'in', params[param_name].value))
+        return AggregateQuery(
+            keys=[('lat', 'ActionGeo_Lat'),
+                  ('lon', 'ActionGeo_Long')],
+            measures=[('Target', 'count', None)],
+            filters=filters,
+            order_by=['lat', 'lon'])
+
+    def get_queries(self, parameters):
+        return [self._build_qeury(parameters)]
 
     def get_plot(self, parameters):
         qe = QueryExecutor()
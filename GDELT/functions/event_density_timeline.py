@@ -1,6 +1,8 @@
 from ..utils.utils import QueryExecutor
+from ..utils.query_plan import AggregateQuery
 import folium
 import folium.plugins as plugins
+import numpy as np
 from numpy import log
 from ..parametrs.date_parameters import DateRangeParameter
 from ..parametrs.category_parameters import FipsCountryParameter, QuadClassParameter, CameoEventcodeBaseParameter
@@ -12,45 +14,61 @@ import pandas as pd
 
 class EventDensityTimeline(Function):
     def _build_qeury(self, params):
-        query = """SELECT MonthYear, ActionGeo_Lat AS lat, ActionGeo_Long AS lon, COUNT(*) AS EventCount
-        FROM `gdelt-bq.full.events`
-        WHERE SQLDATE >= {0}
-        AND SQLDATE < {1}
-        AND ActionGeo_CountryCode = "{2}" """.format(
-            params['range'].value[0],
-            params['range'].value[1],
-            params['loc_country'].value)
+        filters = [('SQLDATE', '>=', params['range'].value[0]),
+                   ('SQLDATE', '<', params['range'].value[1]),
+                   ('ActionGeo_CountryCode', '=', params['loc_country'].value)]
         multiple_params = ['a1_country', 'a2_country', 'quad_class', 'event_code']
         column_names = ['Actor1Geo_CountryCode', 'Actor2Geo_CountryCode', 'QuadClass', 'EventRootCode']
         for param_name, column_name in zip(multiple_params, column_names):
             if 'All' in params[param_name].value:
                 continue
-            query += "\nAND {} IN UNNEST({})".format(
-                column_name, params[param_name].value
-            )
-        query += """
-        GROUP BY MonthYear, lat, lon
-        ORDER BY MonthYear, lat, lon"""
-        return query
+            filters.append((column_name, 'in', params[param_name].value))
+        return AggregateQuery(
+            keys=[('MonthYear', 'MonthYear'),
+                  ('lat', 'ActionGeo_Lat'),
+                  ('lon', 'ActionGeo_Long')],
+            measures=[('EventCount', 'count', None)],
+            filters=filters,
+            order_by=['MonthYear', 'lat', 'lon'])
+
+    def get_queries(self, parameters):
+        return [self._build_qeury(parameters)]
+
+    @staticmethod
+    def _build_timeline(result):
+        """
+        Reads result by chunks, so only filtered points are kept in memory
+        :param result: ChunkedResult of _build_qeury
+        :return: tuple (list of months, list of lists of [lat, lon, weight] for each month,
+        (min_lat, max_lat), (min_lon, max_lon))
+        """
+        min_lon, max_lon = np.nanquantile(result.column('lon'), [0.01, 0.99])
+        min_lat, max_lat = np.nanquantile(result.column('lat'), [0.01, 0.99])
+        points = {}
+        for chunk in result.iter_chunks():
+            chunk = chunk[(chunk.lon >= min_lon) & (chunk.lon <= max_lon) &
+                          (chunk.lat >= min_lat) & (chunk.lat <= max_lat)]
+            for month, month_chunk in chunk.groupby('MonthYear'):
+                points.setdefault(month, []).append(np.stack([
+                    month_chunk['lat'].to_numpy(dtype=np.float64),
+                    month_chunk['lon'].to_numpy(dtype=np.float64),
+                    log(month_chunk['EventCount'].to_numpy(dtype=np.float64))], axis=1))
+        months = list(sorted(points))
+        points = [np.concatenate(points[month]) for month in months]
+        max_weight = max(month_points[:, 2].max() for month_points in points) if points else 1.
+        timeline = []
+        for month_points in points:
+            month_points[:, 2] /= max_weight
+            timeline.append(month_points.tolist())
+        return months, timeline, (min_lat, max_lat), (min_lon, max_lon)
 
     def get_plot(self, parameters):
         qe = QueryExecutor()
-        df = qe.get_result_dataframe(self._build_qeury(parameters))
-
-        min_lon, max_lon = df.lon.quantile([0.01, 0.99])
+        with qe.get_result_chunks(self._build_qeury(parameters)) as result:
+            months, timeline, (min_lat, max_lat), (min_lon, max_lon) = self._build_timeline(result)
         delta_lon = max_lon - min_lon
-        min_lat, max_lat = df.lat.quantile([0.01, 0.99])
         delta_lat = max_lat - min_lat
         center = ((min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
-        df = df[(df.lon >= min_lon) & (df.lon <= max_lon) & (df.lat >= min_lat) & (df.lat <= max_lat)]
-
-        df['EventCount'] = log(df['EventCount'])
-        df['EventCount'] = df['EventCount'] / df['EventCount'].max()
-        timeline = []
-        months = list(sorted(df['MonthYear'].unique()))
-        for month in months:
-            month_counts = df[df['MonthYear'] == month][['lat', 'lon', 'EventCount']].values
-            timeline.append(list(map(list, month_counts)))
 
         m = folium.Map(center,
                        tiles='stamentoner',
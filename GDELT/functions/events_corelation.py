@@ -1,85 +1,121 @@
 from plotly.offline import plot
 import plotly_express as px
 import pandas as pd
+import numpy as np
 from ..utils.utils import QueryExecutor, Utils
+from ..utils.query_plan import AggregateQuery
 from ..parametrs.date_parameters import MonthParameter
 from ..parametrs.category_parameters import GenericCategoryParameter
 from .function import Function
 
 
+# target type -> measure column of query
+target_columns = {
+    1: 'Count',
+    2: 'Tone',
+    3: 'Mentions',
+    4: 'Goldstein',
+}
+
+
 class EventCorrelation(Function):
-    def __init__(self):
-        self.query = """
-        WITH 
-          comb_unique AS 
-          (SELECT u1.Actor1Geo_CountryCode AS Actor1, u2.Actor2Geo_CountryCode AS Actor2, u3.SQLDATE AS Date
-            FROM 
-                (SELECT DISTINCT Actor1Geo_CountryCode
-                 FROM `gdelt-bq.full.events`
-                 WHERE MonthYear = {month}
-                 AND NOT Actor1Geo_CountryCode IS NULL
-                 ORDER BY Actor1Geo_CountryCode) AS u1
-            CROSS JOIN
-                (SELECT DISTINCT Actor2Geo_CountryCode
-                 FROM `gdelt-bq.full.events`
-                 WHERE MonthYear = {month}
-                 AND NOT Actor2CountryCode IS NULL
-                 ORDER BY Actor2Geo_CountryCode) AS u2
-            CROSS JOIN
-                (SELECT DISTINCT SQLDATE
-                 FROM `gdelt-bq.full.events`
-                 WHERE MonthYear = {month}
-                 ORDER BY SQLDATE) AS u3),
-            filled_table AS 
-            (SELECT comb_unique.Actor1 AS Actor1, 
-                    comb_unique.Actor2 AS Actor2, 
-                    comb_unique.Date AS Date,
-                    IFNULL(t1.Target, 0.0) AS Target
-            FROM comb_unique
-            LEFT JOIN
-              (SELECT Actor1Geo_CountryCode, Actor2Geo_CountryCode, SQLDATE as Date, {target_type} as Target
-              FROM `gdelt-bq.full.events`
-              WHERE MonthYear = {month}
-              AND NOT Actor1Geo_CountryCode IS NULL
-              AND NOT Actor2Geo_CountryCode IS NULL
-              GROUP BY Actor1Geo_CountryCode, Actor2Geo_CountryCode, SQLDATE
-              ORDER BY Actor1Geo_CountryCode, Actor2Geo_CountryCode, SQLDATE) AS t1
-            ON comb_unique.Actor1 = t1.Actor1Geo_CountryCode
-            AND comb_unique.Actor2 = t1.Actor2Geo_CountryCode
-            AND comb_unique.Date = t1.Date)
-        SELECT t1.Actor{role_1} AS Actor1, 
-               t2.Actor{role_1} AS Actor2,
-               CORR(t1.Target, t2.Target) AS TargetCorr
-        FROM filled_table as t1
-        CROSS JOIN filled_table as t2
-        WHERE t1.Actor{role_2} = t2.Actor{role_2}
-        AND t1.Date = t2.Date
-        AND t1.Actor{role_1} < t2.Actor{role_1}
-        GROUP BY t1.Actor{role_1}, t2.Actor{role_1}
-        HAVING NOT IS_NAN(TargetCorr)
-        ORDER BY TargetCorr DESC
-        LIMIT 10
+    def _build_query(self, parameters):
+        """
+        Sparse daily series of all measures for each pair of countries, the same for
+        all target and actor types, so switching between them uses the same (cached) result.
+        Pairs with unknown country are kept, they define days and countries of month
         """
+        return AggregateQuery(
+            keys=[('Actor1', 'Actor1Geo_CountryCode'),
+                  ('Actor2', 'Actor2Geo_CountryCode'),
+                  ('Date', 'SQLDATE')],
+            measures=[('Count', 'count', None),
+                      ('Tone', 'avg', 'AvgTone'),
+                      ('Mentions', 'sum', 'NumMentions'),
+                      ('Goldstein', 'avg', 'GoldsteinScale'),
+                      ('Actor2Known', 'count', 'Actor2CountryCode')],
+            filters=[('MonthYear', '=', parameters['month'].value)])
 
-    def get_plot(self, parameters):
-        target_dict = {
-            1: "COUNT(*)",
-            2: "AVG(AvgTone)",
-            3: "Sum(NumMentions)",
-            4: "AVG(GoldsteinScale)"
-        }
+    @staticmethod
+    def _correlation_matrix(df, role, target):
+        """
+        Builds dense matrix of series (country of role) x (country of other role, day),
+        missing combinations are 0, and correlates all series at once
+        :param df: result of _build_query
+        :param role: 1 or 2, role of correlated countries
+        :param target: measure column of df
+        :return: DataFrame with correlation coefficients of each pair of countries,
+        NaN where correlation is undefined
+        """
+        code_dictionary = Utils().get_code_dictionary()
+        actor1 = code_dictionary.codes(df['Actor1'])
+        actor2 = code_dictionary.codes(df['Actor2'])
+        countries = [
+            code_dictionary.sorted_codes(actor1),
+            code_dictionary.sorted_codes(actor2[df['Actor2Known'].to_numpy() > 0]),
+        ]
+        days = np.sort(pd.unique(df['Date'].to_numpy()))
+
+        pairs = (actor1 >= 0) & (actor2 >= 0)
+        rows = code_dictionary.index_of(actor1[pairs], countries[0])
+        columns = code_dictionary.index_of(actor2[pairs], countries[1])
+        day_index = pd.Index(days).get_indexer(df['Date'].to_numpy()[pairs])
+        target = np.nan_to_num(df[target].to_numpy(dtype=np.float64)[pairs])
+        inside = columns >= 0
+
+        dense = np.zeros((len(countries[0]), len(countries[1]), len(days)))
+        dense[rows[inside], columns[inside], day_index[inside]] = target[inside]
+        if role == 2:
+            dense = dense.transpose((1, 0, 2))
+        series = code_dictionary.dtype.categories[countries[role - 1]]
+        dense = dense.reshape((len(series), -1))
 
+        if len(series) == 0:
+            corr = np.empty((0, 0))
+        elif dense.shape[1] < 2:
+            corr = np.full((len(series), len(series)), np.nan)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corr = np.atleast_2d(np.corrcoef(dense))
+        return pd.DataFrame(corr, index=series, columns=series)
+
+    @staticmethod
+    def _top_pairs(matrix, count=10):
+        """
+        :param matrix: result of _correlation_matrix
+        :param count: number of pairs
+        :return: DataFrame with Actor1, Actor2 and TargetCorr of most correlated pairs,
+        sorted by TargetCorr descending
+        """
+        first, second = np.triu_indices(matrix.shape[0], 1)
+        values = matrix.to_numpy()[first, second]
+        defined = ~np.isnan(values)
+        first, second, values = first[defined], second[defined], values[defined]
+        order = np.argsort(-values, kind='stable')[:count]
+        countries = matrix.index.to_numpy()
+        return pd.DataFrame({'Actor1': countries[first[order]],
+                             'Actor2': countries[second[order]],
+                             'TargetCorr': values[order]})
+
+    def get_queries(self, parameters):
+        return [self._build_query(parameters)]
+
+    def get_correlation_matrix(self, parameters):
+        """
+        :param parameters: dictionary of parameters
+        :return: DataFrame with correlation coefficients of all pairs of countries
+        """
         qe = QueryExecutor()
-        query = self.query.format(
-            month=parameters['month'].value,
-            role_1=parameters['actor_type'].value,
-            role_2=(3 - parameters['actor_type'].value),
-            target_type=target_dict[parameters['target_type'].value],
-        )
-        df = qe.get_result_dataframe(query)
+        df = qe.get_result_dataframe(self._build_query(parameters), categorical_cols=['Actor1', 'Actor2'])
+        return self._correlation_matrix(df, parameters['actor_type'].value,
+                                        target_columns[parameters['target_type'].value])
+
+    def get_plot(self, parameters):
+        df = self._top_pairs(self.get_correlation_matrix(parameters))
         df = df.iloc[::-1]
-        df['Actor1'] = df['Actor1'].map(Utils().get_fips_country_id_to_name_mapping())
-        df['Actor2'] = df['Actor2'].map(Utils().get_fips_country_id_to_name_mapping())
+        code_dictionary = Utils().get_code_dictionary()
+        df['Actor1'] = code_dictionary.decode_names(df['Actor1'], 'fips_country')
+        df['Actor2'] = code_dictionary.decode_names(df['Actor2'], 'fips_country')
         df['Country name'] = df['Actor1'] + ' & ' + df['Actor2']
         df['Correlation coefficient'] = df['TargetCorr']
 
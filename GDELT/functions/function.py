@@ -7,6 +7,10 @@ class Function:
     TODO add auto search of classes which implements this class
     """
 
+    # if True, plot of function is first drawn from sample of events table
+    # and replaced by exact plot when it is ready (see FunctionUtil.get_preview)
+    supports_preview = False
+
     def get_plot(self, parameters):
         """
         :param parameters:
@@ -17,6 +21,17 @@ class Function:
         """
         raise Exception("Method isn't defined")
 
+    def get_queries(self, parameters):
+        """
+        :param parameters:
+        dictionary where keys are parameter names,
+        values are values for parameter
+        :return:
+        list of queries (QueryPlan or string SQL) executed by get_plot,
+        used for estimation of query cost
+        """
+        return []
+
     @staticmethod
     def get_parameters():
         """
@@ -1,7 +1,14 @@
 from multiprocessing.dummy import Pool
-from threading import Lock
+from threading import Lock, Event
 import uuid
-from ..utils.utils import Singleton
+import json
+import logging
+from ..utils.utils import Singleton, QueryExecutor, query_bytes_budget, function_bytes_budgets, \
+    preview_sample_percent, job_broker_path, job_results_max_bytes, job_result_ttl
+from ..utils.job_broker import JobBroker, BrokerPool, preview_task, result_task
+from ..utils.result_store import ResultStore, JobExpired
+from ..parametrs.date_parameters import DateTimeParameter, MonthParameter, MonthRangeParameter, \
+    YearParameter, YearRangeParameter
 from .event_count import EventCount
 from .coutry_connection_count import CountryConnectionCount
 from .country_relations import CountryRelations
@@ -12,6 +19,8 @@ from .event_base_type import EventBaseType
 from .domestic_policy_clustering import DomesticPolicyClustering
 from .clustering import Clustering
 
+logger = logging.getLogger(__name__)
+
 
 class FunctionUtil(metaclass=Singleton):
     """
@@ -24,7 +33,10 @@ class FunctionUtil(metaclass=Singleton):
         self.function_list as tuple pof function name and function instance
         """
         print("function utils init")
-        self.function_pool = FunctionPool(self.get_plot)
+        if job_broker_path is not None:
+            self.function_pool = BrokerPool(JobBroker(job_broker_path), self.get_job_key, preview=True)
+        else:
+            self.function_pool = FunctionPool(self.get_plot, self.get_preview, self.get_job_key)
         self.function_dict = {
             'event_count': EventCount(),
             'country_connection_count': CountryConnectionCount(),
@@ -61,6 +73,17 @@ class FunctionUtil(metaclass=Singleton):
         return [(name, function.get_name(), function.get_description())
                 for name, function in self.function_dict.items()]
 
+    def make_parameters(self, function_name, param_dict):
+        """
+        :param function_name: name of function
+        :param param_dict: dictionary parameter name -> value from request
+        :return: dictionary parameter name -> parameter instance
+        """
+        function = self.get_function_by_name(function_name)
+        function_params_dict = {names[0]: param for param, names in function.get_parameters()}
+        return {param_name: function_params_dict[param_name](value)
+                for param_name, value in param_dict.items()}
+
     def get_plot(self, args):
         """
         :param args: tuple of (function name, parameters dictionary)
@@ -68,10 +91,48 @@ class FunctionUtil(metaclass=Singleton):
         """
         function_name, param_dict = args
         function = self.get_function_by_name(function_name)
-        function_params_dict = {names[0]: param for param, names in function.get_parameters()}
-        params_dict = {param_name: function_params_dict[param_name](value)
-                       for param_name, value in param_dict.items()}
-        return function.get_plot(params_dict)
+        params_dict = self.make_parameters(function_name, param_dict)
+        qe = QueryExecutor()
+        qe.set_current_function(function_name)
+        try:
+            return function.get_plot(params_dict)
+        finally:
+            qe.set_current_function(None)
+
+    def get_job_key(self, args):
+        """
+        :param args: tuple of (function name, parameters dictionary)
+        :return: canonical key of function request, requests with the same
+        function and parameter values (after parsing) have the same key
+        """
+        function_name, param_dict = args
+        params_dict = self.make_parameters(function_name, param_dict)
+        return function_name, json.dumps({name: param.value for name, param in params_dict.items()},
+                                         sort_keys=True, default=str)
+
+    def get_preview(self, args):
+        """
+        Draws plot of function from sample of events table, counts and sums are scaled
+        to the whole table. Preview is skipped if queries of function are answered
+        without BigQuery (cache, rollup cube or local store), as exact plot is ready as fast
+        :param args: tuple of (function name, parameters dictionary)
+        :return: approximate plot of function in html or None if function has no preview
+        """
+        function_name, param_dict = args
+        function = self.get_function_by_name(function_name)
+        if not function.supports_preview or preview_sample_percent is None:
+            return None
+        params_dict = self.make_parameters(function_name, param_dict)
+        qe = QueryExecutor()
+        qe.set_current_function(function_name)
+        try:
+            if not any(qe.estimate_bytes(query) for query in function.get_queries(params_dict)):
+                return None
+            qe.set_sample_percent(preview_sample_percent)
+            return function.get_plot(params_dict)
+        finally:
+            qe.set_sample_percent(None)
+            qe.set_current_function(None)
 
     def check_params(self, function_name, param_dict):
         """
@@ -98,6 +159,70 @@ class FunctionUtil(metaclass=Singleton):
             check_param_value(param_name, value)
 
         function.check_params(param_dict)
+        self.check_cost(function_name, param_dict)
+
+    def check_cost(self, function_name, param_dict):
+        """
+        Estimates bytes processed by queries of function with dry run
+        and compares them with budget of function
+        :param function_name: name of function
+        :param param_dict: parameters dictionary with checked values
+        :return: estimated number of bytes
+        :raise AssertionError with error description and name of time range parameter
+        if estimation exceeds budget
+        """
+        function = self.get_function_by_name(function_name)
+        budget = function_bytes_budgets.get(function_name, query_bytes_budget)
+        qe = QueryExecutor()
+        qe.set_current_function(function_name)
+        try:
+            queries = function.get_queries(self.make_parameters(function_name, param_dict))
+            estimated = sum(qe.run(qe.gather(*[qe.estimate(query) for query in queries])))
+            qe.record_estimate(estimated)
+        finally:
+            qe.set_current_function(None)
+        if budget is not None and estimated > budget:
+            raise AssertionError(
+                "Query would process {:.1f} GB, limit of this function is {:.1f} GB. "
+                "Choose shorter time range".format(estimated / 1024 ** 3, budget / 1024 ** 3),
+                self.get_range_parameter(function_name))
+        return estimated
+
+    def get_range_parameter(self, function_name):
+        """
+        :param function_name: name of function
+        :return: name of time range parameter of function (first parameter if there is no such)
+        """
+        date_parameters = (DateTimeParameter, MonthParameter, MonthRangeParameter,
+                           YearParameter, YearRangeParameter)
+        parameters = self.get_function_by_name(function_name).get_parameters()
+        for param, names in parameters:
+            if isinstance(param, type) and issubclass(param, date_parameters):
+                return names[0]
+        return parameters[0][1][0] if parameters else None
+
+
+class FunctionJob:
+    """
+    Exact result of function and optional approximate preview
+    computed for the same job id. Identical submissions share one job,
+    aliases are job ids attached to it. Results are kept in result store of pool
+    """
+
+    def __init__(self, key=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.aliases = set()
+        self.error = None
+        self.has_preview = False
+        # set when exact result (or error) is ready
+        self.done = Event()
+        # set when preview or exact result can be shown
+        self.first_ready = Event()
+
+    @property
+    def refs(self):
+        return len(self.aliases)
 
 
 class FunctionPool():
@@ -106,55 +231,193 @@ class FunctionPool():
     Be aware that each job_id is only shared between thread of one process.
     Multiple workers aren't supported,
     as only process has access to its own function pool.
-    TODO Move pool to separate server application (maybe new server with REST API)
+    Set job_broker_path to share jobs between processes (see BrokerPool)
     """
 
-    def __init__(self, fun):
+    def __init__(self, fun, preview_fun=None, key_fun=None, max_bytes=job_results_max_bytes, ttl=job_result_ttl):
         """
         :param fun: function to run on each task
+        :param preview_fun: function which returns approximate result of task
+        or None if task has no preview, by default tasks have no previews
+        :param key_fun: function which returns hashable canonical key of task args,
+        tasks with the same key submitted while the first one is running share it.
+        By default every task is executed
+        :param max_bytes: maximal total size of compressed results kept by pool
+        :param ttl: seconds for which finished result is kept, job ids of evicted results
+        raise JobExpired
         """
         self.pool = Pool(4)
         self.fun = fun
+        self.preview_fun = preview_fun
+        self.key_fun = key_fun
         self.jobs = {}
+        # key of task -> FunctionJob which is running
+        self.in_flight = {}
+        # id of FunctionJob -> finished job whose result is in store
+        self.stored = {}
+        self.store = ResultStore(max_bytes, ttl, on_evict=self._evicted)
         self.jobs_look = Lock()
 
     def add_task(self, args):
         """
-        Adds new task to pool
+        Adds new task to pool, its preview (if any) is computed at the same time.
+        If the same task is already running, new job id is attached to it
         :param args: args witch will be passed to task
         :return: unique task id
         """
-        res = self.pool.apply_async(self.fun, (args,))
+        key = self.key_fun(args) if self.key_fun is not None else None
         job_uuid = uuid.uuid4()
         with self.jobs_look:
-            self.jobs[str(job_uuid)] = res
+            job = self.in_flight.get(key) if key is not None else None
+            if job is None:
+                job = self._start(args, key)
+                if key is not None:
+                    self.in_flight[key] = job
+            job.aliases.add(str(job_uuid))
+            self.jobs[str(job_uuid)] = job
         return job_uuid
 
+    def _start(self, args, key):
+        job = FunctionJob(key)
+        if self.preview_fun is not None:
+            self.pool.apply_async(self.preview_fun, (args,),
+                                  callback=lambda value: self._preview_finished(job, value),
+                                  error_callback=lambda error: self._preview_failed(job, error))
+        self.pool.apply_async(self.fun, (args,), callback=lambda value: self._finished(job, value),
+                              error_callback=lambda error: self._finished(job, None, error))
+        return job
+
+    def _preview_finished(self, job, value):
+        if value is None or job.done.is_set():
+            return
+        self.store.put((job.id, preview_task), value)
+        job.has_preview = True
+        job.first_ready.set()
+        if job.done.is_set():
+            # exact result was stored in the meantime
+            self.store.delete((job.id, preview_task))
+
+    @staticmethod
+    def _preview_failed(job, error):
+        """
+        Failed preview is only logged, job waits for its exact result
+        """
+        logger.error("Preview of job %s failed", job.id, exc_info=(type(error), error, error.__traceback__))
+
+    def _finished(self, job, value, error=None):
+        with self.jobs_look:
+            if self.in_flight.get(job.key) is job:
+                del self.in_flight[job.key]
+            # result of job without job ids can't be requested
+            keep = job.refs > 0
+            if keep:
+                self.stored[job.id] = job
+        if keep:
+            # entry of failed job keeps its error for the same time
+            self.store.put((job.id, result_task), value)
+        job.error = error
+        self.store.delete((job.id, preview_task))
+        job.done.set()
+        job.first_ready.set()
+
+    def _evicted(self, key):
+        """
+        Detaches job ids of job whose result expired or was evicted from store
+        """
+        job_id, kind = key
+        if kind != result_task:
+            return
+        with self.jobs_look:
+            job = self.stored.pop(job_id, None)
+            for alias in job.aliases if job is not None else []:
+                self.jobs.pop(alias, None)
+
+    def _job(self, job_uuid):
+        """
+        :return: FunctionJob of job id
+        :raise JobExpired if job id is unknown or result of job expired
+        """
+        # job ids of all expired results are detached, not only of this one
+        self.store.expire()
+        with self.jobs_look:
+            job = self.jobs.get(str(job_uuid))
+        if job is None or job.done.is_set() and (job.id, result_task) not in self.store:
+            raise JobExpired(job_uuid)
+        return job
+
+    def release(self, job_uuid):
+        """
+        Detaches job id (i.e. when its user left page), other ids of the same job
+        still get its result. Job which is running stays shared by new identical tasks
+        :param job_uuid: job id returned by add_task method
+        :return: number of job ids still attached to job
+        """
+        with self.jobs_look:
+            job = self.jobs.pop(str(job_uuid), None)
+            if job is None:
+                return 0
+            job.aliases.discard(str(job_uuid))
+            drop = not job.aliases and self.stored.pop(job.id, None) is not None
+        if drop:
+            self.store.delete((job.id, result_task))
+        return job.refs
+
     def check_if_complete(self, job_uuid):
         """
         :param job_uuid: job id returned by add_task method
         :return: check if job is completed
+        :raise JobExpired if result of job expired
         """
-        with self.jobs_look:
-            is_complete = self.jobs[job_uuid].ready()
-        return is_complete
+        return self._job(job_uuid).done.is_set()
 
     def get_result(self, job_uuid):
         """
         Can only be called after wait_result function
         :param job_uuid: job id returned by add_task method
         :return: result of function execution
+        :raise JobExpired if result of job expired
         """
-        with self.jobs_look:
-            value = self.jobs[job_uuid].get()
-        return value
+        job = self._job(job_uuid)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        try:
+            return self.store.get((job.id, result_task))
+        except KeyError:
+            raise JobExpired(job_uuid)
 
     def wait_result(self, job_uuid):
         """
         Wait for function complete
         :param job_uuid: job id returned by add_task method
         :return: nothing
+        :raise JobExpired if result of job expired
         """
-        with self.jobs_look:
-            job = self.jobs[job_uuid]
-        job.wait()
+        self._job(job_uuid).done.wait()
+        self._job(job_uuid)
+
+    def wait_first(self, job_uuid):
+        """
+        Waits until preview or exact result of job can be shown
+        :param job_uuid: job id returned by add_task method
+        :return: nothing
+        :raise JobExpired if result of job expired
+        """
+        self._job(job_uuid).first_ready.wait()
+        self._job(job_uuid)
+
+    def get_latest(self, job_uuid):
+        """
+        Can only be called after wait_first function
+        :param job_uuid: job id returned by add_task method
+        :return: tuple (result of function, True if it is approximate preview)
+        :raise JobExpired if result of job expired
+        """
+        job = self._job(job_uuid)
+        if not job.done.is_set() and job.has_preview:
+            try:
+                return self.store.get((job.id, preview_task)), True
+            except KeyError:
+                # preview was evicted, exact result is awaited
+                pass
+        return self.get_result(job_uuid), False
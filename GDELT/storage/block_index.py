@@ -0,0 +1,105 @@
+import numpy as np
+
+# number of rows in one block of fragment, blocks are the smallest unit skipped by indexes
+block_rows = 8192
+
+# columns with min/max values of each block
+zone_map_columns = ['SQLDATE', 'MonthYear', 'QuadClass']
+
+# code columns with bitmaps of blocks containing each value
+bitmap_columns = [
+    'Actor1Geo_CountryCode',
+    'Actor2Geo_CountryCode',
+    'ActionGeo_CountryCode',
+    'EventRootCode',
+    'Actor1CountryCode',
+    'Actor2CountryCode',
+]
+
+# rows of fragment are sorted by these columns before writing,
+# so rows of the same country are placed in few blocks
+cluster_columns = ['ActionGeo_CountryCode', 'Actor1Geo_CountryCode', 'SQLDATE']
+
+
+def block_count(rows, size=block_rows):
+    return (rows + size - 1) // size
+
+
+def build_zone_map(values, size=block_rows):
+    """
+    :param values: numeric array without NULL values
+    :param size: number of rows in block
+    :return: array of shape (blocks, 2) with min and max value of each block
+    """
+    values = np.asarray(values)
+    if values.shape[0] == 0:
+        return np.empty((0, 2), dtype=values.dtype)
+    starts = np.arange(0, values.shape[0], size)
+    return np.stack([np.minimum.reduceat(values, starts),
+                     np.maximum.reduceat(values, starts)], axis=1)
+
+
+def build_block_bitmap(codes, values_count, size=block_rows):
+    """
+    :param codes: array of dictionary codes, -1 for NULL
+    :param values_count: size of dictionary
+    :param size: number of rows in block
+    :return: packed bit matrix of shape (values_count + 1, ceil(blocks / 8)),
+    bit j of row i is set if block j contains code i, last row is for NULL
+    """
+    codes = np.asarray(codes)
+    blocks = block_count(codes.shape[0], size)
+    present = np.zeros((values_count + 1, blocks), dtype=bool)
+    rows = np.where(codes >= 0, codes, values_count).astype(np.int64)
+    present[rows, np.arange(codes.shape[0]) // size] = True
+    return np.packbits(present, axis=1)
+
+
+def unpack_block_bitmap(bitmap, blocks):
+    """
+    :param bitmap: packed bit matrix from build_block_bitmap
+    :param blocks: number of blocks of fragment
+    :return: boolean matrix of shape (values + 1, blocks)
+    """
+    return np.unpackbits(bitmap, axis=1, count=blocks).astype(bool)
+
+
+def zone_map_blocks(zone_map, op, value):
+    """
+    :param zone_map: array of shape (blocks, 2) from build_zone_map
+    :param op: filter operator
+    :param value: filter value
+    :return: boolean array of blocks which can contain matching rows, None if filter can't be used
+    """
+    low, high = zone_map[:, 0], zone_map[:, 1]
+    if op == 'in':
+        values = [float(item) for item in value]
+        matching = np.zeros(zone_map.shape[0], dtype=bool)
+        for item in values:
+            matching |= (low <= item) & (item <= high)
+        return matching
+    if op not in ('=', '!=', '<', '<=', '>', '>='):
+        return None
+    value = float(value)
+    if op == '=':
+        return (low <= value) & (value <= high)
+    if op == '!=':
+        return (low != value) | (high != value)
+    if op == '<':
+        return low < value
+    if op == '<=':
+        return low <= value
+    if op == '>':
+        return high > value
+    return high >= value
+
+
+def bitmap_blocks(present, matching_codes, with_null):
+    """
+    :param present: boolean matrix from unpack_block_bitmap
+    :param matching_codes: boolean array of dictionary codes which pass filter
+    :param with_null: True if NULL values pass filter
+    :return: boolean array of blocks containing at least one matching value
+    """
+    rows = np.append(matching_codes, with_null)
+    return present[rows].any(axis=0)
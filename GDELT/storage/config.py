@@ -0,0 +1,14 @@
+# paths of local storage, kept without dependencies on BigQuery and web server,
+# so storage commands (i.e. python -m GDELT.storage.ingest) run without them
+
+# local event store read by "local" query backend
+local_store_path = "GDELT/store/events"
+
+# monthly rollup cube, query plans which fit its grain are answered from it
+# by any backend, set path to None to disable it
+rollup_path = "GDELT/store/rollup"
+
+# default event store and rollup cube of synthetic events (python -m GDELT.storage.synthetic),
+# kept apart from the paths above, so synthetic events never mix with real ones
+synthetic_store_path = "GDELT/cache/synthetic/events"
+synthetic_rollup_path = "GDELT/cache/synthetic/rollup"
@@ -0,0 +1,259 @@
+import os
+import json
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+from ..utils.query_plan import months_between
+from . import block_index
+
+meta_file = "_meta.json"
+
+# columns of events table kept in local store with their storage types,
+# "code" columns are dictionary encoded: int16 codes (-1 for NULL) + values
+store_columns = [
+    ('SQLDATE', np.int32),
+    ('MonthYear', np.int32),
+    ('Actor1CountryCode', 'code'),
+    ('Actor2CountryCode', 'code'),
+    ('Actor1Type1Code', 'code'),
+    ('Actor2Type1Code', 'code'),
+    ('EventRootCode', 'code'),
+    ('QuadClass', np.int8),
+    ('GoldsteinScale', np.float32),
+    ('NumMentions', np.int32),
+    ('AvgTone', np.float32),
+    ('Actor1Geo_CountryCode', 'code'),
+    ('Actor2Geo_CountryCode', 'code'),
+    ('ActionGeo_CountryCode', 'code'),
+    ('ActionGeo_Lat', np.float64),
+    ('ActionGeo_Long', np.float64),
+]
+store_column_types = dict(store_columns)
+
+
+def write_json(path, data):
+    tmp_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as target:
+        json.dump(data, target)
+    os.replace(tmp_path, path)
+
+
+def encode_codes(values):
+    """
+    :param values: array of strings, None or NaN for NULL
+    :return: tuple (codes, dictionary) of int16 (or int32 for large dictionaries) codes
+    and sorted unicode array of distinct values
+    """
+    values = pd.Series(values, dtype=object)
+    codes, dictionary = pd.factorize(values, sort=True)
+    code_type = np.int16 if len(dictionary) < np.iinfo(np.int16).max else np.int32
+    return codes.astype(code_type), np.array([str(value) for value in dictionary], dtype=str)
+
+
+class Fragment:
+    """
+    Part of month partition written at once (i.e. from one export file).
+    Each column is stored in separate .npy file and is memory-mapped on read.
+    Rows are split into blocks, fragment keeps min/max of each block (zone maps)
+    and bitmaps of blocks containing each code (block bitmaps), so scans
+    can skip blocks which don't match filters
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, meta_file), 'r') as source:
+            self.meta = json.load(source)
+        self.rows = self.meta['rows']
+        self.block_rows = self.meta.get('block_rows', block_index.block_rows)
+        self.blocks = block_index.block_count(self.rows, self.block_rows)
+        self._dictionaries = {}
+        self._bitmaps = {}
+
+    def column(self, name):
+        """
+        :param name: column name
+        :return: memory-mapped array of values (codes for code columns)
+        """
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def is_coded(self, name):
+        return store_column_types[name] == 'code'
+
+    def dictionary(self, name):
+        """
+        :param name: name of code column
+        :return: sorted unicode array of values, code is index in this array
+        """
+        if name not in self._dictionaries:
+            self._dictionaries[name] = np.load(os.path.join(self.path, name + '.dict.npy'))
+        return self._dictionaries[name]
+
+    def zone_map(self, name):
+        """
+        :param name: name of column from block_index.zone_map_columns
+        :return: array of shape (blocks, 2) with min and max of each block, None if there is no index
+        """
+        path = os.path.join(self.path, name + '.zone.npy')
+        if not os.path.exists(path):
+            return None
+        return np.load(path)
+
+    def block_bitmap(self, name):
+        """
+        :param name: name of column from block_index.bitmap_columns
+        :return: boolean matrix (dictionary values + NULL) x blocks, None if there is no index
+        """
+        if name not in self._bitmaps:
+            path = os.path.join(self.path, name + '.blocks.npy')
+            self._bitmaps[name] = block_index.unpack_block_bitmap(np.load(path), self.blocks) \
+                if os.path.exists(path) else None
+        return self._bitmaps[name]
+
+    def has_indexes(self):
+        return all(os.path.exists(os.path.join(self.path, name + '.zone.npy'))
+                   for name in block_index.zone_map_columns) and \
+            all(os.path.exists(os.path.join(self.path, name + '.blocks.npy'))
+                for name in block_index.bitmap_columns)
+
+    def build_indexes(self):
+        """
+        Writes zone maps and block bitmaps of fragment
+        :return: nothing
+        """
+        for name in block_index.zone_map_columns:
+            zone_map = block_index.build_zone_map(self.column(name), block_index.block_rows)
+            self._save_index(name + '.zone.npy', zone_map)
+        for name in block_index.bitmap_columns:
+            bitmap = block_index.build_block_bitmap(
+                self.column(name), len(self.dictionary(name)), block_index.block_rows)
+            self._save_index(name + '.blocks.npy', bitmap)
+        self.meta['block_rows'] = self.block_rows = block_index.block_rows
+        self.blocks = block_index.block_count(self.rows, self.block_rows)
+        self._bitmaps = {}
+        write_json(os.path.join(self.path, meta_file), self.meta)
+
+    def _save_index(self, file_name, values):
+        tmp_path = os.path.join(self.path, '.tmp-{}-{}'.format(uuid.uuid4().hex, file_name))
+        np.save(tmp_path, values)
+        os.replace(tmp_path, os.path.join(self.path, file_name))
+
+    def decoded(self, name):
+        """
+        :param name: column name
+        :return: array of values, code columns are decoded into object arrays with None for NULL
+        """
+        values = self.column(name)
+        if not self.is_coded(name):
+            return values
+        dictionary = self.dictionary(name).astype(object)
+        decoded = np.empty(values.shape[0], dtype=object)
+        known = values >= 0
+        decoded[known] = dictionary[values[known]]
+        return decoded
+
+
+class EventStore:
+    """
+    Local columnar copy of GDELT events table.
+    Data is partitioned by month: <path>/<MonthYear>/<fragment>/<column>.npy
+    Indexes are kept per fragment, so new data doesn't change existing ones
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def months(self):
+        """
+        :return: sorted list of int months (YYYYMM) which have data
+        """
+        if not self.exists():
+            return []
+        return sorted(int(name) for name in os.listdir(self.path)
+                      if name.isdigit() and len(name) == 6 and self.fragment_names(int(name)))
+
+    def covers(self, start, end):
+        """
+        :param start: first month, None if unbounded
+        :param end: month after last one, None if unbounded
+        :return: True if store has data for each month of range
+        """
+        if start is None or end is None:
+            return False
+        available = set(self.months())
+        return all(month in available for month in months_between(start, end))
+
+    def fragment_names(self, month):
+        month_path = os.path.join(self.path, str(month))
+        if not os.path.isdir(month_path):
+            return []
+        return sorted(name for name in os.listdir(month_path)
+                      if not name.startswith('.') and
+                      os.path.exists(os.path.join(month_path, name, meta_file)))
+
+    def fragments(self, month):
+        """
+        :param month: int month in format YYYYMM
+        :return: list of Fragment of month partition
+        """
+        return [Fragment(os.path.join(self.path, str(month), name))
+                for name in self.fragment_names(month)]
+
+    def write_fragment(self, month, name, columns):
+        """
+        Writes (or replaces) fragment of month partition atomically
+        :param month: int month in format YYYYMM
+        :param name: name of fragment, i.e. name of source file
+        :param columns: dictionary column name -> array of values
+        with all columns from store_columns
+        :return: Fragment
+        """
+        month_path = os.path.join(self.path, str(month))
+        os.makedirs(month_path, exist_ok=True)
+        tmp_path = os.path.join(month_path, '.tmp-{}-{}'.format(name, uuid.uuid4().hex))
+        os.makedirs(tmp_path)
+        arrays = {}
+        dictionaries = {}
+        for column, dtype in store_columns:
+            if dtype == 'code':
+                arrays[column], dictionaries[column] = encode_codes(columns[column])
+            else:
+                arrays[column] = np.asarray(columns[column], dtype=dtype)
+        # codes follow order of sorted dictionaries, so sorting by codes clusters equal values
+        order = np.lexsort([arrays[column] for column in reversed(block_index.cluster_columns)])
+        for column, dtype in store_columns:
+            np.save(os.path.join(tmp_path, column + '.npy'), arrays[column][order])
+            if dtype == 'code':
+                np.save(os.path.join(tmp_path, column + '.dict.npy'), dictionaries[column])
+        rows = len(order)
+        write_json(os.path.join(tmp_path, meta_file),
+                   {'rows': rows, 'month': month, 'block_rows': block_index.block_rows})
+        Fragment(tmp_path).build_indexes()
+
+        fragment_path = os.path.join(month_path, name)
+        old_path = None
+        if os.path.exists(fragment_path):
+            old_path = os.path.join(month_path, '.old-{}-{}'.format(name, uuid.uuid4().hex))
+            os.rename(fragment_path, old_path)
+        os.rename(tmp_path, fragment_path)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+        return Fragment(fragment_path)
+
+    def build_indexes(self, force=False):
+        """
+        Builds indexes of fragments which don't have them (i.e. written by older version)
+        :param force: rebuild indexes of all fragments
+        :return: number of indexed fragments
+        """
+        indexed = 0
+        for month in self.months():
+            for fragment in self.fragments(month):
+                if force or not fragment.has_indexes():
+                    fragment.build_indexes()
+                    indexed += 1
+        return indexed
@@ -0,0 +1,191 @@
+"""
+Ingest of GDELT 1.0 event export files into local event store.
+
+Usage (from main directory of project):
+    python -m GDELT.storage.ingest <directory with export files> [--store PATH] [--rollup PATH]
+        [--workers N] [--force]
+    python -m GDELT.storage.ingest --build-indexes [--store PATH]
+
+Files (YYYYMMDD.export.CSV.zip, YYYYMM.zip, YYYY.zip or unpacked .CSV)
+are decoded in parallel processes, only columns used by functions are kept.
+Rows of each file are split by MonthYear and written as fragments of month partitions.
+Already ingested files are skipped, so command can be rerun when new files arrive.
+Indexes are written together with fragments, --build-indexes adds them
+to fragments written before indexes existed.
+Months of rollup cube which got new rows are rebuilt after ingest. Cube at rollup_path
+is updated only from default store, ingest into other store (--store) updates
+cube given by --rollup or none.
+"""
+import os
+import sys
+import csv
+import zipfile
+import argparse
+from multiprocessing import Pool
+import pandas as pd
+
+from .event_store import EventStore, store_columns
+from .local_engine import LocalEngine
+from .rollup import RollupCube, build_from_store
+from .config import local_store_path, rollup_path
+
+# positions of stored columns in tab separated export files
+export_column_positions = {
+    'SQLDATE': 1,
+    'MonthYear': 2,
+    'Actor1CountryCode': 7,
+    'Actor1Type1Code': 12,
+    'Actor2CountryCode': 17,
+    'Actor2Type1Code': 22,
+    'EventRootCode': 28,
+    'QuadClass': 29,
+    'GoldsteinScale': 30,
+    'NumMentions': 31,
+    'AvgTone': 34,
+    'Actor1Geo_CountryCode': 37,
+    'Actor2Geo_CountryCode': 44,
+    'ActionGeo_CountryCode': 51,
+    'ActionGeo_Lat': 53,
+    'ActionGeo_Long': 54,
+}
+
+sources_dir = "_sources"
+chunk_rows = 1000000
+
+
+def export_files(source_dir):
+    """
+    :param source_dir: directory with export files
+    :return: sorted list of paths of export files
+    """
+    return sorted(os.path.join(source_dir, name) for name in os.listdir(source_dir)
+                  if name.lower().endswith(('.zip', '.csv', '.tsv')))
+
+
+def source_name(path):
+    name = os.path.basename(path)
+    for extension in ('.zip', '.csv', '.tsv'):
+        if name.lower().endswith(extension):
+            name = name[:-len(extension)]
+    return name
+
+
+def open_export_file(path):
+    """
+    :param path: path of zipped or plain export file
+    :return: binary file object of tab separated data
+    """
+    if path.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        return archive.open(archive.namelist()[0])
+    return open(path, 'rb')
+
+
+def read_export_chunks(path):
+    """
+    :param path: path of export file
+    :return: generator of DataFrames with stored columns in compact types
+    """
+    names = [name for name, _ in sorted(export_column_positions.items(), key=lambda item: item[1])]
+    dtypes = {name: (str if dtype == 'code' else dtype) for name, dtype in store_columns}
+    with open_export_file(path) as source:
+        for chunk in pd.read_csv(source,
+                                 sep='\t',
+                                 header=None,
+                                 usecols=sorted(export_column_positions.values()),
+                                 dtype={export_column_positions[name]: dtypes[name] for name in names},
+                                 quoting=csv.QUOTE_NONE,
+                                 keep_default_na=False,
+                                 na_values=[''],
+                                 chunksize=chunk_rows):
+            chunk.columns = names
+            yield chunk
+
+
+def ingest_file(args):
+    """
+    Decodes one export file and writes its rows to store
+    :param args: tuple (store path, export file path)
+    :return: tuple (export file path, number of rows, list of months)
+    """
+    store_path, path = args
+    store = EventStore(store_path)
+    name = source_name(path)
+    rows = 0
+    months = set()
+    for chunk_no, chunk in enumerate(read_export_chunks(path)):
+        for month, month_df in chunk.groupby('MonthYear'):
+            columns = {column: month_df[column].values for column, _ in store_columns}
+            store.write_fragment(int(month), '{}-{}'.format(name, chunk_no), columns)
+            months.add(int(month))
+        rows += chunk.shape[0]
+    mark_ingested(store_path, name)
+    return path, rows, sorted(months)
+
+
+def is_ingested(store_path, name):
+    return os.path.exists(os.path.join(store_path, sources_dir, name))
+
+
+def mark_ingested(store_path, name):
+    os.makedirs(os.path.join(store_path, sources_dir), exist_ok=True)
+    with open(os.path.join(store_path, sources_dir, name), 'w'):
+        pass
+
+
+def ingest(source_dir, store_path=local_store_path, workers=None, force=False, rollup=rollup_path):
+    """
+    Ingests all export files from directory using pool of processes
+    :param source_dir: directory with export files
+    :param store_path: path of event store
+    :param workers: number of processes, by default number of CPU cores
+    :param force: ingest files even if they were already ingested
+    :param rollup: path of rollup cube to update, None to skip update
+    :return: number of ingested rows
+    """
+    paths = [path for path in export_files(source_dir)
+             if force or not is_ingested(store_path, source_name(path))]
+    print("{} files to ingest".format(len(paths)))
+    if not paths:
+        return 0
+    os.makedirs(store_path, exist_ok=True)
+    total_rows = 0
+    updated_months = set()
+    with Pool(workers or os.cpu_count() or 1) as pool:
+        for path, rows, months in pool.imap_unordered(
+                ingest_file, [(store_path, path) for path in paths]):
+            total_rows += rows
+            updated_months.update(months)
+            print("{}: {} rows, months {}".format(os.path.basename(path), rows,
+                                                  ', '.join(map(str, months))))
+    print("Ingested {} rows".format(total_rows))
+    if rollup is not None:
+        build_from_store(RollupCube(rollup), LocalEngine(EventStore(store_path)), sorted(updated_months))
+    return total_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest GDELT event export files into local event store")
+    parser.add_argument('source_dir', nargs='?', help="directory with export files")
+    parser.add_argument('--store', default=local_store_path, help="path of event store")
+    parser.add_argument('--rollup', default=None,
+                        help="path of rollup cube to update, by default {} for default store "
+                             "and none for other stores".format(rollup_path))
+    parser.add_argument('--workers', type=int, default=None, help="number of decoding processes")
+    parser.add_argument('--force', action='store_true', help="ingest already ingested files again")
+    parser.add_argument('--build-indexes', action='store_true',
+                        help="build indexes of fragments which don't have them")
+    args = parser.parse_args(argv)
+    if args.build_indexes:
+        print("Indexed {} fragments".format(EventStore(args.store).build_indexes()))
+    if args.source_dir is not None:
+        rollup = args.rollup
+        if rollup is None and os.path.normpath(args.store) == os.path.normpath(local_store_path):
+            rollup = rollup_path
+        ingest(args.source_dir, args.store, args.workers, args.force, rollup)
+    elif not args.build_indexes:
+        parser.error("directory with export files is required")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
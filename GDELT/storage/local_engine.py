@@ -0,0 +1,359 @@
+import os
+import operator
+from multiprocessing.dummy import Pool
+import numpy as np
+import pandas as pd
+
+from ..utils.query_plan import JoinQuery, Column, Expression, months_between, filter_columns
+from .event_store import store_column_types
+from . import block_index
+
+comparison_operators = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+# substitute of NULL float key values during grouping
+null_float_key = np.inf
+
+
+def referenced_columns(plan):
+    """
+    :param plan: QueryPlan
+    :return: set of table columns used by plan
+    """
+    if isinstance(plan, JoinQuery):
+        return referenced_columns(plan.left) | referenced_columns(plan.right)
+    columns = {column for _, column in plan.keys}
+    columns.update(filter_columns(plan.filters))
+    for _, _, argument in plan.measures:
+        arguments = argument if isinstance(argument, tuple) else (argument,)
+        for item in arguments:
+            if isinstance(item, Expression):
+                columns.update(item.columns)
+            elif item is not None:
+                columns.add(item)
+    return columns
+
+
+class FragmentColumns:
+    """
+    Column source for evaluation of partial states on selected rows of fragment
+    """
+
+    def __init__(self, fragment, selection, rows):
+        self.fragment = fragment
+        self.selection = selection
+        self.rows = rows
+        self._cache = {}
+
+    def __call__(self, name):
+        if name not in self._cache:
+            values = np.asarray(self.fragment.column(name)[self.selection])
+            if self.fragment.is_coded(name):
+                dictionary = self.fragment.dictionary(name).astype(object)
+                decoded = np.empty(values.shape[0], dtype=object)
+                known = values >= 0
+                decoded[known] = dictionary[values[known]]
+                values = decoded
+            elif values.dtype.kind == 'f':
+                values = values.astype(np.float64)
+            self._cache[name] = values
+        return self._cache[name]
+
+
+class LocalEngine:
+    """
+    Executes query plans over local EventStore.
+    Fragments of month partitions are scanned concurrently by a pool of threads, each scan
+    produces partial aggregates which are merged and finalized at the end.
+    Parallelism is thread-level: threads overlap reads of memory-mapped columns and numpy
+    operations which release GIL, pandas grouping of fragments mostly runs on one core
+    (fragments aren't sent to processes, as columns would be copied)
+    String columns are compared and grouped by dictionary codes.
+    Blocks of fragments are pruned by zone maps and block bitmaps before reading
+    """
+
+    def __init__(self, store, workers=None):
+        """
+        :param store: EventStore
+        :param workers: number of scanning threads, by default number of CPU cores
+        """
+        self.store = store
+        self.pool = Pool(workers or os.cpu_count() or 1)
+
+    def can_execute(self, plan):
+        """
+        :param plan: QueryPlan
+        :return: True if store has all columns and months needed by plan
+        """
+        if not all(column in store_column_types for column in referenced_columns(plan)):
+            return False
+        return self.store.covers(*plan.month_bounds())
+
+    def execute(self, plan):
+        """
+        :param plan: AggregateQuery or JoinQuery
+        :return: DataFrame with the same columns as result of plan.to_sql() in BigQuery
+        """
+        if isinstance(plan, JoinQuery):
+            return plan.join(self.execute(plan.left), self.execute(plan.right))
+        return plan.finalize(self.execute_partial(plan))
+
+    def execute_partial(self, plan, fragments=None):
+        """
+        :param plan: AggregateQuery
+        :param fragments: list of Fragment to scan, by default all fragments of plan months
+        :return: DataFrame with decoded key columns and partial states
+        """
+        if fragments is None:
+            fragments = self.plan_fragments(plan)
+        key_dictionaries = {
+            column: self._key_dictionary(fragments, column)
+            for _, column in plan.keys if store_column_types[column] == 'code'}
+        states = plan.partial_states()
+        partials = [partial for partial in self.pool.map(
+            lambda fragment: self._scan(fragment, plan, states, key_dictionaries), fragments)
+                    if partial is not None]
+        return self._decode_keys(self._merge(partials, plan, states), plan, key_dictionaries)
+
+    def plan_fragments(self, plan):
+        """
+        :param plan: AggregateQuery
+        :return: list of fragments of months needed by plan
+        """
+        start, end = plan.month_bounds()
+        months = self.store.months()
+        if start is not None and end is not None:
+            months = [month for month in months_between(start, end) if month in set(months)]
+        fragments = []
+        for month in months:
+            fragments += self.store.fragments(month)
+        return fragments
+
+    @staticmethod
+    def _key_dictionary(fragments, column):
+        dictionaries = [fragment.dictionary(column) for fragment in fragments]
+        if not dictionaries:
+            return np.array([], dtype=str)
+        return np.unique(np.concatenate(dictionaries))
+
+    def _scan(self, fragment, plan, states, key_dictionaries):
+        """
+        Computes partial aggregates for one fragment
+        :return: DataFrame with key codes and partial states or None if no rows match
+        """
+        candidates = self.candidate_rows(fragment, plan.filters)
+        if candidates is not None and candidates.shape[0] == 0:
+            return None
+        mask = self.filter_mask(fragment, plan.filters, candidates)
+        if mask is None:
+            selection = slice(None) if candidates is None else candidates
+        else:
+            selection = np.flatnonzero(mask) if candidates is None else candidates[mask]
+        rows = fragment.rows if isinstance(selection, slice) else selection.shape[0]
+        if rows == 0:
+            return None
+        data = {}
+        for alias, column in plan.keys:
+            values = np.asarray(fragment.column(column)[selection])
+            if column in key_dictionaries:
+                remap = np.searchsorted(key_dictionaries[column], fragment.dictionary(column))
+                values = np.where(values >= 0, remap[np.maximum(values, 0)], -1)
+            elif values.dtype.kind == 'f':
+                values = np.where(np.isnan(values), null_float_key, values.astype(np.float64))
+            else:
+                values = values.astype(np.int64)
+            data[alias] = values
+        source = FragmentColumns(fragment, selection, rows)
+        for state in states:
+            data[state.name] = state.evaluate(source)
+        frame = pd.DataFrame(data, columns=[alias for alias, _ in plan.keys] + [state.name for state in states])
+        if not plan.keys:
+            return frame.sum().to_frame().T
+        return frame.groupby([alias for alias, _ in plan.keys], sort=False).sum().reset_index()
+
+    @staticmethod
+    def _merge(partials, plan, states):
+        keys = [alias for alias, _ in plan.keys]
+        if not partials:
+            columns = {alias: np.array([], dtype=np.int64) for alias in keys}
+            columns.update({state.name: np.array([], dtype=state.dtype) for state in states})
+            return pd.DataFrame(columns, columns=keys + [state.name for state in states])
+        if len(partials) == 1:
+            return partials[0]
+        merged = pd.concat(partials, ignore_index=True)
+        if not keys:
+            return merged.sum().to_frame().T
+        return merged.groupby(keys, sort=False).sum().reset_index()
+
+    @staticmethod
+    def _decode_keys(partial, plan, key_dictionaries):
+        for alias, column in plan.keys:
+            values = partial[alias].values
+            if column in key_dictionaries:
+                dictionary = key_dictionaries[column].astype(object)
+                decoded = np.empty(values.shape[0], dtype=object)
+                known = values >= 0
+                decoded[known] = dictionary[values[known].astype(np.int64)]
+                partial[alias] = decoded
+            elif store_column_types[column] in (np.float32, np.float64):
+                partial[alias] = np.where(values == null_float_key, np.nan, values)
+            else:
+                partial[alias] = values.astype(np.int64)
+        return partial
+
+    def candidate_blocks(self, fragment, filters):
+        """
+        :param fragment: Fragment
+        :param filters: list of filters of AggregateQuery
+        :return: boolean array of blocks which can contain matching rows,
+        None if no filter can be answered by indexes
+        """
+        blocks = None
+        for column, op, value in filters:
+            if isinstance(value, Column):
+                continue
+            column_blocks = None
+            if op == 'or':
+                column_blocks = self._any_candidate_blocks(fragment, value)
+            elif column in block_index.zone_map_columns:
+                zone_map = fragment.zone_map(column)
+                if zone_map is not None:
+                    column_blocks = block_index.zone_map_blocks(zone_map, op, value)
+            elif column in block_index.bitmap_columns:
+                present = fragment.block_bitmap(column)
+                if present is not None:
+                    column_blocks = self._bitmap_filter_blocks(fragment, column, present, op, value)
+            if column_blocks is not None:
+                blocks = column_blocks if blocks is None else blocks & column_blocks
+        return blocks
+
+    def _any_candidate_blocks(self, fragment, filters):
+        """
+        :return: blocks which can contain rows passing any of filters,
+        None if some filter can't be answered by indexes
+        """
+        blocks = None
+        for condition in filters:
+            condition_blocks = self.candidate_blocks(fragment, [condition])
+            if condition_blocks is None:
+                return None
+            blocks = condition_blocks if blocks is None else blocks | condition_blocks
+        return blocks
+
+    def _bitmap_filter_blocks(self, fragment, column, present, op, value):
+        all_codes = np.arange(len(fragment.dictionary(column)))
+        if op == 'is null':
+            return block_index.bitmap_blocks(present, np.zeros(all_codes.shape[0], dtype=bool), True)
+        matching_codes = self._code_filter_mask(fragment, column, all_codes, op, value)
+        return block_index.bitmap_blocks(present, matching_codes, False)
+
+    def candidate_rows(self, fragment, filters):
+        """
+        :param fragment: Fragment
+        :param filters: list of filters of AggregateQuery
+        :return: sorted array of rows of blocks which can contain matching rows,
+        None if all rows have to be scanned
+        """
+        blocks = self.candidate_blocks(fragment, filters)
+        if blocks is None or blocks.all():
+            return None
+        starts = np.flatnonzero(blocks) * fragment.block_rows
+        if starts.shape[0] == 0:
+            return np.array([], dtype=np.int64)
+        offsets = np.arange(fragment.block_rows)
+        rows = (starts[:, None] + offsets[None, :]).ravel()
+        return rows[rows < fragment.rows]
+
+    def filter_mask(self, fragment, filters, rows=None):
+        """
+        :param fragment: Fragment
+        :param filters: list of filters of AggregateQuery
+        :param rows: array of rows to check, by default all rows of fragment
+        :return: boolean array of rows which pass all filters, None if there are no filters
+        """
+        mask = None
+        for column, op, value in filters:
+            if op == 'or':
+                column_mask = np.logical_or.reduce([self.filter_mask(fragment, [condition], rows)
+                                                    for condition in value])
+            else:
+                column_mask = self._filter_mask(fragment, column, op, value, rows)
+            mask = column_mask if mask is None else mask & column_mask
+        return mask
+
+    def _filter_mask(self, fragment, column, op, value, rows=None):
+        values = fragment.column(column)
+        if rows is not None:
+            values = values[rows]
+        if isinstance(value, Column):
+            other_values = fragment.column(value.name)
+            if rows is not None:
+                other_values = other_values[rows]
+        if fragment.is_coded(column):
+            if isinstance(value, Column):
+                return self._column_code_filter_mask(fragment, column, values, op, value, other_values)
+            return self._code_filter_mask(fragment, column, values, op, value)
+        if op == 'is null':
+            return np.isnan(values) if values.dtype.kind == 'f' else np.zeros(values.shape[0], dtype=bool)
+        if op == 'is not null':
+            return ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(values.shape[0], dtype=bool)
+        if op == 'in':
+            return np.isin(values, [float(item) for item in value])
+        if isinstance(value, Column):
+            return comparison_operators[op](values, other_values)
+        return comparison_operators[op](values, float(value))
+
+    @staticmethod
+    def _code_filter_mask(fragment, column, codes, op, value):
+        """
+        Filter on dictionary encoded column. Dictionary is sorted,
+        so order of codes is the same as order of values
+        """
+        dictionary = fragment.dictionary(column)
+        known = codes >= 0
+        if op == 'is null':
+            return ~known
+        if op == 'is not null':
+            return known
+        if op == 'in':
+            found = np.flatnonzero(np.isin(dictionary, [str(item) for item in value]))
+            return np.isin(codes, found)
+        value = str(value)
+        if op in ('=', '!='):
+            position = np.searchsorted(dictionary, value)
+            code = position if position < len(dictionary) and dictionary[position] == value else -2
+            return known & comparison_operators[op](codes, code)
+        bounds = {
+            '<': (np.searchsorted(dictionary, value, 'left'), operator.lt),
+            '<=': (np.searchsorted(dictionary, value, 'right'), operator.lt),
+            '>': (np.searchsorted(dictionary, value, 'right'), operator.ge),
+            '>=': (np.searchsorted(dictionary, value, 'left'), operator.ge),
+        }
+        bound, compare = bounds[op]
+        return known & compare(codes, bound)
+
+    @staticmethod
+    def _column_code_filter_mask(fragment, column, codes, op, value, other_codes):
+        """
+        Equality of two code columns, codes of other column are mapped to dictionary of first one
+        """
+        dictionary = fragment.dictionary(column)
+        other_dictionary = fragment.dictionary(value.name)
+        positions = np.searchsorted(dictionary, other_dictionary)
+        positions = np.minimum(positions, max(len(dictionary) - 1, 0))
+        lookup = np.where(dictionary[positions] == other_dictionary, positions, -2) \
+            if len(dictionary) else np.full(len(other_dictionary), -2)
+        known = codes >= 0
+        other_known = other_codes >= 0
+        mapped = np.where(other_known, lookup[np.maximum(other_codes, 0)], -2)
+        if op == '=':
+            return known & other_known & (codes == mapped)
+        if op == '!=':
+            return known & other_known & (codes != mapped)
+        raise ValueError("Unsupported comparison of columns " + op)
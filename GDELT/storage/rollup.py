@@ -0,0 +1,354 @@
+"""
+Pre-aggregated monthly rollup cube of events table.
+
+Usage (from main directory of project):
+    python -m GDELT.storage.rollup [--start YYYYMM] [--end YYYYMM] [--source local|bigquery]
+
+Cube keeps mergeable partial states (counts and sums) grouped by
+MonthYear, Actor1Geo_CountryCode, Actor2Geo_CountryCode, EventRootCode and QuadClass,
+one directory of column files per month. Query plans which group and filter
+only by these columns are answered from cube without scanning events.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import operator
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+
+from ..utils.query_plan import AggregateQuery, JoinQuery, Column, tone_impact, mentions_tone, \
+    events_table, event_column_types, months_between, next_month
+from ..utils.result_cache import write_columns, read_columns, decode_categoricals
+from ..utils.watermark import closed_since
+
+meta_file = "meta.json"
+
+cube_dimensions = [
+    'MonthYear',
+    'Actor1Geo_CountryCode',
+    'Actor2Geo_CountryCode',
+    'EventRootCode',
+    'QuadClass',
+]
+
+cube_measures = [
+    ('Events', 'count', None),
+    ('Mentions', 'sum', 'NumMentions'),
+    ('Tone', 'avg', 'AvgTone'),
+    ('Goldstein', 'avg', 'GoldsteinScale'),
+    ('ToneImpact', 'avg', tone_impact),
+    ('MentionsTone', 'avg', mentions_tone),
+]
+
+# argument of measure -> (column of sum, column of count of not null values) in cube
+cube_arguments = {
+    'NumMentions': ('Mentions__sum', 'Events__n'),
+    'AvgTone': ('Tone__sum', 'Tone__n'),
+    'GoldsteinScale': ('Goldstein__sum', 'Goldstein__n'),
+    tone_impact: ('ToneImpact__sum', 'ToneImpact__n'),
+    mentions_tone: ('MentionsTone__sum', 'MentionsTone__n'),
+}
+
+comparison_operators = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def cube_query(start, end):
+    """
+    :param start: first month in format YYYYMM
+    :param end: month after last one
+    :return: AggregateQuery of cube partial states for months [start, end)
+    """
+    return AggregateQuery(
+        keys=[(column, column) for column in cube_dimensions],
+        measures=cube_measures,
+        filters=[('MonthYear', '>=', start),
+                 ('MonthYear', '<', end)])
+
+
+def cube_filters(filters):
+    """
+    Rewrites filters of plan into filters on cube dimensions.
+    SQLDATE bounds are accepted only on first days of months
+    :param filters: list of filters of AggregateQuery
+    :return: list of filters or None if some filter needs finer detail than cube has
+    """
+    result = []
+    for column, op, value in filters:
+        if op == 'or':
+            conditions = cube_filters(value)
+            if conditions is None:
+                return None
+            result.append((column, op, conditions))
+            continue
+        if isinstance(value, Column) and value.name not in cube_dimensions:
+            return None
+        if column in cube_dimensions:
+            result.append((column, op, value))
+        elif column == 'SQLDATE' and op in ('>=', '<') and not isinstance(value, Column) \
+                and int(value) % 100 == 1:
+            result.append(('MonthYear', op, int(value) // 100))
+        else:
+            return None
+    return result
+
+
+def cube_states(measures):
+    """
+    :param measures: list of measures of AggregateQuery
+    :return: list of tuples (partial state name, cube column, dimension which must be not null),
+    None if some measure can't be computed from cube
+    """
+    states = []
+    for alias, function, argument in measures:
+        if function == 'count':
+            if argument is None:
+                states.append((alias + '__n', 'Events__n', None))
+            elif argument in cube_dimensions:
+                states.append((alias + '__n', 'Events__n', argument))
+            elif argument in cube_arguments:
+                states.append((alias + '__n', cube_arguments[argument][1], None))
+            else:
+                return None
+        elif function in ('sum', 'avg') and argument in cube_arguments:
+            sum_column, count_column = cube_arguments[argument]
+            states.append((alias + '__sum', sum_column, None))
+            if function == 'avg':
+                states.append((alias + '__n', count_column, None))
+        else:
+            return None
+    return states
+
+
+def frame_filter_mask(df, column, op, value):
+    """
+    Evaluates filter on DataFrame with SQL semantics (comparisons with NULL are false)
+    :return: boolean array
+    """
+    if op == 'or':
+        return np.logical_or.reduce([frame_filter_mask(df, *condition) for condition in value])
+    values = df[column].to_numpy()
+    known = pd.notnull(values)
+    if op == 'is null':
+        return ~known
+    if op == 'is not null':
+        return known
+    if isinstance(value, Column):
+        other_values = df[value.name].to_numpy()
+        known &= pd.notnull(other_values)
+        value = other_values
+    elif op == 'in':
+        value = [str(item) if event_column_types[column] == 'STRING' else int(item) for item in value]
+        return known & np.isin(values, value)
+    elif event_column_types[column] == 'STRING':
+        value = str(value)
+    else:
+        value = int(value)
+    mask = np.zeros(values.shape[0], dtype=bool)
+    if isinstance(value, np.ndarray):
+        value = value[known]
+    mask[known] = comparison_operators[op](values[known], value)
+    return mask
+
+
+class RollupCube:
+    """
+    Monthly rollup cube stored in directory: <path>/<MonthYear>/<column files>.
+    Months are replaced atomically, loaded months are kept in memory.
+    Month built before it was closed is used only for open_ttl seconds
+    """
+
+    def __init__(self, path, open_ttl=None):
+        """
+        :param path: directory of cube
+        :param open_ttl: time in seconds during which month built before its end is used,
+        None to use such months until they are rebuilt
+        """
+        self.path = path
+        self.open_ttl = open_ttl
+        self.lock = threading.Lock()
+        self._frames = {}
+
+    def months(self):
+        """
+        :return: sorted list of int months which are present in cube
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(name) for name in os.listdir(self.path)
+                      if name.isdigit() and os.path.exists(os.path.join(self.path, name, meta_file)))
+
+    def is_fresh(self, month, now=None):
+        """
+        :param month: int month in format YYYYMM
+        :param now: unix time, by default current time
+        :return: True if month is present and was built after it was closed
+        or not earlier than open_ttl seconds ago
+        """
+        try:
+            with open(os.path.join(self.path, str(month), meta_file), 'r') as source:
+                built = json.load(source)['built']
+        except (IOError, OSError, ValueError):
+            return False
+        now = time.time() if now is None else now
+        return built >= closed_since(month) or self.open_ttl is None or now - built < self.open_ttl
+
+    def covers(self, start, end):
+        if start is None or end is None:
+            return False
+        return all(self.is_fresh(month) for month in months_between(start, end))
+
+    def write_month(self, month, partial):
+        """
+        Writes (or replaces) partial states of one month
+        :param month: int month in format YYYYMM
+        :param partial: DataFrame with cube dimensions and partial states of cube_query
+        :return: nothing
+        """
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, '.tmp-{}-{}'.format(month, uuid.uuid4().hex))
+        os.makedirs(tmp_path)
+        columns = write_columns(tmp_path, partial.reset_index(drop=True))
+        with open(os.path.join(tmp_path, meta_file), 'w') as target:
+            json.dump({'month': month, 'built': time.time(), 'columns': columns}, target)
+        month_path = os.path.join(self.path, str(month))
+        old_path = None
+        if os.path.exists(month_path):
+            old_path = os.path.join(self.path, '.old-{}-{}'.format(month, uuid.uuid4().hex))
+            os.rename(month_path, old_path)
+        os.rename(tmp_path, month_path)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    def month_frame(self, month):
+        """
+        :param month: int month in format YYYYMM
+        :return: DataFrame with partial states of month
+        """
+        month_path = os.path.join(self.path, str(month))
+        with open(os.path.join(month_path, meta_file), 'r') as source:
+            meta = json.load(source)
+        with self.lock:
+            cached = self._frames.get(month)
+            if cached is not None and cached[0] == meta['built']:
+                return cached[1]
+        # frames are kept decoded, they are filtered and grouped by many plans
+        df = decode_categoricals(read_columns(month_path, meta['columns']))
+        with self.lock:
+            self._frames[month] = (meta['built'], df)
+        return df
+
+    def can_answer(self, plan):
+        """
+        :param plan: QueryPlan
+        :return: True if plan can be computed from cube
+        """
+        if isinstance(plan, JoinQuery):
+            return self.can_answer(plan.left) and self.can_answer(plan.right)
+        if not isinstance(plan, AggregateQuery) or plan.table != events_table:
+            return False
+        if not all(column in cube_dimensions for _, column in plan.keys):
+            return False
+        if cube_filters(plan.filters) is None or cube_states(plan.measures) is None:
+            return False
+        return self.covers(*plan.month_bounds())
+
+    def execute(self, plan):
+        """
+        :param plan: AggregateQuery or JoinQuery accepted by can_answer
+        :return: DataFrame with the same columns as result of plan.to_sql() in BigQuery
+        """
+        if isinstance(plan, JoinQuery):
+            return plan.join(self.execute(plan.left), self.execute(plan.right))
+        return plan.finalize(self.execute_partial(plan))
+
+    def execute_partial(self, plan):
+        """
+        :param plan: AggregateQuery accepted by can_answer
+        :return: DataFrame with key columns and partial states of plan
+        """
+        frames = [self.month_frame(month) for month in months_between(*plan.month_bounds())]
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        mask = np.ones(df.shape[0], dtype=bool)
+        for column, op, value in cube_filters(plan.filters):
+            mask &= frame_filter_mask(df, column, op, value)
+        df = df[mask]
+        keys = [alias for alias, _ in plan.keys]
+        data = {alias: df[column].to_numpy() for alias, column in plan.keys}
+        for name, column, not_null in cube_states(plan.measures):
+            values = df[column].to_numpy()
+            if not_null is not None:
+                values = np.where(pd.notnull(df[not_null].to_numpy()), values, 0)
+            data[name] = values
+        partial = pd.DataFrame(data, columns=keys + [name for name, _, _ in cube_states(plan.measures)])
+        if not keys:
+            return partial.sum().to_frame().T
+        return partial.groupby(keys, sort=False, dropna=False).sum().reset_index()
+
+
+def build_from_store(cube, engine, months):
+    """
+    Builds cube months from local event store
+    :param cube: RollupCube
+    :param engine: LocalEngine
+    :param months: list of int months
+    :return: nothing
+    """
+    for month in months:
+        plan = cube_query(month, next_month(month))
+        cube.write_month(month, engine.execute_partial(plan))
+        print("Rollup of {} is built".format(month))
+
+
+def build_from_bigquery(cube, executor, start, end):
+    """
+    Builds cube months with one BigQuery query
+    :param cube: RollupCube
+    :param executor: QueryExecutor
+    :param start: first month in format YYYYMM
+    :param end: month after last one
+    :return: nothing
+    """
+    plan = cube_query(start, end)
+    partial = executor.get_result_dataframe(plan.to_partial_sql(), use_cache=False)
+    for month, month_df in partial.groupby('MonthYear'):
+        cube.write_month(int(month), month_df)
+        print("Rollup of {} is built".format(month))
+
+
+def main(argv=None):
+    from ..utils.utils import QueryExecutor, rollup_path
+    parser = argparse.ArgumentParser(description="Build monthly rollup cube of events")
+    parser.add_argument('--start', type=int, default=None, help="first month YYYYMM")
+    parser.add_argument('--end', type=int, default=None, help="month after last one YYYYMM")
+    parser.add_argument('--source', choices=['local', 'bigquery'], default='local',
+                        help="build from local event store or BigQuery")
+    args = parser.parse_args(argv)
+    executor = QueryExecutor()
+    cube = RollupCube(rollup_path)
+    if args.source == 'local':
+        months = executor.local_engine.store.months()
+        if args.start is not None:
+            months = [month for month in months if month >= args.start]
+        if args.end is not None:
+            months = [month for month in months if month < args.end]
+        build_from_store(cube, executor.local_engine, months)
+    else:
+        if args.start is None or args.end is None:
+            parser.error("--start and --end are required for BigQuery source")
+        build_from_bigquery(cube, executor, args.start, args.end)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,240 @@
+"""
+Generator of synthetic GDELT events for benchmarks and tests without real data.
+
+Usage (from main directory of project):
+    python -m GDELT.storage.synthetic --rows 1000000 [--store PATH] [--rollup PATH]
+        [--start YYYYMM] [--end YYYYMM] [--seed N]
+
+By default events are written into synthetic_store_path and synthetic_rollup_path
+(see GDELT/storage/config.py), never into local event store and rollup cube of real events.
+
+Events imitate distributions of GDELT: few countries take most of events
+(Zipf distribution with the largest countries first), event locations are
+concentrated around few hotspots of each country with heavy-tailed spread,
+number of events grows over time with yearly seasonality and fewer events
+on weekends, mentions are heavy-tailed and tone and Goldstein scale depend
+on event type. Events are written into event store as one fragment per month
+and rollup cube is built from them, so functions can run over them locally.
+Data is deterministic for given number of rows, months and seed.
+"""
+import sys
+import argparse
+import calendar
+import numpy as np
+
+from .event_store import EventStore
+from .local_engine import LocalEngine
+from .rollup import RollupCube, build_from_store
+from ..utils.query_plan import months_between
+from .config import synthetic_store_path, synthetic_rollup_path
+from ..utils.utils import Utils
+
+# countries with the most events in GDELT, the rest follows in order of resources.
+# Head countries are listed in the same order by FIPS and CAMEO codes
+head_fips_countries = ['US', 'UK', 'IS', 'RS', 'CH', 'IN', 'AS', 'PK', 'NI', 'IZ', 'FR', 'SY', 'PL']
+head_cameo_countries = ['USA', 'GBR', 'ISR', 'RUS', 'CHN', 'IND', 'AUS', 'PAK', 'NGA', 'IRQ', 'FRA',
+                        'SYR', 'POL']
+# exponent of Zipf distribution of events over countries
+country_skew = 1.1
+# fractions of events without actor countries
+actor1_null_fraction = 0.1
+actor2_null_fraction = 0.3
+# fraction of events located in country of first actor
+action_in_actor1_fraction = 0.7
+# event root codes with their weights and mean Goldstein scale
+root_codes = [
+    ('01', 12, 0.0), ('02', 5, 3.0), ('03', 8, 4.0), ('04', 14, 1.0), ('05', 6, 3.5),
+    ('06', 2, 6.0), ('07', 2, 7.0), ('08', 2, 5.0), ('09', 1, -2.0), ('10', 1, -5.0),
+    ('11', 4, -2.0), ('12', 2, -4.0), ('13', 2, -6.0), ('14', 1.5, -6.5), ('15', 0.5, -7.2),
+    ('16', 1, -4.0), ('17', 3, -5.0), ('18', 3, -9.0), ('19', 4, -10.0), ('20', 0.2, -10.0),
+]
+# location hotspots of each country and spread of events around them in degrees
+hotspots = 6
+hotspot_spread = 4.
+event_spread = 0.3
+# growth of number of events per month over the whole range and amplitude of yearly seasonality
+growth = 3.
+seasonality = 0.2
+weekend_weight = 0.7
+
+
+def zipf_weights(count, skew=country_skew):
+    weights = 1. / np.arange(1, count + 1) ** skew
+    return weights / weights.sum()
+
+
+def ordered_codes(codes, head):
+    """
+    :return: array of codes with codes of head first, in order of head
+    """
+    codes = [code for code in codes if isinstance(code, str)]
+    return np.array([code for code in head if code in codes] +
+                     [code for code in codes if code not in head], dtype=object)
+
+
+def month_rows(rows, months):
+    """
+    :param rows: total number of rows
+    :param months: list of int months
+    :return: array of number of rows of each month with trend and seasonality, summing to rows
+    """
+    position = np.linspace(0, 1, len(months))
+    weights = (1 + (growth - 1) * position) * \
+        (1 + seasonality * np.sin(2 * np.pi * (np.array(months) % 100 - 1) / 12))
+    counts = np.floor(rows * weights / weights.sum()).astype(np.int64)
+    counts[np.argsort(-weights)[:rows - counts.sum()]] += 1
+    return counts
+
+
+class EventGenerator:
+    """
+    Generates columns of events table with realistic distributions
+    """
+
+    def __init__(self, seed=0):
+        utils = Utils()
+        self.seed = seed
+        self.fips = ordered_codes(utils.get_fips_country_id_to_name_mapping().index, head_fips_countries)
+        self.cameo = ordered_codes(utils.get_cameo_country_id_to_name_mapping().index, head_cameo_countries)
+        self.types = np.array([code for code in utils.get_cameo_type_id_to_name_mapping().index
+                               if isinstance(code, str)], dtype=object)
+        rng = np.random.default_rng(seed)
+        self.fips_weights = zipf_weights(len(self.fips))
+        # CAMEO code of actor of head country is its own code, other actors get CAMEO codes
+        # outside of head by their own Zipf distribution, continuing ranks of head
+        cameo_index = {code: i for i, code in enumerate(self.cameo)}
+        self.fips_cameo = np.full(len(self.fips), -1)
+        for fips_code, cameo_code in zip(head_fips_countries, head_cameo_countries):
+            if fips_code in self.fips and cameo_code in cameo_index:
+                self.fips_cameo[list(self.fips).index(fips_code)] = cameo_index[cameo_code]
+        self.cameo_tail = np.setdiff1d(np.arange(len(self.cameo)), self.fips_cameo[self.fips_cameo >= 0])
+        self.cameo_tail_weights = zipf_weights(len(self.cameo))[self.cameo_tail]
+        self.cameo_tail_weights /= self.cameo_tail_weights.sum()
+        self.type_weights = zipf_weights(len(self.types), 1.)
+        # hotspots of each country around its random center, larger hotspots first
+        centers = np.column_stack([rng.uniform(-50, 65, len(self.fips)), rng.uniform(-170, 175, len(self.fips))])
+        self.hotspots = centers[:, None, :] + rng.normal(0, hotspot_spread, (len(self.fips), hotspots, 2))
+        self.hotspot_weights = zipf_weights(hotspots, 1.5)
+        self.root_codes = np.array([code for code, _, _ in root_codes], dtype=object)
+        self.root_weights = np.array([weight for _, weight, _ in root_codes], dtype=np.float64)
+        self.root_weights /= self.root_weights.sum()
+        self.goldstein = np.array([goldstein for _, _, goldstein in root_codes])
+
+    def _countries(self, rng, rows, null_fraction):
+        """
+        :return: tuple (array of indexes of FIPS countries, -1 for NULL, mask of known countries)
+        """
+        countries = rng.choice(len(self.fips), rows, p=self.fips_weights)
+        known = rng.random(rows) >= null_fraction
+        return np.where(known, countries, -1), known
+
+    def _cameo_countries(self, rng, countries, known):
+        """
+        :param countries: array of indexes of FIPS countries of actors
+        :param known: mask of actors with known country
+        :return: array of indexes of CAMEO countries of actors, -1 for NULL
+        """
+        tail = self.cameo_tail[rng.choice(len(self.cameo_tail), len(countries), p=self.cameo_tail_weights)]
+        cameo = np.where(self.fips_cameo[np.maximum(countries, 0)] >= 0,
+                         self.fips_cameo[np.maximum(countries, 0)], tail)
+        return np.where(known, cameo, -1)
+
+    def _codes(self, codes, indexes):
+        values = codes[np.maximum(indexes, 0)].astype(object)
+        values[indexes < 0] = None
+        return values
+
+    def _days(self, rng, month, rows):
+        year, month_no = divmod(month, 100)
+        days = np.arange(1, calendar.monthrange(year, month_no)[1] + 1)
+        weights = np.array([weekend_weight if calendar.weekday(year, month_no, day) >= 5 else 1.
+                            for day in days])
+        return month * 100 + rng.choice(days, rows, p=weights / weights.sum())
+
+    def month_columns(self, month, rows):
+        """
+        :param month: int month YYYYMM
+        :param rows: number of events
+        :return: dictionary column name -> array of values with all columns of store_columns
+        """
+        rng = np.random.default_rng([self.seed, month])
+        actor1, known1 = self._countries(rng, rows, actor1_null_fraction)
+        actor2, known2 = self._countries(rng, rows, actor2_null_fraction)
+        other, _ = self._countries(rng, rows, 0.)
+        action = np.where(known1 & (rng.random(rows) < action_in_actor1_fraction), actor1, other)
+
+        hotspot = rng.choice(hotspots, rows, p=self.hotspot_weights)
+        location = self.hotspots[action, hotspot] + rng.standard_t(2, (rows, 2)) * event_spread
+        latitude = np.clip(location[:, 0], -90, 90)
+        longitude = (location[:, 1] + 180) % 360 - 180
+
+        # actors of head countries keep their country, the rest are spread over other CAMEO codes
+        cameo1 = self._cameo_countries(rng, actor1, known1)
+        cameo2 = self._cameo_countries(rng, actor2, known2)
+        type1 = np.where(rng.random(rows) < 0.6, -1, rng.choice(len(self.types), rows, p=self.type_weights))
+        type2 = np.where(rng.random(rows) < 0.7, -1, rng.choice(len(self.types), rows, p=self.type_weights))
+
+        root = rng.choice(len(self.root_codes), rows, p=self.root_weights)
+        quad_class = np.select([root < 5, root < 8, root < 13], [1, 2, 3], 4)
+        goldstein = np.clip(self.goldstein[root] + rng.normal(0, 1, rows), -10, 10)
+        tone = np.clip(rng.normal(-1.5 + 0.4 * self.goldstein[root], 3, rows), -30, 30)
+        mentions = np.minimum(1 + rng.pareto(1.5, rows) * 2, 10000).astype(np.int32)
+
+        return {
+            'SQLDATE': self._days(rng, month, rows),
+            'MonthYear': np.full(rows, month),
+            'Actor1CountryCode': self._codes(self.cameo, cameo1),
+            'Actor2CountryCode': self._codes(self.cameo, cameo2),
+            'Actor1Type1Code': self._codes(self.types, type1),
+            'Actor2Type1Code': self._codes(self.types, type2),
+            'EventRootCode': self.root_codes[root],
+            'QuadClass': quad_class,
+            'GoldsteinScale': goldstein,
+            'NumMentions': mentions,
+            'AvgTone': tone,
+            'Actor1Geo_CountryCode': self._codes(self.fips, actor1),
+            'Actor2Geo_CountryCode': self._codes(self.fips, actor2),
+            'ActionGeo_CountryCode': self.fips[action],
+            'ActionGeo_Lat': latitude,
+            'ActionGeo_Long': longitude,
+        }
+
+
+def generate(rows, start=201301, end=202001, seed=0, store_path=synthetic_store_path, rollup=synthetic_rollup_path):
+    """
+    Writes synthetic events into event store, replacing synthetic fragments written before
+    :param rows: total number of events
+    :param start: first month YYYYMM
+    :param end: month after last one
+    :param seed: seed of random generator
+    :param store_path: path of event store
+    :param rollup: path of rollup cube to build, None to skip it
+    :return: EventStore
+    """
+    store = EventStore(store_path)
+    generator = EventGenerator(seed)
+    months = months_between(start, end)
+    for month, count in zip(months, month_rows(rows, months)):
+        if count == 0:
+            continue
+        store.write_fragment(month, 'synthetic', generator.month_columns(month, int(count)))
+    print("Generated {} events in {} months".format(rows, len(months)))
+    if rollup is not None:
+        build_from_store(RollupCube(rollup), LocalEngine(store), store.months())
+    return store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic GDELT events")
+    parser.add_argument('--rows', type=int, required=True, help="number of events")
+    parser.add_argument('--start', type=int, default=201301, help="first month YYYYMM")
+    parser.add_argument('--end', type=int, default=202001, help="month after last one YYYYMM")
+    parser.add_argument('--seed', type=int, default=0, help="seed of random generator")
+    parser.add_argument('--store', default=synthetic_store_path, help="path of event store")
+    parser.add_argument('--rollup', default=synthetic_rollup_path, help="path of rollup cube")
+    args = parser.parse_args(argv)
+    generate(args.rows, args.start, args.end, args.seed, args.store, args.rollup)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -19,7 +19,8 @@ from django.conf.urls.static import static
 from .settings import settings
 from .views.main_view import main_index
 from .views.parameters_views import parameters_index
-from .views.function_views import make_plot_request, loading_page, wait_for_plot, draw_plot
+from .views.function_views import make_plot_request, loading_page, wait_for_plot, draw_plot, query_usage, \
+    release_job
 
 
 
@@ -30,7 +31,9 @@ urlpatterns = [
     path('plot_request/<function>', make_plot_request, name='index'),
     path('loading/<function>/<job_uuid>', loading_page, name='index'),
     path('wait_for_plot/', wait_for_plot, name='index'),
+    path('release_job/', release_job, name='index'),
     path('plot/<function>/<job_uuid>', draw_plot, name='index'),
+    path('usage/', query_usage, name='index'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
 
@@ -0,0 +1,347 @@
+"""
+Benchmark of functions over synthetic events of growing size.
+
+Usage (from main directory of project):
+    python -m GDELT.utils.benchmark [--sizes 1000 10000 ...] [--functions NAME ...] [--repeat N]
+        [--baseline PATH] [--save-baseline] [--tolerance X] [--no-memory]
+
+Synthetic events (see GDELT.storage.synthetic) of each size are generated once
+into benchmark_data_path with their rollup cube. Every function of FunctionUtil.function_dict
+draws its plot with default parameters over local store (result cache is disabled,
+so every run executes its queries). Time is split into steps:
+query - materialization of query results (QueryExecutor result methods),
+render - conversion of figures into html (plotly, folium and mapbox calls),
+transform - the rest of get_plot. Peak memory of Python allocations
+is measured by separate run with tracemalloc, as tracing slows the code down.
+
+Results are compared with stored baseline, steps which got slower or took more memory
+than baseline by more than tolerance are reported as regressions (exit status is 1).
+--save-baseline stores results as new baseline. Without stored baseline nothing can be
+compared, so benchmark fails at once (exit status is 2) instead of passing silently.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import importlib
+import threading
+import tracemalloc
+import numpy as np
+
+from . import utils
+
+benchmark_data_path = "GDELT/cache/benchmark"
+benchmark_baseline_path = "GDELT/resources/benchmark_baseline.json"
+default_sizes = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+# months of synthetic events, they contain default time ranges of all functions
+synthetic_range = (201301, 202001)
+# differences smaller than these aren't regressions
+min_regression_seconds = 0.05
+min_regression_bytes = 1024 ** 2
+
+steps = ['query', 'transform', 'render', 'total']
+
+# methods of QueryExecutor which materialize query results
+query_methods = ['get_result_dataframe', 'fetch_all', 'get_result_chunks', 'iter_result_chunks']
+# (module, attribute path) of calls which convert figures into html, besides
+# plot functions of plotly imported by function modules
+render_calls = [
+    ('folium', 'Map.render'),
+    ('folium', 'Map._repr_html_'),
+    ('mapboxgl.viz', 'HeatmapViz.create_html'),
+    ('mapboxgl.viz', 'HeatmapViz.as_iframe'),
+]
+
+
+class StepTimer:
+    """
+    Wall time of calls of wrapped functions by step, nested and concurrent calls are counted once
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.intervals = {}
+        self.patches = []
+
+    def _add(self, step, start, end):
+        with self.lock:
+            self.intervals.setdefault(step, []).append((start, end))
+
+    def wrap(self, step, function):
+        timer = self
+        name = getattr(function, '__name__', None)
+        if name == 'iter_result_chunks':
+            def wrapper(*args, **kwargs):
+                iterator = function(*args, **kwargs)
+                while True:
+                    start = time.time()
+                    try:
+                        value = next(iterator)
+                    except StopIteration:
+                        timer._add(step, start, time.time())
+                        return
+                    timer._add(step, start, time.time())
+                    yield value
+        else:
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    timer._add(step, start, time.time())
+        wrapper.__name__ = name or wrapper.__name__
+        return wrapper
+
+    def patch(self, owner, name, step):
+        """
+        Replaces attribute of module or class by timed wrapper until restore is called
+        """
+        own = name in vars(owner)
+        self.patches.append((owner, name, vars(owner)[name] if own else None))
+        setattr(owner, name, self.wrap(step, getattr(owner, name)))
+
+    def restore(self):
+        for owner, name, original in reversed(self.patches):
+            if original is None:
+                # inherited method
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self.patches = []
+
+    def reset(self):
+        with self.lock:
+            self.intervals = {}
+
+    def seconds(self, *step_names):
+        """
+        :return: length of union of intervals of steps
+        """
+        with self.lock:
+            intervals = sorted(interval for step in step_names for interval in self.intervals.get(step, []))
+        total = 0.
+        end = None
+        for start, stop in intervals:
+            if end is None or start > end:
+                total += stop - start
+                end = stop
+            elif stop > end:
+                total += stop - end
+                end = stop
+        return total
+
+
+def instrument(timer, function_util):
+    """
+    Wraps query and render calls used by functions
+    :param timer: StepTimer
+    :param function_util: FunctionUtil
+    :return: nothing
+    """
+    for name in query_methods:
+        timer.patch(utils.QueryExecutor, name, 'query')
+    modules = {sys.modules[type(function).__module__] for function in function_util.function_dict.values()}
+    for module in modules:
+        if callable(getattr(module, 'plot', None)):
+            timer.patch(module, 'plot', 'render')
+    for module_name, path in render_calls:
+        *owners, name = path.split('.')
+        try:
+            owner = importlib.import_module(module_name)
+            for owner_name in owners:
+                owner = getattr(owner, owner_name)
+            getattr(owner, name)
+        except (ImportError, AttributeError):
+            # library isn't installed or has different version
+            continue
+        timer.patch(owner, name, 'render')
+
+
+def prepare_data(rows, seed=0):
+    """
+    Generates synthetic events of size once and points QueryExecutor to them
+    :param rows: number of events
+    :param seed: seed of generator
+    :return: nothing
+    """
+    from ..storage.synthetic import generate
+    path = os.path.join(benchmark_data_path, '{}-{}'.format(rows, seed))
+    store_path = os.path.join(path, 'events')
+    rollup = os.path.join(path, 'rollup')
+    if not os.path.exists(os.path.join(path, 'done')):
+        generate(rows, synthetic_range[0], synthetic_range[1], seed, store_path, rollup)
+        with open(os.path.join(path, 'done'), 'w'):
+            pass
+    utils.local_store_path = store_path
+    utils.rollup_path = rollup
+    utils.result_cache_path = None
+    utils.query_backend = 'local'
+    utils.query_client = 'local'
+    utils.batch_window = None
+    # executor is created again for new store
+    utils.Singleton._instances.pop(utils.QueryExecutor, None)
+
+
+def default_parameters(function_util, function_name):
+    """
+    :return: dictionary parameter name -> parameter instance with default values of function
+    """
+    defaults = function_util.get_function_by_name(function_name).get_default_parameters()
+    return function_util.make_parameters(function_name, {
+        names[0]: param.get_value_from_default(defaults[names[0]])
+        for param, names in function_util.get_parameters(function_name)})
+
+
+def measure(timer, function, parameters, repeat):
+    """
+    :return: dictionary step -> median seconds of repeat runs of get_plot
+    """
+    runs = []
+    for _ in range(repeat):
+        timer.reset()
+        start = time.time()
+        function.get_plot(parameters)
+        total = time.time() - start
+        query = timer.seconds('query')
+        render = timer.seconds('render')
+        transform = max(0., total - timer.seconds('query', 'render'))
+        runs.append({'query': query, 'transform': transform, 'render': render, 'total': total})
+    return {step: float(np.median([run[step] for run in runs])) for step in steps}
+
+
+def peak_memory(function, parameters):
+    """
+    :return: peak bytes of Python allocations during get_plot
+    """
+    tracemalloc.start()
+    try:
+        function.get_plot(parameters)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(sizes, function_names=None, repeat=3, memory=True, seed=0):
+    """
+    :param sizes: list of numbers of synthetic events
+    :param function_names: list of function names, None for all functions
+    :param repeat: number of timed runs of each function, median is reported
+    :param memory: measure peak memory
+    :param seed: seed of synthetic data
+    :return: dictionary size -> function name -> dictionary step -> seconds and "peak_bytes",
+    or "error" with description if function failed
+    """
+    from ..functions.function_utils import FunctionUtil
+    function_util = FunctionUtil()
+    timer = StepTimer()
+    instrument(timer, function_util)
+    results = {}
+    try:
+        for rows in sizes:
+            prepare_data(rows, seed)
+            size_results = results[str(rows)] = {}
+            for name in function_names or list(function_util.function_dict):
+                function = function_util.get_function_by_name(name)
+                qe = utils.QueryExecutor()
+                qe.set_current_function(name)
+                try:
+                    parameters = default_parameters(function_util, name)
+                    # first run warms up code dictionaries, indexes and file cache
+                    function.get_plot(parameters)
+                    result = measure(timer, function, parameters, repeat)
+                    if memory:
+                        result['peak_bytes'] = peak_memory(function, parameters)
+                except Exception as e:
+                    result = {'error': repr(e)}
+                finally:
+                    qe.set_current_function(None)
+                size_results[name] = result
+                print_result(rows, name, result)
+    finally:
+        timer.restore()
+    return results
+
+
+def print_result(rows, name, result):
+    if 'error' in result:
+        print("{:>9} {:<28} error: {}".format(rows, name, result['error']))
+        return
+    print("{:>9} {:<28} query {:8.3f} s  transform {:8.3f} s  render {:8.3f} s  total {:8.3f} s{}".format(
+        rows, name, result['query'], result['transform'], result['render'], result['total'],
+        "  peak {:8.1f} MB".format(result['peak_bytes'] / 1024 ** 2) if 'peak_bytes' in result else ""))
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: result of run_benchmarks
+    :param baseline: stored results of run_benchmarks
+    :param tolerance: allowed relative growth of time and memory
+    :return: list of descriptions of regressions
+    """
+    regressions = []
+    for rows, size_results in results.items():
+        for name, result in size_results.items():
+            base = baseline.get(rows, {}).get(name)
+            if base is None or 'error' in base:
+                continue
+            if 'error' in result:
+                regressions.append("{} {}: fails with {}".format(rows, name, result['error']))
+                continue
+            for step in steps:
+                if result[step] > base[step] * (1 + tolerance) and \
+                        result[step] - base[step] > min_regression_seconds:
+                    regressions.append("{} {}: {} {:.3f} s, baseline {:.3f} s".format(
+                        rows, name, step, result[step], base[step]))
+            if 'peak_bytes' in result and 'peak_bytes' in base and \
+                    result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance) and \
+                    result['peak_bytes'] - base['peak_bytes'] > min_regression_bytes:
+                regressions.append("{} {}: peak memory {:.1f} MB, baseline {:.1f} MB".format(
+                    rows, name, result['peak_bytes'] / 1024 ** 2, base['peak_bytes'] / 1024 ** 2))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of functions over synthetic events")
+    parser.add_argument('--sizes', type=int, nargs='*', default=default_sizes, help="numbers of events")
+    parser.add_argument('--functions', nargs='*', default=None, help="names of benchmarked functions")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed runs of each function")
+    parser.add_argument('--seed', type=int, default=0, help="seed of synthetic data")
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory")
+    parser.add_argument('--baseline', default=benchmark_baseline_path, help="file of baseline results")
+    parser.add_argument('--save-baseline', action='store_true', help="store results as baseline")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="allowed relative growth of time and memory over baseline")
+    args = parser.parse_args(argv)
+
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        print("ERROR: no baseline at {}, nothing to compare with. Run with --save-baseline "
+              "on reference machine to store one".format(args.baseline), file=sys.stderr)
+        return 2
+    results = run_benchmarks(args.sizes, args.functions, args.repeat, not args.no_memory, args.seed)
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as source:
+                baseline = json.load(source).get('results', {})
+        for rows, size_results in results.items():
+            baseline.setdefault(rows, {}).update(size_results)
+        with open(args.baseline, 'w') as target:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'results': baseline}, target, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(args.baseline))
+        return 0
+    with open(args.baseline) as source:
+        stored = json.load(source)
+    if stored.get('machine') != platform.platform():
+        print("Baseline was measured on {}, times may differ".format(stored.get('machine')))
+    regressions = compare(results, stored['results'], args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    print("{} regressions".format(len(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
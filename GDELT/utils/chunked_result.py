@@ -0,0 +1,342 @@
+"""
+Query results which don't have to fit into memory.
+Result is collected from chunks of column arrays. While its size is below memory cap
+chunks are kept in memory, after that all columns are spilled to files in format
+of result cache entries (raw numeric arrays, string columns as int32 codes and dictionary),
+so spilled result is read memory-mapped and can be moved into cache without copying.
+"""
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from .columnar import rechunk_columns, columns_to_dataframe, concat_columns
+from .result_cache import open_column, decode_column
+from .code_dictionary import global_dictionary, is_code_dtype, code_dtype
+
+
+def array_bytes(array):
+    """
+    :param array: numpy array
+    :return: approximate memory used by array including python objects of object array
+    """
+    if array.dtype != np.dtype(object):
+        return array.nbytes
+    return array.nbytes + sum(sys.getsizeof(value) for value in array if value is not None)
+
+
+class ChunkedResult:
+    """
+    Result of query collected by chunks, with memory bounded by max_bytes.
+    Should be closed after use to remove spilled files
+    """
+
+    def __init__(self, column_dtypes, max_bytes=None, spill_path=None):
+        """
+        :param column_dtypes: list of tuples (column name, numpy dtype)
+        :param max_bytes: size of chunks kept in memory after which result is spilled to files,
+        None to keep everything in memory
+        :param spill_path: directory for spilled results, by default system temporary directory
+        """
+        self.column_dtypes = column_dtypes
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.rows = 0
+        self.chunks = []
+        self.memory_bytes = 0
+        # files of spilled result
+        self.directory = None
+        self.columns = None
+        self.owned = True
+        self._dictionaries = None
+        self._opened = None
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """
+        :param df: DataFrame with complete result,
+        Categorical columns are kept as codes of global code dictionary
+        :return: finished ChunkedResult kept in memory
+        """
+        column_dtypes = []
+        columns = []
+        for name in df.columns:
+            if isinstance(df[name].dtype, pd.CategoricalDtype):
+                column_dtypes.append((name, code_dtype))
+                columns.append(global_dictionary.codes(df[name]))
+            else:
+                column_dtypes.append((name, df[name].dtype))
+                columns.append(df[name].to_numpy())
+        result = cls(column_dtypes)
+        result.append(columns)
+        result.finish()
+        return result
+
+    @classmethod
+    def from_directory(cls, path, columns):
+        """
+        Opens result stored in directory (i.e. cache entry), directory isn't removed on close
+        :param path: directory with column files
+        :param columns: list of column descriptions
+        :return: finished ChunkedResult
+        """
+        result = cls([(column['name'], object) for column in columns])
+        result.directory = path
+        result.columns = columns
+        result.owned = False
+        result._opened = [open_column(path, column) for column in columns]
+        result.rows = result._opened[0][0].shape[0] if columns else 0
+        return result
+
+    @property
+    def names(self):
+        return [name for name, _ in self.column_dtypes]
+
+    @property
+    def spilled(self):
+        return self.directory is not None
+
+    def append(self, columns):
+        """
+        :param columns: list of column arrays of the same length, in order of column_dtypes
+        :return: nothing
+        """
+        self.rows += columns[0].shape[0]
+        if self.spilled:
+            self._write_chunk(columns)
+            return
+        self.chunks.append(columns)
+        self.memory_bytes += sum(array_bytes(column) for column in columns)
+        if self.max_bytes is not None and self.memory_bytes > self.max_bytes:
+            self._spill()
+
+    def _spill(self):
+        if self.spill_path is not None:
+            os.makedirs(self.spill_path, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='tmp-spill-', dir=self.spill_path)
+        self.columns = []
+        self._dictionaries = []
+        for i, (name, _) in enumerate(self.column_dtypes):
+            self.columns.append({'name': name, 'file': '{}.bin'.format(i), 'kind': None, 'rows': 0})
+            self._dictionaries.append({})
+        chunks, self.chunks, self.memory_bytes = self.chunks, [], 0
+        for columns in chunks:
+            self._write_chunk(columns)
+
+    def _write_chunk(self, columns):
+        for i, values in enumerate(columns):
+            column = self.columns[i]
+            if column['kind'] is None:
+                if values.dtype != np.dtype(object):
+                    column.update(kind='array', dtype=values.dtype.str)
+                else:
+                    column.update(kind='strings', dtype=np.dtype(np.int32).str,
+                                  values_file='{}.values.npy'.format(i))
+            if column['kind'] == 'array':
+                dtype = np.result_type(np.dtype(column['dtype']), values.dtype)
+                if values.dtype == np.dtype(object):
+                    self._to_pickled(i)
+                elif dtype != np.dtype(column['dtype']):
+                    self._convert_column(i, dtype)
+            elif column['kind'] == 'strings' and \
+                    not all(isinstance(value, str) for value in values if value is not None):
+                self._to_pickled(i)
+            self._append_values(i, values)
+
+    def _append_values(self, i, values):
+        column = self.columns[i]
+        file_path = os.path.join(self.directory, column['file'])
+        if column['kind'] == 'pickled':
+            with open(file_path, 'ab') as target:
+                pickle.dump(np.asarray(values, dtype=object), target)
+            column['chunks'] += 1
+        elif column['kind'] == 'strings':
+            dictionary = self._dictionaries[i]
+            codes = np.fromiter((-1 if value is None else dictionary.setdefault(value, len(dictionary))
+                                 for value in values), dtype=np.int32, count=values.shape[0])
+            with open(file_path, 'ab') as target:
+                target.write(codes.tobytes())
+        else:
+            with open(file_path, 'ab') as target:
+                target.write(np.ascontiguousarray(values, dtype=column['dtype']).tobytes())
+        column['rows'] += values.shape[0]
+
+    def _dictionary_values(self, i):
+        """
+        :return: array of strings of spilled string column ordered by their codes
+        """
+        dictionary = self._dictionaries[i]
+        values = np.empty(len(dictionary), dtype=object)
+        values[list(dictionary.values())] = list(dictionary.keys())
+        return values
+
+    def _column_blocks(self, column, dictionary, block_rows=1000000):
+        """
+        :return: generator of decoded arrays of spilled column
+        """
+        if column['rows'] == 0:
+            return
+        values = np.memmap(os.path.join(self.directory, column['file']),
+                           dtype=column['dtype'], mode='r', shape=(column['rows'],))
+        for start in range(0, column['rows'], block_rows):
+            yield decode_column(values, dictionary, start, start + block_rows)
+
+    def _rewrite_column(self, i, kind, dtype=None):
+        """
+        Writes spilled column again with other kind or dtype, block by block
+        """
+        old = self.columns[i]
+        dictionary = self._dictionary_values(i) if old['kind'] == 'strings' else None
+        column = {'name': old['name'], 'file': old['file'] + '.new', 'kind': kind, 'rows': 0}
+        if kind == 'pickled':
+            column['chunks'] = 0
+        else:
+            column['dtype'] = dtype.str
+        self.columns[i] = column
+        for block in self._column_blocks(old, dictionary):
+            self._append_values(i, block)
+        old_path = os.path.join(self.directory, old['file'])
+        new_path = os.path.join(self.directory, column['file'])
+        if os.path.exists(new_path):
+            os.replace(new_path, old_path)
+        elif os.path.exists(old_path):
+            os.remove(old_path)
+        column['file'] = old['file']
+
+    def _convert_column(self, i, dtype):
+        """
+        Changes dtype of spilled numeric column (i.e. integer column which got NULL values)
+        """
+        self._rewrite_column(i, 'array', dtype)
+
+    def _to_pickled(self, i):
+        """
+        Changes spilled column to sequence of pickled object arrays,
+        used for columns which have values other than numbers and strings
+        """
+        if self.columns[i]['kind'] != 'pickled':
+            self._rewrite_column(i, 'pickled')
+
+    def finish(self):
+        """
+        Marks result as complete, spilled files are opened for reading
+        :return: nothing
+        """
+        if not self.spilled:
+            return
+        for i, column in enumerate(self.columns):
+            if is_code_dtype(self.column_dtypes[i][1]):
+                # codes of global dictionary are stored with its current values,
+                # so files are readable without it (i.e. by result cache)
+                column.update(kind='strings', dtype=column.get('dtype', np.dtype(np.int16).str),
+                              values_file='{}.values.npy'.format(i))
+                file_path = os.path.join(self.directory, column['file'])
+                if not os.path.exists(file_path):
+                    open(file_path, 'wb').close()
+                with global_dictionary.lock:
+                    values = np.array(global_dictionary.values, dtype=str)
+                np.save(os.path.join(self.directory, column['values_file']), values)
+                continue
+            if column['kind'] is None:
+                column.update(kind='array', dtype=np.dtype(self.column_dtypes[i][1]).str)
+                if column['dtype'] == np.dtype(object).str:
+                    column.update(kind='pickled', chunks=0)
+                    column.pop('dtype')
+            file_path = os.path.join(self.directory, column['file'])
+            if not os.path.exists(file_path):
+                open(file_path, 'wb').close()
+            if column['kind'] == 'strings':
+                np.save(os.path.join(self.directory, column['values_file']),
+                        self._dictionary_values(i).astype(str))
+        self._opened = [open_column(self.directory, column) for column in self.columns]
+
+    def _read(self, i, start=None, stop=None):
+        """
+        :return: values of rows [start, stop) of spilled column,
+        columns of code_dtype are returned as codes of global dictionary
+        """
+        values, dictionary = self._opened[i]
+        if is_code_dtype(self.column_dtypes[i][1]):
+            return values[start:stop]
+        return decode_column(values, dictionary, start, stop)
+
+    def iter_columns(self, chunk_rows=None):
+        """
+        :param chunk_rows: number of rows of chunks, by default chunks are returned
+        as they were appended (or by 100000 rows for spilled result)
+        :return: generator of lists of column arrays in order of column_dtypes,
+        columns of code_dtype are returned as codes of global code dictionary
+        """
+        if not self.spilled:
+            chunks = self.chunks if chunk_rows is None else rechunk_columns(self.chunks, chunk_rows)
+            for columns in chunks:
+                yield columns
+            return
+        chunk_rows = chunk_rows or 100000
+        for start in range(0, self.rows, chunk_rows):
+            yield [self._read(i, start, start + chunk_rows) for i in range(len(self.columns))]
+
+    def iter_chunks(self, chunk_rows=None):
+        """
+        :param chunk_rows: number of rows of chunks, the same as in iter_columns
+        :return: generator of DataFrames with parts of result
+        """
+        for columns in self.iter_columns(chunk_rows):
+            yield columns_to_dataframe(columns, self.column_dtypes)
+
+    def column(self, name):
+        """
+        :param name: name of column
+        :return: numpy array with all values of column,
+        numeric columns of spilled result are memory-mapped,
+        columns of code_dtype are returned as codes of global code dictionary
+        """
+        i = self.names.index(name)
+        if self.spilled:
+            return self._read(i)
+        parts = [columns[i] for columns in self.chunks]
+        if not parts:
+            return concat_columns([], [self.column_dtypes[i]])[name]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def to_dataframe(self):
+        """
+        :return: DataFrame with complete result, numeric columns of spilled result are memory-mapped
+        """
+        if self.spilled:
+            return columns_to_dataframe([self._read(i) for i in range(len(self.columns))],
+                                        self.column_dtypes)
+        columns = concat_columns(self.chunks, self.column_dtypes)
+        return columns_to_dataframe([columns[name] for name in self.names], self.column_dtypes)
+
+    def save_to_cache(self, cache, query, ttl=-1):
+        """
+        Stores result in ResultCache, spilled files are moved into cache
+        :param cache: ResultCache
+        :param query: string SQL query
+        :param ttl: time to live, the same as in ResultCache.put
+        :return: nothing
+        """
+        if not self.spilled:
+            cache.put(query, self.to_dataframe(), ttl)
+        elif self.owned and cache.put_directory(query, self.directory, self.columns, ttl):
+            self.owned = False
+
+    def close(self):
+        """
+        Removes spilled files, arrays which are already read stay valid
+        :return: nothing
+        """
+        self.chunks = []
+        if self.spilled and self.owned:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.owned = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
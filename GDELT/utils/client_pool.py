@@ -0,0 +1,36 @@
+import queue
+import threading
+import contextlib
+
+
+class ClientPool:
+    """
+    Bounded pool of query clients. Clients are created on first use
+    and reused by following queries, so their connections stay open.
+    At most size clients are used at the same time, other callers wait
+    """
+
+    def __init__(self, factory, size):
+        """
+        :param factory: function without arguments which creates new client
+        :param size: maximal number of clients used at the same time
+        """
+        self.factory = factory
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def client(self):
+        """
+        Context manager which takes client from pool and returns it back after use
+        """
+        with self.semaphore:
+            try:
+                client = self.idle.get_nowait()
+            except queue.Empty:
+                client = self.factory()
+            try:
+                yield client
+            finally:
+                self.idle.put(client)
@@ -0,0 +1,198 @@
+"""
+Process-wide dictionary of codes of events table (FIPS and CAMEO country codes,
+CAMEO event codes and actor type codes).
+Every code value gets one integer code, so query results can keep code columns
+as pandas Categoricals (int16 codes) sharing the same categories:
+joins, reindexing and name lookups are done with integer arrays.
+Codes are never removed or reordered, values which aren't in resources get new codes.
+"""
+import threading
+import numpy as np
+import pandas as pd
+
+# dtype of query result columns which are decoded into codes of global dictionary
+code_dtype = 'code'
+
+# columns of events table -> domain of names of their values
+column_domains = {
+    'Actor1Geo_CountryCode': 'fips_country',
+    'Actor2Geo_CountryCode': 'fips_country',
+    'ActionGeo_CountryCode': 'fips_country',
+    'Actor1CountryCode': 'cameo_country',
+    'Actor2CountryCode': 'cameo_country',
+    'EventRootCode': 'cameo_eventcode',
+    'EventBaseCode': 'cameo_eventcode',
+    'EventCode': 'cameo_eventcode',
+    'Actor1Type1Code': 'cameo_type',
+    'Actor2Type1Code': 'cameo_type',
+}
+
+
+def is_code_dtype(dtype):
+    return isinstance(dtype, str) and dtype == code_dtype
+
+
+class CodeDictionary:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = []
+        self.index = {}
+        self.domains = {}
+        self._dtype = None
+        self._names = {}
+
+    def load_domain(self, domain, mapping):
+        """
+        Adds codes of domain to dictionary
+        :param domain: name of domain, i.e. "fips_country"
+        :param mapping: pandas Series with names as values and codes as index
+        :return: nothing
+        """
+        self.remap(mapping.index.astype(str))
+        with self.lock:
+            self.domains[domain] = {str(code): name for code, name in mapping.items()}
+            self._names.pop(domain, None)
+
+    @property
+    def code_type(self):
+        return np.int16 if len(self.values) < np.iinfo(np.int16).max else np.int32
+
+    @property
+    def dtype(self):
+        """
+        :return: CategoricalDtype with all values of dictionary as categories
+        """
+        with self.lock:
+            if self._dtype is None or len(self._dtype.categories) != len(self.values):
+                self._dtype = pd.CategoricalDtype(pd.Index(self.values, dtype=object))
+            return self._dtype
+
+    def remap(self, values):
+        """
+        :param values: sequence of distinct strings (i.e. dictionary of column)
+        :return: array of codes of values, new values are added to dictionary
+        """
+        with self.lock:
+            for value in values:
+                if value not in self.index:
+                    self.index[value] = len(self.values)
+                    self.values.append(value)
+            return np.array([self.index[value] for value in values], dtype=self.code_type)
+
+    def encode(self, values):
+        """
+        :param values: array of strings, None or NaN for NULL
+        :return: array of codes, -1 for NULL
+        """
+        local_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        return self.translate(local_codes, uniques)
+
+    def translate(self, local_codes, local_values):
+        """
+        :param local_codes: codes in dictionary of single column, -1 for NULL
+        :param local_values: values of column dictionary
+        :return: array of codes of global dictionary, -1 for NULL
+        """
+        mapping = self.remap([str(value) for value in local_values])
+        local_codes = np.asarray(local_codes)
+        codes = np.full(local_codes.shape[0], -1, dtype=self.code_type)
+        known = local_codes >= 0
+        codes[known] = mapping[local_codes[known]]
+        return codes
+
+    def categorical(self, codes):
+        """
+        :param codes: array of codes of dictionary, -1 for NULL
+        :return: pandas Categorical with categories of dictionary
+        """
+        return pd.Categorical.from_codes(codes, dtype=self.dtype)
+
+    def to_categorical(self, values):
+        """
+        :param values: array or Series of strings or Categorical
+        :return: pandas Categorical with categories of dictionary
+        """
+        if isinstance(values, pd.Series):
+            values = values.array
+        if isinstance(values, pd.Categorical):
+            categories = values.categories
+            with self.lock:
+                shared = categories.equals(pd.Index(self.values[:len(categories)], dtype=object))
+            if shared:
+                # categorical of this dictionary created before it got new values
+                return self.categorical(values.codes)
+            return self.categorical(self.translate(values.codes, categories))
+        return self.categorical(self.encode(values))
+
+    def decode_column(self, values, dictionary):
+        """
+        Decoder of result cache columns (see read_columns)
+        :param values: values or codes of column returned by open_column
+        :param dictionary: strings of column dictionary, None if column isn't dictionary encoded
+        :return: pandas Categorical with categories of dictionary
+        """
+        if dictionary is None:
+            return self.to_categorical(values)
+        return self.categorical(self.translate(values, dictionary))
+
+    def codes(self, values):
+        """
+        :param values: Series or array of values
+        :return: array of codes of dictionary, -1 for NULL
+        """
+        return np.asarray(self.to_categorical(values).codes)
+
+    def sorted_codes(self, codes):
+        """
+        :param codes: array of codes, -1 for NULL
+        :return: array of distinct not NULL codes ordered by their values
+        """
+        codes = np.unique(np.asarray(codes)[np.asarray(codes) >= 0])
+        values = self.dtype.categories.to_numpy()[codes].astype(str)
+        return codes[np.argsort(values, kind='stable')]
+
+    def index_of(self, codes, keys):
+        """
+        Integer replacement of pd.Index(keys).get_indexer(values)
+        :param codes: array of codes, -1 for NULL
+        :param keys: array of distinct codes
+        :return: array of positions of codes in keys, -1 for NULL and codes which aren't in keys
+        """
+        codes = np.asarray(codes)
+        size = len(self.dtype.categories)
+        positions = np.full(size + 1, -1, dtype=np.int64)
+        positions[np.asarray(keys, dtype=np.int64)] = np.arange(len(keys))
+        return positions[np.where(codes >= 0, codes, size)]
+
+    def names(self, domain):
+        """
+        :param domain: name of domain, i.e. "fips_country"
+        :return: object array with name of each code of dictionary, None if code has no name in domain.
+        Names of codes are looked up as names[codes]
+        """
+        with self.lock:
+            cached = self._names.get(domain)
+            if cached is not None and cached.shape[0] == len(self.values):
+                return cached
+            mapping = self.domains.get(domain, {})
+            names = np.empty(len(self.values), dtype=object)
+            names[:] = [mapping.get(value) for value in self.values]
+            self._names[domain] = names
+            return names
+
+    def decode_names(self, values, domain):
+        """
+        :param values: Series or array of codes as strings or Categorical
+        :param domain: name of domain
+        :return: object array of names, None for NULL and codes without name
+        """
+        codes = self.codes(values)
+        names = self.names(domain)
+        result = np.empty(codes.shape[0], dtype=object)
+        known = codes >= 0
+        result[known] = names[codes[known]]
+        return result
+
+
+# dictionary shared by all results of process, domains are loaded by Utils().get_code_dictionary()
+global_dictionary = CodeDictionary()
@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow
+except ImportError:
+    # results are decoded from rows of pages without pyarrow
+    pyarrow = None
+
+from .code_dictionary import global_dictionary, is_code_dtype
+
+# numpy dtypes used for BigQuery standard types
+# INTEGER columns with NULL values fall back to float64 (the same as pandas does)
+bigquery_dtypes = {
+    'INTEGER': np.int64,
+    'INT64': np.int64,
+    'FLOAT': np.float64,
+    'FLOAT64': np.float64,
+    'NUMERIC': np.float64,
+    'BOOLEAN': np.bool_,
+    'BOOL': np.bool_,
+}
+
+
+def schema_dtypes(schema, dtypes=None):
+    """
+    :param schema: list of BigQuery SchemaField of query result
+    :param dtypes: optional dictionary column name -> numpy dtype
+    which overrides types declared by schema, or code_dtype for string columns
+    decoded into codes of global code dictionary
+    :return: list of tuples (column name, numpy dtype)
+    String and other types are stored as object columns
+    """
+    dtypes = dtypes or {}
+    return [(field.name, dtypes.get(field.name, bigquery_dtypes.get(field.field_type, object)))
+            for field in schema]
+
+
+def to_column_array(values, dtype):
+    """
+    Converts sequence of values of one column into typed numpy array
+    :param values: sequence of python values (can contain None)
+    :param dtype: declared dtype of column
+    :return: numpy array. Integer and boolean columns with NULLs
+    are returned as float64 and object arrays respectively,
+    columns of code_dtype as codes of global code dictionary
+    """
+    if is_code_dtype(dtype):
+        return global_dictionary.encode(values)
+    dtype = np.dtype(dtype)
+    if dtype == np.dtype(object):
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return array
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        if dtype.kind in 'iuf':
+            return np.array(values, dtype=np.float64)
+        return to_column_array(values, object)
+
+
+def arrow_column_array(column, dtype):
+    """
+    Converts Arrow array of one column into typed numpy array, the same as to_column_array
+    :param column: pyarrow Array
+    :param dtype: declared dtype of column
+    :return: numpy array, numeric columns without NULLs are converted without copy
+    """
+    if is_code_dtype(dtype):
+        encoded = column.dictionary_encode()
+        return global_dictionary.translate(encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False),
+                                           encoded.dictionary.to_pylist())
+    dtype = np.dtype(dtype)
+    if column.null_count > 0 and dtype.kind in 'iuf':
+        return column.cast(pyarrow.float64()).to_numpy(zero_copy_only=False)
+    values = column.to_numpy(zero_copy_only=False)
+    if values.dtype == dtype:
+        return values
+    return to_column_array(values, dtype)
+
+
+def iter_arrow_columns(row_iterator, column_dtypes):
+    """
+    Converts record batches of result into typed column arrays,
+    rows of pages are decoded by BigQuery client column-wise
+    :param row_iterator: BigQuery RowIterator
+    :param column_dtypes: list of tuples (column name, numpy dtype)
+    :return: generator of lists of numpy arrays (one array for each column)
+    """
+    if hasattr(row_iterator, 'to_arrow_iterable'):
+        batches = row_iterator.to_arrow_iterable()
+    else:
+        batches = row_iterator.to_arrow().to_batches()
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        yield [arrow_column_array(batch.column(i), dtype) for i, (_, dtype) in enumerate(column_dtypes)]
+
+
+def iter_page_columns(row_iterator, column_dtypes):
+    """
+    Converts each result page into typed column arrays.
+    BigQuery results are read as Arrow record batches, so no object is created for single row.
+    Pages of clients without Arrow support (local stand-in client) or without pyarrow
+    are transposed from rows
+    :param row_iterator: BigQuery RowIterator
+    :param column_dtypes: list of tuples (column name, numpy dtype)
+    :return: generator of lists of numpy arrays (one array for each column)
+    """
+    if pyarrow is not None and (hasattr(row_iterator, 'to_arrow_iterable') or hasattr(row_iterator, 'to_arrow')):
+        yield from iter_arrow_columns(row_iterator, column_dtypes)
+        return
+    for page in row_iterator.pages:
+        values = [row.values() for row in page]
+        if not values:
+            continue
+        columns = zip(*values)
+        del values
+        yield [to_column_array(column, dtype)
+               for column, (_, dtype) in zip(columns, column_dtypes)]
+
+
+def concat_columns(chunks, column_dtypes):
+    """
+    :param chunks: iterable of lists of column arrays
+    :param column_dtypes: list of tuples (column name, numpy dtype)
+    :return: dictionary column name -> numpy array
+    """
+    parts = [[] for _ in column_dtypes]
+    for chunk in chunks:
+        for part, column in zip(parts, chunk):
+            part.append(column)
+    columns = {}
+    for (name, dtype), part in zip(column_dtypes, parts):
+        if not part:
+            columns[name] = np.empty(0, dtype=global_dictionary.code_type if is_code_dtype(dtype) else dtype)
+        elif len(part) == 1:
+            columns[name] = part[0]
+        else:
+            columns[name] = np.concatenate(part)
+    return columns
+
+
+def rechunk_columns(chunks, chunk_rows):
+    """
+    :param chunks: iterable of lists of column arrays of any sizes
+    :param chunk_rows: number of rows of returned chunks
+    :return: generator of lists of column arrays with chunk_rows rows
+    (last one can be smaller)
+    """
+    pending = []
+    pending_rows = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_rows += chunk[0].shape[0]
+        while pending_rows >= chunk_rows:
+            columns = [np.concatenate(part) if len(pending) > 1 else part[0]
+                       for part in zip(*pending)]
+            yield [column[:chunk_rows] for column in columns]
+            pending = [[column[chunk_rows:] for column in columns]]
+            pending_rows -= chunk_rows
+    if pending_rows > 0:
+        yield [np.concatenate(part) if len(pending) > 1 else part[0] for part in zip(*pending)]
+
+
+def columns_to_dataframe(columns, column_dtypes):
+    """
+    :param columns: list of column arrays
+    :param column_dtypes: list of tuples (column name, numpy dtype)
+    :return: DataFrame built from arrays without copying,
+    columns of code_dtype are Categoricals of global code dictionary
+    """
+    names = [name for name, _ in column_dtypes]
+    data = {name: global_dictionary.categorical(column) if is_code_dtype(dtype) else column
+            for (name, dtype), column in zip(column_dtypes, columns)}
+    return pd.DataFrame(data, columns=names, copy=False)
+
+
+def rows_to_dataframe(row_iterator, dtypes=None):
+    """
+    Columnar materialization of query result
+    :param row_iterator: BigQuery RowIterator returned by QueryJob.result()
+    :param dtypes: optional dictionary column name -> numpy dtype
+    :return: pandas DataFrame built directly from column arrays
+    """
+    column_dtypes = schema_dtypes(row_iterator.schema, dtypes)
+    columns = concat_columns(iter_page_columns(row_iterator, column_dtypes), column_dtypes)
+    return columns_to_dataframe([columns[name] for name, _ in column_dtypes], column_dtypes)
+
+
+def month_year_to_timestamp(column):
+    """
+    :param column: pandas Series with dates in format YYYYMM (the same as MonthYear column)
+    :return: Series of pd.Timestamp of first day of each month
+    """
+    column = column.astype(np.int64)
+    return pd.to_datetime(pd.DataFrame({'year': column // 100,
+                                        'month': column % 100,
+                                        'day': 1}))
+
+
+def format_result_dataframe(df,
+                            index_col_name=None,
+                            datetime_cols=None,
+                            month_year_cols=None,
+                            categorical_cols=None):
+    """
+    Applies common post-processing of query results.
+    Parameters have the same meaning as in QueryExecutor.get_result_dataframe
+    :return: formatted DataFrame
+    """
+    if categorical_cols is not None:
+        for categorical_col in categorical_cols:
+            df[categorical_col] = global_dictionary.to_categorical(df[categorical_col])
+    if datetime_cols is not None:
+        for datetime_col in datetime_cols:
+            df[datetime_col] = pd.to_datetime(df[datetime_col],
+                                              format='%Y%m%d',
+                                              errors='ignore')
+    if month_year_cols is not None:
+        for month_year_col in month_year_cols:
+            df[month_year_col] = month_year_to_timestamp(df[month_year_col])
+    if index_col_name is not None:
+        df.index = df[index_col_name]
+        df.drop([index_col_name], inplace=True, axis=1)
+    return df
@@ -0,0 +1,58 @@
+import time
+import threading
+import collections
+
+
+class EstimateMemo:
+    """
+    Bytes processed estimated by dry runs of queries, kept for limited time
+    (events table grows, so estimates get outdated) and for limited number of queries,
+    least recently used estimates are dropped first
+    """
+
+    def __init__(self, size, ttl):
+        """
+        :param size: maximal number of kept estimates
+        :param ttl: default seconds for which estimate is kept
+        """
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # query -> tuple (bytes, expiration time), in order of use
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        :param key: normalized SQL query
+        :return: estimated bytes, None if query wasn't estimated or estimate expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        """
+        :param key: normalized SQL query
+        :param value: estimated bytes
+        :param ttl: seconds for which estimate is kept, default ttl of memo if None,
+        0 to not keep estimate
+        :return: nothing
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
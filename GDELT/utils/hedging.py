@@ -0,0 +1,107 @@
+"""
+Helpers of hedged and retried query execution.
+Latency of queries is kept per function, query which runs longer than
+given percentile of latencies of its function is submitted again
+and the first finished job is used. Transient errors are retried
+with exponential backoff with full jitter.
+"""
+import random
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+from google.api_core import exceptions as api_exceptions
+
+# errors of BigQuery API which succeed when request is repeated
+transient_errors = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+# errors of queries which were stopped before their result was known,
+# their time is only lower bound of latency
+timeout_errors = (
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    TimeoutError,
+    concurrent.futures.TimeoutError,
+    concurrent.futures.CancelledError,
+)
+
+# reasons of failed BigQuery jobs which are worth resubmitting
+transient_reasons = {'backendError', 'internalError', 'rateLimitExceeded', 'jobBackendError'}
+
+
+def is_transient(error):
+    """
+    :param error: exception raised by query or its result
+    :return: True if query can be retried
+    """
+    if isinstance(error, transient_errors):
+        return True
+    reasons = {item.get('reason') for item in getattr(error, 'errors', None) or [] if isinstance(item, dict)}
+    return bool(reasons & transient_reasons)
+
+
+def is_timeout(error):
+    """
+    :param error: exception raised by query or its result
+    :return: True if query timed out or was cancelled, so it took at least time until error
+    """
+    return isinstance(error, timeout_errors)
+
+
+def backoff_delays(retries, base_delay, max_delay):
+    """
+    :param retries: number of retries
+    :param base_delay: delay before first retry in seconds
+    :param max_delay: maximal delay
+    :return: generator of delays before each retry (exponential backoff with full jitter)
+    """
+    for attempt in range(retries):
+        yield random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class LatencyHistory:
+    """
+    Recent latencies of queries of each function
+    """
+
+    def __init__(self, size=200, min_samples=20):
+        """
+        :param size: number of latest latencies kept for each function
+        :param min_samples: number of latencies needed before percentiles are known
+        """
+        self.size = size
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    def record(self, function_name, seconds):
+        """
+        :param function_name: name of function from FunctionUtil.function_dict, None for background queries
+        :param seconds: time from submission of query to its result
+        :return: nothing
+        """
+        with self.lock:
+            history = self.latencies.get(function_name)
+            if history is None:
+                history = self.latencies[function_name] = collections.deque(maxlen=self.size)
+            history.append(seconds)
+
+    def percentile(self, function_name, percent):
+        """
+        :param function_name: name of function
+        :param percent: percentile between 0 and 100
+        :return: latency in seconds, None if function doesn't have enough latencies yet
+        """
+        with self.lock:
+            history = list(self.latencies.get(function_name, ()))
+        if len(history) < self.min_samples:
+            return None
+        return float(np.percentile(history, percent))
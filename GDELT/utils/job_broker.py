@@ -0,0 +1,404 @@
+"""
+Job broker shared by processes of web server, jobs are executed by separate worker processes.
+
+Usage (from main directory of project):
+    python -m GDELT.utils.job_broker [--processes N] [--threads N] [--path PATH]
+
+Jobs, their state and results are kept in SQLite database (job_broker_path),
+so any web server process can answer wait and plot requests of job submitted
+by other process, and jobs survive restart of web server. Each job has exact result
+task and optional preview task, workers claim queued tasks, execute them
+and store results. Running task whose worker stopped reporting for job_lease seconds
+(i.e. worker process was killed) is executed again by other worker.
+Identical submissions share one job while it is running, the same as in FunctionPool.
+Results are stored compressed, results older than job_result_ttl and least recently
+used results over job_results_max_bytes are deleted by workers.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+from multiprocessing import Process
+
+from .result_cache import _Transaction
+from .result_store import JobExpired, compress_value, decompress_value
+from .utils import job_broker_path, job_worker_threads, job_poll_interval, job_lease, job_max_attempts, \
+    job_result_ttl, job_results_max_bytes
+
+# kinds of tasks of job, preview tasks are claimed first as they are short
+preview_task = 'preview'
+result_task = 'result'
+
+
+class JobError(Exception):
+    """
+    Error raised by task in worker process
+    """
+
+
+class JobBroker:
+    """
+    SQLite database with jobs, tasks and job ids (aliases) attached to jobs
+    """
+
+    def __init__(self, path, lease=job_lease, max_attempts=job_max_attempts,
+                 ttl=job_result_ttl, max_bytes=job_results_max_bytes):
+        """
+        :param path: path of database file
+        :param lease: seconds after which running task without heartbeat is executed again
+        :param max_attempts: number of executions of task before it fails
+        :param ttl: seconds for which finished job is kept, None to keep jobs until evicted by size
+        :param max_bytes: maximal total size of compressed results, None for no limit
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    key TEXT,
+                    args TEXT NOT NULL,
+                    refs INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    expires REAL,
+                    accessed REAL)""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    job_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    heartbeat REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    kind_of_value INTEGER,
+                    value BLOB,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (job_id, kind))""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS aliases (
+                    job_uuid TEXT PRIMARY KEY,
+                    job_id TEXT NOT NULL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+            connection.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created)")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return _Transaction(connection)
+
+    def submit(self, args, key=None, preview=False):
+        """
+        Adds job, or attaches new job id to running job with the same key
+        :param args: JSON serializable args of tasks
+        :param key: JSON serializable canonical key of args, None if job isn't shared
+        :param preview: add preview task
+        :return: new job id
+        """
+        job_uuid = str(uuid.uuid4())
+        key = json.dumps(key, sort_keys=True) if key is not None else None
+        now = time.time()
+        with self._connect() as connection:
+            row = None
+            if key is not None:
+                row = connection.execute("""
+                    SELECT jobs.id FROM jobs JOIN tasks ON tasks.job_id = jobs.id AND tasks.kind = ?
+                    WHERE jobs.key = ? AND tasks.status IN ('queued', 'running')
+                    ORDER BY jobs.created DESC LIMIT 1""", (result_task, key)).fetchone()
+            if row is None:
+                job_id = uuid.uuid4().hex
+                connection.execute("INSERT INTO jobs (id, key, args, refs, created) VALUES (?, ?, ?, 0, ?)",
+                                   (job_id, key, json.dumps(args), now))
+                for kind in ([preview_task] if preview else []) + [result_task]:
+                    connection.execute("INSERT INTO tasks (job_id, kind, status, created) VALUES (?, ?, 'queued', ?)",
+                                       (job_id, kind, now))
+            else:
+                job_id = row[0]
+            connection.execute("UPDATE jobs SET refs = refs + 1 WHERE id = ?", (job_id,))
+            connection.execute("INSERT INTO aliases VALUES (?, ?)", (job_uuid, job_id))
+        return job_uuid
+
+    def release(self, job_uuid):
+        """
+        Detaches job id, job is still finished for other ids.
+        Finished job without job ids is deleted
+        :return: number of job ids still attached to job
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT job_id FROM aliases WHERE job_uuid = ?", (job_uuid,)).fetchone()
+            if row is None:
+                return 0
+            connection.execute("DELETE FROM aliases WHERE job_uuid = ?", (job_uuid,))
+            connection.execute("UPDATE jobs SET refs = refs - 1 WHERE id = ?", (row[0],))
+            refs = connection.execute("SELECT refs FROM jobs WHERE id = ?", (row[0],)).fetchone()[0]
+            finished = connection.execute("SELECT status FROM tasks WHERE job_id = ? AND kind = ?",
+                                          (row[0], result_task)).fetchone()[0] in ('done', 'error')
+            if refs == 0 and finished:
+                self._delete(connection, [row[0]])
+            return refs
+
+    def _delete(self, connection, job_ids):
+        for table, column in [('aliases', 'job_id'), ('tasks', 'job_id'), ('jobs', 'id')]:
+            connection.executemany("DELETE FROM {} WHERE {} = ?".format(table, column),
+                                   [(job_id,) for job_id in job_ids])
+
+    def tasks(self, job_uuid, with_values=False):
+        """
+        :param job_uuid: job id returned by submit
+        :param with_values: read values and errors of tasks
+        :return: dictionary kind -> tuple (status, value, error) of tasks of job
+        :raise JobExpired if there is no such job id or job expired
+        """
+        columns = 'kind, status, kind_of_value, value, error' if with_values else \
+            'kind, status, NULL, NULL, NULL'
+        now = time.time()
+        with self._connect() as connection:
+            rows = connection.execute("""
+                SELECT {} FROM tasks JOIN aliases ON aliases.job_id = tasks.job_id
+                JOIN jobs ON jobs.id = tasks.job_id
+                WHERE aliases.job_uuid = ? AND (jobs.expires IS NULL OR jobs.expires > ?)""".format(columns),
+                                      (str(job_uuid), now)).fetchall()
+            if rows and with_values:
+                connection.execute("""
+                    UPDATE jobs SET accessed = ?
+                    WHERE id = (SELECT job_id FROM aliases WHERE job_uuid = ?) AND accessed IS NOT NULL""",
+                                   (now, str(job_uuid)))
+        if not rows:
+            raise JobExpired(job_uuid)
+        return {kind: (status, decompress_value(kind_of_value, value) if value is not None else None, error)
+                for kind, status, kind_of_value, value, error in rows}
+
+    def claim(self, worker):
+        """
+        Takes the oldest queued task (or running task of dead worker)
+        :param worker: id of worker process
+        :return: tuple (job id, kind of task, args) or None if there is no task
+        """
+        now = time.time()
+        with self._connect() as connection:
+            # jobs which fail here expire and are evicted the same way as finished ones
+            connection.execute("""
+                UPDATE jobs SET expires = ?, accessed = ?
+                WHERE id IN (SELECT job_id FROM tasks
+                             WHERE kind = ? AND status = 'running' AND heartbeat < ? AND attempts >= ?)""",
+                               (now + self.ttl if self.ttl is not None else None, now,
+                                result_task, now - self.lease, self.max_attempts))
+            connection.execute("""
+                UPDATE tasks SET status = 'error', error = 'Worker stopped while executing task'
+                WHERE status = 'running' AND heartbeat < ? AND attempts >= ?""",
+                               (now - self.lease, self.max_attempts))
+            while True:
+                row = connection.execute("""
+                    SELECT tasks.job_id, tasks.kind, jobs.args FROM tasks JOIN jobs ON jobs.id = tasks.job_id
+                    WHERE tasks.status = 'queued' OR (tasks.status = 'running' AND tasks.heartbeat < ?)
+                    ORDER BY tasks.created, tasks.kind LIMIT 1""", (now - self.lease,)).fetchone()
+                if row is None:
+                    return None
+                job_id, kind, args = row
+                if kind == preview_task and connection.execute(
+                        "SELECT status FROM tasks WHERE job_id = ? AND kind = ?",
+                        (job_id, result_task)).fetchone()[0] == 'done':
+                    # exact result is ready, preview isn't needed anymore
+                    connection.execute("UPDATE tasks SET status = 'done' WHERE job_id = ? AND kind = ?",
+                                       (job_id, kind))
+                    continue
+                connection.execute("""
+                    UPDATE tasks SET status = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1
+                    WHERE job_id = ? AND kind = ?""", (worker, now, job_id, kind))
+                break
+        return job_id, kind, json.loads(args)
+
+    def heartbeat(self, worker):
+        """
+        Marks running tasks of worker as alive
+        """
+        with self._connect() as connection:
+            connection.execute("UPDATE tasks SET heartbeat = ? WHERE worker = ? AND status = 'running'",
+                               (time.time(), worker))
+
+    def finish(self, job_id, kind, worker, value=None, error=None):
+        """
+        Stores compressed value or error of task executed by worker
+        """
+        kind_of_value, data = compress_value(value) if value is not None else (None, None)
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("""
+                UPDATE tasks SET status = ?, kind_of_value = ?, value = ?, error = ?
+                WHERE job_id = ? AND kind = ? AND worker = ? AND status = 'running'""",
+                               ('done' if error is None else 'error', kind_of_value, data, error,
+                                job_id, kind, worker))
+            if kind == result_task:
+                # preview isn't shown after exact result
+                connection.execute("UPDATE tasks SET value = NULL WHERE job_id = ? AND kind = ?",
+                                   (job_id, preview_task))
+                connection.execute("UPDATE jobs SET expires = ?, accessed = ? WHERE id = ?",
+                                   (now + self.ttl if self.ttl is not None else None, now, job_id))
+
+    def purge(self):
+        """
+        Deletes expired jobs and least recently used finished jobs over size limit
+        :return: number of deleted jobs
+        """
+        with self._connect() as connection:
+            expired = [job_id for job_id, in connection.execute(
+                "SELECT id FROM jobs WHERE expires <= ?", (time.time(),))]
+            self._delete(connection, expired)
+            evicted = []
+            if self.max_bytes is not None:
+                sizes = connection.execute("""
+                    SELECT jobs.id, SUM(IFNULL(LENGTH(tasks.value), 0)) FROM jobs JOIN tasks ON tasks.job_id = jobs.id
+                    WHERE jobs.accessed IS NOT NULL
+                    GROUP BY jobs.id ORDER BY jobs.accessed DESC""").fetchall()
+                total = 0
+                for job_id, size in sizes:
+                    total += size
+                    if total > self.max_bytes and job_id != sizes[0][0]:
+                        evicted.append(job_id)
+                self._delete(connection, evicted)
+        return len(expired) + len(evicted)
+
+
+class BrokerPool:
+    """
+    Client of JobBroker with interface of FunctionPool, used by web server processes.
+    Unknown job ids and ids of deleted jobs raise JobExpired
+    """
+
+    def __init__(self, broker, key_fun=None, preview=False, poll_interval=job_poll_interval):
+        """
+        :param broker: JobBroker
+        :param key_fun: function which returns canonical key of task args, the same as in FunctionPool
+        :param preview: jobs have preview tasks
+        :param poll_interval: seconds between checks of state of waited job
+        """
+        self.broker = broker
+        self.key_fun = key_fun
+        self.preview = preview
+        self.poll_interval = poll_interval
+
+    def add_task(self, args):
+        key = self.key_fun(args) if self.key_fun is not None else None
+        return self.broker.submit(args, key, self.preview)
+
+    def release(self, job_uuid):
+        return self.broker.release(str(job_uuid))
+
+    def check_if_complete(self, job_uuid):
+        return self.broker.tasks(job_uuid)[result_task][0] in ('done', 'error')
+
+    def get_result(self, job_uuid):
+        """
+        :return: result of function execution
+        :raise JobError if function failed
+        """
+        status, value, error = self.broker.tasks(job_uuid, with_values=True)[result_task]
+        if status == 'error':
+            raise JobError(error)
+        return value
+
+    def wait_result(self, job_uuid):
+        while not self.check_if_complete(job_uuid):
+            time.sleep(self.poll_interval)
+
+    def _first_ready(self, job_uuid):
+        tasks = self.broker.tasks(job_uuid)
+        if tasks[result_task][0] in ('done', 'error'):
+            return True
+        if preview_task not in tasks or tasks[preview_task][0] != 'done':
+            return False
+        # preview is ready if function has one
+        return self.broker.tasks(job_uuid, with_values=True)[preview_task][1] is not None
+
+    def wait_first(self, job_uuid):
+        while not self._first_ready(job_uuid):
+            time.sleep(self.poll_interval)
+
+    def get_latest(self, job_uuid):
+        tasks = self.broker.tasks(job_uuid, with_values=True)
+        preview = tasks.get(preview_task)
+        if tasks[result_task][0] in ('done', 'error') or preview is None or \
+                preview[0] != 'done' or preview[1] is None:
+            self.wait_result(job_uuid)
+            return self.get_result(job_uuid), False
+        return preview[1], True
+
+
+def run_worker(path, threads, fun, preview_fun=None, stop=None):
+    """
+    Executes tasks of broker until stop is set
+    :param path: path of broker database
+    :param threads: number of tasks executed at the same time
+    :param fun: function executing result tasks
+    :param preview_fun: function executing preview tasks
+    :param stop: optional threading.Event
+    :return: nothing
+    """
+    broker = JobBroker(path)
+    worker = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    stop = stop or threading.Event()
+
+    def heartbeat():
+        while not stop.wait(broker.lease / 3):
+            broker.heartbeat(worker)
+            broker.purge()
+
+    def loop():
+        while not stop.is_set():
+            task = broker.claim(worker)
+            if task is None:
+                stop.wait(job_poll_interval)
+                continue
+            job_id, kind, args = task
+            try:
+                value = (preview_fun if kind == preview_task else fun)(tuple(args))
+                broker.finish(job_id, kind, worker, value=value)
+            except Exception as e:
+                broker.finish(job_id, kind, worker, error='{}: {}'.format(type(e).__name__, e))
+
+    loops = [threading.Thread(target=loop, daemon=True) for _ in range(threads)]
+    for thread in loops + [threading.Thread(target=heartbeat, daemon=True)]:
+        thread.start()
+    for thread in loops:
+        thread.join()
+
+
+def work(path, threads):
+    """
+    Entry of worker process, executes functions of FunctionUtil
+    """
+    from ..functions.function_utils import FunctionUtil
+    function_util = FunctionUtil()
+    run_worker(path, threads, function_util.get_plot, function_util.get_preview)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker processes executing jobs of job broker")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument('--threads', type=int, default=job_worker_threads,
+                        help="number of jobs executed at the same time by each process")
+    parser.add_argument('--path', default=job_broker_path, help="path of broker database")
+    args = parser.parse_args(argv)
+    if args.path is None:
+        parser.error("job_broker_path isn't set, pass --path")
+    processes = [Process(target=work, args=(args.path, args.threads)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    print("{} worker processes started".format(len(processes)))
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
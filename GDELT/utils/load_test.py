@@ -0,0 +1,171 @@
+"""
+Load test of function requests driven through Django views in one process.
+
+Usage (from main directory of project):
+    python -m GDELT.utils.load_test [--client replay|bigquery|local] [--record] [--latency-scale X]
+        [--users N] [--requests N] [--functions NAME ...] [--requests-file FILE] [--no-cache]
+
+Each simulated user repeats the flow of browser: plot_request, wait_for_plot
+(until preview or exact result), plot page, and if it was approximate,
+wait_for_plot and plot page again. Time of each step, time to first and exact plot
+and throughput of requests are printed. Requests are read from file with one JSON
+{"function": name, "params": {parameter: value}} per line, or default parameters of functions are used.
+
+Queries are recorded with --record (i.e. with --client bigquery) and replayed
+without BigQuery with --client replay. Result cache isn't used, month ranges aren't split
+into shards and country filters aren't batched during recording and replay,
+as which queries are made would otherwise depend on earlier requests and their timing.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+from multiprocessing.dummy import Pool
+
+from . import utils
+
+# host allowed by settings, used by requests of test client
+host = '127.0.0.1'
+
+
+def default_requests(function_names):
+    """
+    :param function_names: list of function names, None for all functions
+    :return: list of tuples (function name, parameters dictionary) with default values
+    in format of parameters form
+    """
+    from ..functions.function_utils import FunctionUtil
+    function_util = FunctionUtil()
+    requests = []
+    for name in function_names or list(function_util.function_dict):
+        defaults = function_util.get_function_by_name(name).get_default_parameters()
+        requests.append((name, {names[0]: param.get_value_from_default(defaults[names[0]])
+                                for param, names in function_util.get_parameters(name)}))
+    return requests
+
+
+def read_requests(path):
+    """
+    :param path: file with one JSON object with "function" and "params" per line
+    :return: list of tuples (function name, parameters dictionary)
+    """
+    with open(path) as source:
+        return [(item['function'], item['params']) for item in map(json.loads, source) if item]
+
+
+def run_session(client, function_name, param_dict):
+    """
+    Requests plot as browser does
+    :param client: django.test.Client
+    :param function_name: name of function
+    :param param_dict: parameters dictionary in format of parameters form
+    :return: dictionary with times of steps in seconds, "error" with description if request failed
+    """
+    times = {'function': function_name}
+    started = time.time()
+
+    def post(url, body):
+        response = client.post(url, json.dumps(body), content_type='application/json', HTTP_HOST=host)
+        return json.loads(response.content)
+
+    try:
+        response = post('/plot_request/{}'.format(function_name), param_dict)
+        times['submit'] = time.time() - started
+        if response['status'] != 'ok':
+            times['error'] = response['error']
+            return times
+        job_uuid = response['job_uuid']
+        post('/wait_for_plot/', {'job_uuid': job_uuid, 'preview': True})
+        times['wait'] = time.time() - started - times['submit']
+        page = client.get('/plot/{}/{}'.format(function_name, job_uuid), HTTP_HOST=host).content
+        times['first_plot'] = time.time() - started
+        times['render'] = times['first_plot'] - times['submit'] - times['wait']
+        if b'id="approximate"' in page:
+            times['preview'] = True
+            post('/wait_for_plot/', {'job_uuid': job_uuid})
+            client.get('/plot/{}/{}'.format(function_name, job_uuid), HTTP_HOST=host)
+        times['exact_plot'] = time.time() - started
+    except Exception as e:
+        times['error'] = repr(e)
+    return times
+
+
+def print_summary(results, seconds):
+    """
+    :param results: list of results of run_session
+    :param seconds: duration of test
+    :return: nothing
+    """
+    finished = [result for result in results if 'error' not in result]
+    print("{} requests in {:.1f} s, {:.2f} requests/s, {} errors, {} previews".format(
+        len(results), seconds, len(finished) / seconds if seconds > 0 else 0.,
+        len(results) - len(finished), sum(1 for result in finished if result.get('preview'))))
+    for step in ['submit', 'wait', 'render', 'first_plot', 'exact_plot']:
+        values = [result[step] for result in finished if step in result]
+        if values:
+            print("{:<12} p50 {:8.3f} s   p95 {:8.3f} s   max {:8.3f} s".format(
+                step, np.percentile(values, 50), np.percentile(values, 95), max(values)))
+    for function_name in sorted({result['function'] for result in results}):
+        values = [result['exact_plot'] for result in finished if result['function'] == function_name]
+        errors = [result['error'] for result in results
+                  if result['function'] == function_name and 'error' in result]
+        print("{:<28} {:4d} requests   p50 {}   {}".format(
+            function_name, len(values) + len(errors),
+            "{:8.3f} s".format(np.percentile(values, 50)) if values else "       -",
+            "error: {}".format(errors[0]) if errors else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of function requests")
+    parser.add_argument('--client', choices=['replay', 'bigquery', 'local'], default='replay',
+                        help="client executing queries")
+    parser.add_argument('--record', action='store_true',
+                        help="record queries into {}".format(utils.recordings_path))
+    parser.add_argument('--latency-scale', type=float, default=1.,
+                        help="multiplier of replayed latencies, 0 for no delays")
+    parser.add_argument('--users', type=int, default=8, help="number of concurrent users")
+    parser.add_argument('--requests', type=int, default=None,
+                        help="number of requests, by default each request once")
+    parser.add_argument('--functions', nargs='*', default=None, help="names of requested functions")
+    parser.add_argument('--requests-file', default=None, help="file with requests, one JSON per line")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't use result cache and rollup cube, so every request runs its queries")
+    parser.add_argument('--seed', type=int, default=0, help="seed of order of requests")
+    args = parser.parse_args(argv)
+
+    # settings are read when QueryExecutor and its clients are created
+    utils.query_client = args.client
+    utils.record_queries = args.record
+    utils.replay_latency_scale = args.latency_scale
+    if args.record or args.client == 'replay':
+        utils.range_shards = 1
+        utils.batch_window = None
+        utils.result_cache_path = None
+    if args.no_cache:
+        utils.result_cache_path = None
+        utils.rollup_path = None
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'GDELT.settings')
+    import django
+    django.setup()
+    from django.test import Client
+
+    requests = read_requests(args.requests_file) if args.requests_file else default_requests(args.functions)
+    if args.requests is not None:
+        rng = random.Random(args.seed)
+        requests = [rng.choice(requests) for _ in range(args.requests)]
+
+    pool = Pool(args.users)
+    started = time.time()
+    results = pool.map(lambda request: run_session(Client(), *request), requests, chunksize=1)
+    seconds = time.time() - started
+    pool.close()
+    print_summary(results, seconds)
+    print(json.dumps(utils.QueryExecutor().get_usage(), indent=2))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
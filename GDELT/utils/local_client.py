@@ -0,0 +1,291 @@
+"""
+Stand-in for BigQuery client used in development and tests.
+Queries are translated into SQLite dialect and executed over events of local event store,
+processed bytes are computed the same way as BigQuery does (size of all values of read columns
+for each scan of table),
+so cost estimation and accounting can be checked without BigQuery account.
+"""
+import re
+import math
+import sqlite3
+import uuid
+import threading
+import collections
+import numpy as np
+
+from .query_plan import event_column_types
+
+# BigQuery bills at least 10 MB per query, rounded up to 1 MB
+min_billed_bytes = 10 * 1024 ** 2
+billed_bytes_unit = 1024 ** 2
+# number of result tables of finished queries kept for list_rows
+result_tables = 16
+
+
+class SchemaField:
+    def __init__(self, name, field_type):
+        self.name = name
+        self.field_type = field_type
+
+
+class Row:
+    def __init__(self, values):
+        self._values = values
+
+    def values(self):
+        return self._values
+
+
+class RowIterator:
+    """
+    Result of query with the same interface as BigQuery RowIterator: schema and pages of rows
+    """
+
+    def __init__(self, schema, rows, page_size=10000):
+        self.schema = schema
+        self.total_rows = len(rows)
+        self._rows = rows
+        self.page_size = page_size
+
+    @property
+    def pages(self):
+        for start in range(0, len(self._rows), self.page_size):
+            yield [Row(values) for values in self._rows[start:start + self.page_size]]
+
+    def __iter__(self):
+        for values in self._rows:
+            yield Row(values)
+
+
+class QueryJob:
+    def __init__(self, query, dry_run, total_bytes_processed, rows=None, schema=None, destination=None):
+        self.query = query
+        self.dry_run = dry_run
+        self.destination = destination
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = 0 if dry_run else \
+            max(min_billed_bytes, int(math.ceil(total_bytes_processed / billed_bytes_unit)) * billed_bytes_unit)
+        self._rows = rows
+        self._schema = schema
+
+    def cancel(self):
+        """
+        Query is executed when job is created, so there is nothing to cancel
+        :return: False
+        """
+        return False
+
+    def result(self, page_size=None):
+        if self.dry_run:
+            raise Exception("Dry run job has no result")
+        return RowIterator(self._schema, self._rows, page_size=page_size or 10000)
+
+
+class _Correlation:
+    """
+    CORR aggregate for SQLite
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.syy = self.sxy = 0.
+
+    def step(self, x, y):
+        if x is None or y is None:
+            return
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.syy += y * y
+        self.sxy += x * y
+
+    def finalize(self):
+        if self.n < 2:
+            return None
+        denominator = (self.n * self.sxx - self.sx ** 2) * (self.n * self.syy - self.sy ** 2)
+        if denominator <= 0:
+            return None
+        return (self.n * self.sxy - self.sx * self.sy) / math.sqrt(denominator)
+
+
+class _CountIf:
+    def __init__(self):
+        self.count = 0
+
+    def step(self, condition):
+        if condition:
+            self.count += 1
+
+    def finalize(self):
+        return self.count
+
+
+def translate_query(query):
+    """
+    :param query: BigQuery standard SQL generated by functions
+    :return: equivalent SQLite query over table "events"
+    """
+    query = re.sub(r'`[^`]*`\s+TABLESAMPLE\s+SYSTEM\s*\(\s*([0-9.]+)\s+PERCENT\s*\)',
+                   lambda match: '(SELECT * FROM events WHERE ABS(RANDOM()) % 1000000 < {})'.format(
+                       float(match.group(1)) * 10000), query, flags=re.IGNORECASE)
+    query = re.sub(r'`[^`]*`', 'events', query)
+    query = re.sub(r'IN\s+UNNEST\s*\(\s*\[([^\]]*)\]\s*\)', r'IN (\1)', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bIF\s*\(', 'IIF(', query, flags=re.IGNORECASE)
+    query = re.sub(r'"([^"]*)"', lambda match: "'{}'".format(match.group(1).replace("'", "''")), query)
+    return query
+
+
+def referenced_columns(query):
+    """
+    :param query: SQL query
+    :return: set of events table columns used by query
+    """
+    words = set(re.findall(r'\b\w+\b', query))
+    return {column for column in event_column_types if column in words}
+
+
+def _parenthesized_groups(query):
+    """
+    :return: list of tuples (start, end) of parenthesized parts of query
+    """
+    groups = []
+    stack = []
+    for position, char in enumerate(query):
+        if char == '(':
+            stack.append(position)
+        elif char == ')' and stack:
+            groups.append((stack.pop(), position + 1))
+    return groups
+
+
+def table_scans(query):
+    """
+    Each reference of table in query is a separate scan of columns used
+    by its SELECT (without nested subqueries which scan table themselves)
+    :param query: SQL query
+    :return: list of sets of events table columns read by each scan
+    """
+    tables = [match.start() for match in re.finditer(r'`[^`]*`', query)]
+    groups = [(start, end) for start, end in _parenthesized_groups(query)
+              if re.match(r'\(\s*SELECT\b', query[start:end], re.IGNORECASE)]
+    scans = []
+    for table in tables:
+        enclosing = [(start, end) for start, end in groups if start < table < end]
+        start, end = min(enclosing, key=lambda group: group[1] - group[0]) if enclosing else (0, len(query))
+        nested = [(inner_start, inner_end) for inner_start, inner_end in groups
+                  if start < inner_start and inner_end <= end and (inner_start, inner_end) != (start, end)
+                  and any(inner_start < other < inner_end for other in tables)]
+        text = query[start:end]
+        for inner_start, inner_end in sorted(nested, reverse=True):
+            text = text[:inner_start - start] + ' ' * (inner_end - inner_start) + text[inner_end - start:]
+        scans.append(referenced_columns(text))
+    return scans
+
+
+class LocalClient:
+    """
+    Client with interface of google.cloud.bigquery.Client used by QueryExecutor
+    """
+
+    def __init__(self, store):
+        """
+        :param store: EventStore with events to query
+        """
+        self.store = store
+        self.lock = threading.Lock()
+        self.connection = None
+        self.column_bytes = {}
+        # destination table name -> (schema, rows) of finished queries
+        self.tables = collections.OrderedDict()
+
+    def _connect(self):
+        if self.connection is not None:
+            return self.connection
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+        connection.create_aggregate('CORR', 2, _Correlation)
+        connection.create_aggregate('COUNTIF', 1, _CountIf)
+        connection.create_function('SQRT', 1, lambda value: None if value is None or value < 0
+                                   else math.sqrt(value))
+        connection.create_function('IS_NAN', 1, lambda value: value is not None and math.isnan(value))
+        columns = [column for column in event_column_types]
+        connection.execute("CREATE TABLE events ({})".format(', '.join(
+            '{} {}'.format(column, 'TEXT' if event_column_types[column] == 'STRING' else
+                           'INTEGER' if event_column_types[column] == 'INTEGER' else 'REAL')
+            for column in columns)))
+        for month in self.store.months():
+            for fragment in self.store.fragments(month):
+                data = []
+                for column in columns:
+                    values = fragment.decoded(column)
+                    if values.dtype.kind == 'f':
+                        values = np.where(np.isnan(values), None, values.astype(object))
+                    elif values.dtype.kind in 'iu':
+                        values = values.astype(np.int64).astype(object)
+                    data.append(values)
+                connection.executemany(
+                    "INSERT INTO events VALUES ({})".format(', '.join('?' * len(columns))),
+                    zip(*data))
+        for column in columns:
+            if event_column_types[column] == 'STRING':
+                size = connection.execute(
+                    "SELECT COALESCE(SUM(LENGTH({}) + 2), 0) FROM events".format(column)).fetchone()[0]
+            else:
+                size = 8 * connection.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            self.column_bytes[column] = size
+        self.connection = connection
+        return connection
+
+    def query(self, query, job_config=None):
+        """
+        :param query: BigQuery SQL
+        :param job_config: optional QueryJobConfig, only dry_run is used
+        :return: QueryJob
+        """
+        dry_run = bool(getattr(job_config, 'dry_run', False))
+        with self.lock:
+            connection = self._connect()
+            processed = sum(self.column_bytes[column]
+                            for columns in table_scans(query) for column in columns)
+            if dry_run:
+                return QueryJob(query, True, processed)
+            cursor = connection.execute(translate_query(query))
+            rows = cursor.fetchall()
+            names = [description[0] for description in cursor.description]
+        schema = [SchemaField(name, self._field_type([row[i] for row in rows]))
+                  for i, name in enumerate(names)]
+        destination = '_local_results.anon{}'.format(uuid.uuid4().hex)
+        with self.lock:
+            self.tables[destination] = (schema, rows)
+            while len(self.tables) > result_tables:
+                self.tables.popitem(last=False)
+        return QueryJob(query, False, processed, rows, schema, destination)
+
+    def list_rows(self, table, selected_fields=None, start_index=0, max_results=None, page_size=None):
+        """
+        Reads range of rows of result table, the same as BigQuery list_rows,
+        so result can be read by several streams
+        :param table: destination of QueryJob
+        :param selected_fields: schema of returned rows, by default schema of table
+        :param start_index: index of first row
+        :param max_results: maximal number of rows, None for all rows after start_index
+        :param page_size: number of rows in pages
+        :return: RowIterator
+        """
+        with self.lock:
+            if table not in self.tables:
+                raise Exception("Not found: Table {}".format(table))
+            schema, rows = self.tables[table]
+        end = len(rows) if max_results is None else start_index + max_results
+        return RowIterator(selected_fields or schema, rows[start_index:end], page_size=page_size or 10000)
+
+    @staticmethod
+    def _field_type(values):
+        types = {type(value) for value in values if value is not None}
+        if types == {int}:
+            return 'INTEGER'
+        if types and types <= {int, float}:
+            return 'FLOAT'
+        if types == {bytes}:
+            return 'BYTES'
+        return 'STRING'
@@ -0,0 +1,200 @@
+"""
+Micro-batching of concurrent queries which differ only in country filter.
+First query of some shape waits for short window (only if other query of the same shape
+arrived recently, so single requests aren't delayed), queries of the same shape
+which arrive meanwhile join it. Batch is executed as one query with
+country IN (...) grouped additionally by country, and each query gets
+rows of its country. N scans of events table become one.
+Filters "or" of equalities of several country columns with the same country
+are batched as well (i.e. country in any actor role).
+"""
+import time
+import threading
+import numpy as np
+
+from .query_plan import AggregateQuery, Column
+
+# columns whose equality filters are batched
+batch_columns = (
+    'Actor1Geo_CountryCode',
+    'Actor2Geo_CountryCode',
+    'ActionGeo_CountryCode',
+    'Actor1CountryCode',
+    'Actor2CountryCode',
+)
+
+# prefix of aliases of batched columns added to keys of batch query
+batch_key = 'BatchValue'
+
+
+def _is_batched(condition):
+    column, op, value = condition
+    return column in batch_columns and op == '=' and not isinstance(value, Column)
+
+
+def batch_filter(plan):
+    """
+    :param plan: QueryPlan
+    :return: tuple (position of filter, list of columns, value) of first equality filter
+    on one of batch_columns (or "or" of such filters with the same value),
+    None if plan can't be batched
+    """
+    if not isinstance(plan, AggregateQuery) or plan.sample_percent is not None:
+        return None
+    if any(alias.startswith(batch_key) for alias, _ in plan.keys):
+        return None
+    for i, (column, op, value) in enumerate(plan.filters):
+        if _is_batched((column, op, value)):
+            return i, [column], str(value)
+        if op == 'or' and value and all(_is_batched(condition) for condition in value) \
+                and len({str(condition[2]) for condition in value}) == 1:
+            return i, [condition[0] for condition in value], str(value[0][2])
+    return None
+
+
+def batch_filters(plan, position, columns, value):
+    """
+    :return: filters of plan with batched filter matching value (list of values or None)
+    """
+    op = '=' if value is None or not isinstance(value, list) else 'in'
+    conditions = [(column, op, value) for column in columns]
+    filters = list(plan.filters)
+    filters[position] = conditions[0] if len(conditions) == 1 else (None, 'or', conditions)
+    return filters
+
+
+def batch_aliases(plan, columns):
+    """
+    :return: list of tuples (alias of batched column in batch query, True if it is added key)
+    """
+    key_aliases = {column: alias for alias, column in plan.keys}
+    return [(key_aliases[column], False) if column in key_aliases else ('{}{}'.format(batch_key, i), True)
+            for i, column in enumerate(columns)]
+
+
+def batch_plan(plan, position, columns, values):
+    """
+    :param plan: AggregateQuery accepted by batch_filter
+    :param position: position of batched filter
+    :param columns: batched columns
+    :param values: list of values of batched columns
+    :return: AggregateQuery for all values, grouped additionally by batched columns
+    which aren't its keys
+    """
+    keys = list(plan.keys) + [(alias, column) for (alias, added), column
+                              in zip(batch_aliases(plan, columns), columns) if added]
+    return AggregateQuery(keys, plan.measures, batch_filters(plan, position, columns, sorted(values)),
+                          table=plan.table)
+
+
+class Batch:
+    def __init__(self, plan, position, columns):
+        self.plan = plan
+        self.position = position
+        self.columns = columns
+        self.values = set()
+        self.closed = False
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QueryBatcher:
+    """
+    Collects concurrent partial aggregate requests of the same shape into batches
+    """
+
+    def __init__(self, fetch, window, max_values, recent=None):
+        """
+        :param fetch: function (AggregateQuery, list of months) -> dictionary month -> DataFrame
+        with partial states, executes batch
+        :param window: time in seconds for which first request of batch waits for others
+        :param max_values: maximal number of values of batched column in one batch
+        :param recent: first request of batch waits only if previous request of the same shape
+        came at most this number of seconds before it, by default 10 windows
+        """
+        self.fetch = fetch
+        self.window = window
+        self.max_values = max_values
+        self.recent = recent if recent is not None else 10 * (window or 0)
+        self.lock = threading.Lock()
+        self.pending = {}
+        # shape of requests -> time of the latest request
+        self.requested = {}
+
+    def submit(self, plan, months):
+        """
+        :param plan: QueryPlan
+        :param months: list of int months to fetch
+        :return: dictionary month -> DataFrame with partial states of plan,
+        None if plan can't be batched
+        """
+        found = batch_filter(plan)
+        if found is None:
+            return None
+        position, columns, value = found
+        shape = batch_filters(plan, position, columns, None)
+        key = (AggregateQuery(plan.keys, plan.measures, shape, table=plan.table).to_partial_sql(),
+               tuple(sorted(months)))
+        now = time.time()
+        with self.lock:
+            batch = self.pending.get(key)
+            leader = batch is None or batch.closed or len(batch.values) >= self.max_values
+            if leader:
+                batch = self.pending[key] = Batch(plan, position, columns)
+                # batch waits for others only if requests of its shape are frequent
+                wait = now - self.requested.get(key, -self.recent) < self.recent
+                for shape in [shape for shape, requested in self.requested.items()
+                              if now - requested >= self.recent]:
+                    del self.requested[shape]
+            self.requested[key] = now
+            batch.values.add(value)
+        if leader:
+            self._execute(key, batch, months, wait)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return self._slice(batch, value)
+
+    def _execute(self, key, batch, months, wait=True):
+        if wait:
+            time.sleep(self.window)
+        with self.lock:
+            batch.closed = True
+            if self.pending.get(key) is batch:
+                del self.pending[key]
+        try:
+            if len(batch.values) == 1:
+                batch.result = self.fetch(batch.plan, months)
+            else:
+                batch.result = self.fetch(batch_plan(batch.plan, batch.position, batch.columns,
+                                                     batch.values), months)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    @staticmethod
+    def _slice(batch, value):
+        """
+        :return: dictionary month -> partial states of rows of one value of batched column
+        """
+        if len(batch.values) == 1:
+            return batch.result
+        aliases = batch_aliases(batch.plan, batch.columns)
+        added = [alias for alias, is_added in aliases if is_added]
+        keys = [alias for alias, _ in batch.plan.keys]
+        result = {}
+        for month, partial in batch.result.items():
+            rows = np.logical_or.reduce([partial[alias].astype(str).to_numpy() == value
+                                         for alias, _ in aliases])
+            partial = partial.loc[rows, [column for column in partial.columns
+                                         if column not in added]].reset_index(drop=True)
+            if added and keys:
+                # rows of different added keys (i.e. country in other actor role) are the same group of plan
+                partial = partial.groupby(keys, sort=False, dropna=False, observed=True).sum().reset_index()
+            elif added:
+                partial = partial.sum().to_frame().T
+            result[month] = partial
+        return result
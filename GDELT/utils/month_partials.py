@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from .query_plan import AggregateQuery, Column, months_between
+from .result_cache import decode_categoricals
+
+# alias of month key added to partial queries
+partition_key = 'PartitionMonth'
+
+
+def _month_bounds(column, month):
+    if column == 'MonthYear':
+        return month, month
+    return month * 100 + 1, month * 100 + 31
+
+
+def _range_match(op, low, high, value):
+    """
+    :return: tuple (all values in [low, high] match, some value in [low, high] matches)
+    """
+    if op == '=':
+        return low == high == value, low <= value <= high
+    if op == '<':
+        return high < value, low < value
+    if op == '<=':
+        return high <= value, low <= value
+    if op == '>':
+        return low > value, high > value
+    return low >= value, high >= value
+
+
+def month_filters(filters, month):
+    """
+    Restricts filters of range query to one month.
+    Range filters which hold for whole month are dropped, so the same month
+    of different ranges gets the same filters
+    :param filters: list of filters of AggregateQuery
+    :param month: int month in format YYYYMM
+    :return: list of filters for month or None if month has no matching rows
+    """
+    result = []
+    for column, op, value in filters:
+        if column not in ('MonthYear', 'SQLDATE') or isinstance(value, Column) \
+                or op not in ('=', '<', '<=', '>', '>=', 'in'):
+            result.append((column, op, value))
+            continue
+        low, high = _month_bounds(column, month)
+        if op == 'in':
+            inside = sorted(int(item) for item in value if low <= int(item) <= high)
+            if not inside:
+                return None
+            if column == 'SQLDATE':
+                result.append((column, op, inside))
+            continue
+        matches_all, matches_any = _range_match(op, low, high, int(value))
+        if not matches_any:
+            return None
+        if not matches_all:
+            result.append((column, op, int(value)))
+    return result + [('MonthYear', '=', month)]
+
+
+def month_plan(plan, month):
+    """
+    :param plan: AggregateQuery
+    :param month: int month in format YYYYMM
+    :return: AggregateQuery of plan rows from one month, None if month has no matching rows
+    """
+    filters = month_filters(plan.filters, month)
+    if filters is None:
+        return None
+    return AggregateQuery(plan.keys, plan.measures, filters, table=plan.table)
+
+
+def plan_months(plan):
+    """
+    :param plan: AggregateQuery
+    :return: dictionary month -> month plan for months of plan range with possible rows,
+    None if range of plan is unbounded
+    """
+    start, end = plan.month_bounds()
+    if start is None or end is None:
+        return None
+    plans = {}
+    for month in months_between(start, end):
+        single_month_plan = month_plan(plan, month)
+        if single_month_plan is not None:
+            plans[month] = single_month_plan
+    return plans
+
+
+def months_query(plan, months):
+    """
+    :param plan: AggregateQuery
+    :param months: list of int months
+    :return: SQL returning partial states of plan for given months,
+    grouped additionally by month in partition_key column
+    """
+    months_plan = AggregateQuery(plan.keys, plan.measures,
+                                 list(plan.filters) + [('MonthYear', 'in', sorted(months))],
+                                 table=plan.table)
+    return months_plan.to_partial_sql(extra_keys=[(partition_key, 'MonthYear')])
+
+
+def split_months(partial, months):
+    """
+    :param partial: DataFrame returned by months_query
+    :param months: list of int months of query
+    :return: dictionary month -> DataFrame with partial states of month
+    """
+    month_values = partial[partition_key].to_numpy()
+    columns = [column for column in partial.columns if column != partition_key]
+    return {month: partial.loc[month_values == month, columns].reset_index(drop=True)
+            for month in months}
+
+
+def concat_partials(partials, keys):
+    """
+    Concatenates partials, key columns which are Categorical in some partial
+    (partials read from result cache) get union of their categories,
+    so strings are decoded once for merged result
+    :param partials: list of DataFrames with the same columns
+    :param keys: names of key columns
+    :return: DataFrame
+    """
+    for key in keys:
+        if not any(isinstance(partial[key].dtype, pd.CategoricalDtype) for partial in partials):
+            continue
+        categories = pd.Index(pd.unique(np.concatenate([
+            partial[key].array.categories.to_numpy(dtype=object)
+            if isinstance(partial[key].dtype, pd.CategoricalDtype)
+            else partial[key].dropna().to_numpy(dtype=object) for partial in partials])))
+        partials = [partial.assign(**{key: partial[key].array.set_categories(categories)
+                                      if isinstance(partial[key].dtype, pd.CategoricalDtype)
+                                      else pd.Categorical(partial[key].to_numpy(dtype=object), categories=categories)})
+                    for partial in partials]
+    return pd.concat(partials, ignore_index=True)
+
+
+def merge_partials(plan, partials):
+    """
+    Merges partial states of parts of table and computes measures
+    :param plan: AggregateQuery
+    :param partials: list of DataFrames with partial states
+    :return: DataFrame with the same columns as plan.to_sql() result
+    """
+    keys = [alias for alias, _ in plan.keys]
+    columns = keys + [state.name for state in plan.partial_states()]
+    partials = [partial[columns] for partial in partials if partial.shape[0] > 0]
+    if not partials:
+        partial = pd.DataFrame({column: np.array([], dtype=np.int64) for column in columns},
+                               columns=columns)
+    else:
+        partial = concat_partials(partials, keys)
+    if not keys:
+        partial = partial.sum().to_frame().T
+    elif len(partials) > 1:
+        partial = partial.groupby(keys, sort=False, dropna=False, observed=True).sum().reset_index()
+    return plan.finalize(decode_categoricals(partial))
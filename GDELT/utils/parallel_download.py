@@ -0,0 +1,128 @@
+"""
+Parallel download of large query results.
+The first page of result is already fetched with results of query job, so it is used as it is.
+The rest of result table is split into row ranges which are read by several streams
+at the same time (BigQuery list_rows with start_index and max_results, so no additional
+dependency on BigQuery Storage API is needed), each stream decodes its pages
+into column arrays in its own thread.
+Ranges are returned in order, so order of rows (ORDER BY of query) is kept.
+"""
+import math
+import numpy as np
+from multiprocessing.dummy import Pool
+
+from .columnar import iter_page_columns
+from .chunked_result import ChunkedResult
+
+
+def split_rows(total_rows, streams, min_rows=1):
+    """
+    :param total_rows: number of rows of result
+    :param streams: maximal number of streams
+    :param min_rows: minimal number of rows read by one stream
+    :return: list of tuples (start index, number of rows) covering all rows
+    """
+    streams = max(1, min(streams, int(math.ceil(total_rows / max(min_rows, 1)))))
+    size = int(math.ceil(total_rows / streams)) if total_rows else 0
+    return [(start, min(size, total_rows - start)) for start in range(0, total_rows, size or 1)]
+
+
+def read_stream(client_pool, destination, schema, column_dtypes, start, rows,
+                page_size=None, max_bytes=None, spill_path=None):
+    """
+    Reads one range of rows of result table
+    :param client_pool: ClientPool, client is taken for time of reading
+    :param destination: result table of query job
+    :param schema: schema of result
+    :param column_dtypes: list of tuples (column name, numpy dtype)
+    :param start: index of first row
+    :param rows: number of rows
+    :param page_size: number of rows of pages
+    :param max_bytes: memory of stream after which it is spilled, the same as in ChunkedResult
+    :param spill_path: directory for spilled files
+    :return: finished ChunkedResult with rows of range
+    """
+    result = ChunkedResult(column_dtypes, max_bytes=max_bytes, spill_path=spill_path)
+    try:
+        with client_pool.client() as client:
+            row_iterator = client.list_rows(destination, selected_fields=schema, start_index=start,
+                                            max_results=rows, page_size=page_size)
+            for columns in iter_page_columns(row_iterator, column_dtypes):
+                result.append(columns)
+        result.finish()
+    except BaseException:
+        result.close()
+        raise
+    return result
+
+
+def read_streams(client_pool, destination, schema, column_dtypes, total_rows, streams,
+                 page_size=None, max_bytes=None, spill_path=None, start=0):
+    """
+    Reads result table by several parallel streams
+    :param client_pool: ClientPool used by streams
+    :param destination: result table of query job
+    :param schema: schema of result
+    :param column_dtypes: list of tuples (column name, numpy dtype)
+    :param total_rows: number of rows of result
+    :param streams: maximal number of parallel streams
+    :param page_size: number of rows of pages, also minimal number of rows of one stream
+    :param max_bytes: memory cap of all streams together, None for no cap
+    :param spill_path: directory for spilled files
+    :param start: index of first read row, earlier rows aren't read
+    :return: generator of lists of column arrays in order of rows of result
+    """
+    ranges = [(start + first, rows) for first, rows in split_rows(total_rows - start, streams, page_size or 1)]
+    if not ranges:
+        return
+    stream_bytes = None if max_bytes is None else max_bytes // len(ranges)
+    pool = Pool(len(ranges))
+    results = pool.imap(lambda bounds: read_stream(client_pool, destination, schema, column_dtypes,
+                                                   bounds[0], bounds[1], page_size, stream_bytes,
+                                                   spill_path),
+                        ranges)
+    pool.close()
+    try:
+        for _ in ranges:
+            with next(results) as result:
+                for columns in result.iter_columns(page_size):
+                    # spilled arrays are copied, files of stream are removed after it is read
+                    yield [np.array(column) for column in columns] if result.spilled else columns
+    finally:
+        # streams which weren't consumed (error or generator closed) are finished and removed
+        while True:
+            try:
+                result = next(results)
+            except StopIteration:
+                break
+            except Exception:
+                continue
+            result.close()
+        pool.join()
+
+
+def read_result(row_iterator, client_pool, destination, column_dtypes, streams,
+                page_size=None, max_bytes=None, spill_path=None):
+    """
+    Reads the first page of result from row iterator of query job (it is fetched together
+    with query results) and the rest of rows by several parallel streams
+    :param row_iterator: BigQuery RowIterator of finished query job
+    :param client_pool: ClientPool used by streams
+    :param destination: result table of query job
+    :param column_dtypes: list of tuples (column name, numpy dtype)
+    :param streams: maximal number of parallel streams
+    :param page_size: number of rows of pages, also minimal number of rows of one stream
+    :param max_bytes: memory cap of all streams together, None for no cap
+    :param spill_path: directory for spilled files
+    :return: generator of lists of column arrays in order of rows of result
+    """
+    total_rows = row_iterator.total_rows or 0
+    pages = iter_page_columns(row_iterator, column_dtypes)
+    first_page = next(pages, None)
+    pages.close()
+    start = 0
+    if first_page is not None:
+        start = len(first_page[0]) if first_page else 0
+        yield first_page
+    yield from read_streams(client_pool, destination, row_iterator.schema, column_dtypes, total_rows, streams,
+                            page_size=page_size, max_bytes=max_bytes, spill_path=spill_path, start=start)
@@ -0,0 +1,502 @@
+import numpy as np
+import pandas as pd
+
+events_table = "gdelt-bq.full.events"
+
+# types of events table columns used by functions
+event_column_types = {
+    'SQLDATE': 'INTEGER',
+    'MonthYear': 'INTEGER',
+    'Actor1CountryCode': 'STRING',
+    'Actor2CountryCode': 'STRING',
+    'Actor1Type1Code': 'STRING',
+    'Actor2Type1Code': 'STRING',
+    'EventRootCode': 'STRING',
+    'QuadClass': 'INTEGER',
+    'GoldsteinScale': 'FLOAT',
+    'NumMentions': 'INTEGER',
+    'AvgTone': 'FLOAT',
+    'Actor1Geo_CountryCode': 'STRING',
+    'Actor2Geo_CountryCode': 'STRING',
+    'ActionGeo_CountryCode': 'STRING',
+    'ActionGeo_Lat': 'FLOAT',
+    'ActionGeo_Long': 'FLOAT',
+}
+
+
+def next_month(month):
+    """
+    :param month: int month in format YYYYMM
+    :return: int next month in format YYYYMM
+    """
+    year, month = divmod(month, 100)
+    return year * 100 + month + 1 if month < 12 else (year + 1) * 100 + 1
+
+
+def months_between(start, end):
+    """
+    :param start: first month in format YYYYMM
+    :param end: month after last one in format YYYYMM
+    :return: list of int months [start, end)
+    """
+    months = []
+    month = int(start)
+    while month < int(end):
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+class Column:
+    """
+    Reference to column of table, can be used as filter value
+    i.e. ('Actor1Geo_CountryCode', '=', Column('Actor2Geo_CountryCode'))
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Column) and other.name == self.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return 'Column({!r})'.format(self.name)
+
+
+class Expression:
+    """
+    Value computed from columns of one row.
+    Defined by SQL text for BigQuery and function on numpy arrays for local execution
+    """
+
+    def __init__(self, sql, columns, function):
+        """
+        :param sql: SQL expression
+        :param columns: list of column names used by expression
+        :param function: function which takes column arrays in order of columns
+        and returns array of results
+        """
+        self.sql = sql
+        self.columns = columns
+        self.function = function
+
+    def evaluate(self, get_column):
+        """
+        :param get_column: function column name -> numpy array
+        :return: numpy array of expression values
+        """
+        return self.function(*[get_column(column) for column in self.columns])
+
+    def __repr__(self):
+        return 'Expression({!r})'.format(self.sql)
+
+
+tone_impact = Expression(
+    "(0.5 * AvgTone + GoldsteinScale) * NumMentions",
+    ['AvgTone', 'GoldsteinScale', 'NumMentions'],
+    lambda tone, goldstein, mentions: (0.5 * tone + goldstein) * mentions)
+
+mentions_tone = Expression(
+    "AvgTone * NumMentions",
+    ['AvgTone', 'NumMentions'],
+    lambda tone, mentions: tone * mentions)
+
+
+def format_value(column, value):
+    """
+    :param column: name of column compared with value
+    :param value: python value
+    :return: SQL literal for value
+    """
+    if isinstance(value, Column):
+        return value.name
+    if event_column_types.get(column) == 'STRING' or \
+            (column not in event_column_types and isinstance(value, str)):
+        return '"{}"'.format(value)
+    return str(value)
+
+
+def filter_columns(filters):
+    """
+    :param filters: list of filters of AggregateQuery
+    :return: list of columns used by filters, including columns of "or" filters
+    """
+    columns = []
+    for column, op, value in filters:
+        if op == 'or':
+            columns += filter_columns(value)
+            continue
+        columns.append(column)
+        if isinstance(value, Column):
+            columns.append(value.name)
+    return columns
+
+
+def format_argument(argument):
+    if isinstance(argument, Expression):
+        return argument.sql
+    return argument
+
+
+class QueryPlan:
+    """
+    Base class for logical queries over events table.
+    Query plan can be rendered as BigQuery SQL or executed by local engine
+    """
+
+    def to_sql(self):
+        """
+        :return: BigQuery SQL string
+        """
+        raise Exception("Method isn't defined")
+
+    def month_bounds(self):
+        """
+        :return: tuple (first month, month after last one) in format YYYYMM
+        of data needed by query, None on unbounded side
+        """
+        raise Exception("Method isn't defined")
+
+    def sampled(self, percent):
+        """
+        :param percent: percent of table blocks read by query
+        :return: approximate variant of plan which reads sample of table,
+        counts and sums are scaled to the whole table
+        """
+        raise Exception("Method isn't defined")
+
+    def __str__(self):
+        return self.to_sql()
+
+
+class PartialState:
+    """
+    Mergeable part of aggregate: sum of some value over rows of group.
+    Partial states of different parts of table can be added
+    """
+
+    def __init__(self, name, sql, evaluate, dtype):
+        """
+        :param name: name of result column
+        :param sql: SQL aggregate expression
+        :param evaluate: function get_column -> numpy array of values to be summed
+        :param dtype: numpy type of values
+        """
+        self.name = name
+        self.sql = sql
+        self.evaluate = evaluate
+        self.dtype = dtype
+
+
+def _values(argument, get_column):
+    if isinstance(argument, Expression):
+        return argument.evaluate(get_column)
+    return get_column(argument)
+
+
+def _not_null(values):
+    if values.dtype == object:
+        return pd.notnull(values)
+    if values.dtype.kind == 'f':
+        return ~np.isnan(values)
+    return np.ones(values.shape[0], dtype=bool)
+
+
+def _filled(values):
+    if values.dtype.kind == 'f':
+        return np.where(np.isnan(values), 0., values)
+    return values.astype(np.int64)
+
+
+class AggregateQuery(QueryPlan):
+    """
+    SELECT keys, aggregates FROM events WHERE filters GROUP BY keys ORDER BY order_by
+    keys - list of tuples (alias, column name)
+    measures - list of tuples (alias, function, argument), where function is one of:
+        "count" - COUNT(*) if argument is None else number of not null values,
+        "sum", "avg" - argument is column name or Expression,
+        "corr" - argument is tuple of two columns
+    filters - list of tuples (column name, operator, value), joined by AND.
+    Operators: "=", "!=", "<", "<=", ">", ">=", "in", "is null", "is not null".
+    Value can be Column to compare two columns.
+    Filter (None, "or", list of filters) matches rows which pass any of filters
+    order_by - list of aliases to sort result by
+    sample_percent - if set, query reads only this percent of table (TABLESAMPLE)
+    and counts and sums are scaled to the whole table
+    """
+
+    aggregate_functions = ('count', 'sum', 'avg', 'corr')
+
+    def __init__(self, keys, measures, filters=(), order_by=(), table=events_table, sample_percent=None):
+        for _, function, _ in measures:
+            assert function in self.aggregate_functions, "Unknown aggregate " + function
+        self.keys = list(keys)
+        self.measures = list(measures)
+        self.filters = list(filters)
+        self.order_by = list(order_by)
+        self.table = table
+        self.sample_percent = sample_percent
+
+    def sampled(self, percent):
+        return AggregateQuery(self.keys, self.measures, self.filters, self.order_by, self.table,
+                              sample_percent=percent)
+
+    def _scaled(self, sql):
+        """
+        :param sql: SQL aggregate expression
+        :return: expression scaled from sample to the whole table
+        """
+        if self.sample_percent is None:
+            return sql
+        return "{} * {}".format(sql, repr(100. / self.sample_percent))
+
+    def columns(self):
+        """
+        :return: list of result column names
+        """
+        return [alias for alias, _ in self.keys] + [alias for alias, _, _ in self.measures]
+
+    def _measure_sql(self, function, argument):
+        if function == 'count':
+            return "COUNT(*)" if argument is None else "COUNT({})".format(format_argument(argument))
+        if function == 'corr':
+            return "CORR({}, {})".format(*map(format_argument, argument))
+        return "{}({})".format(function.upper(), format_argument(argument))
+
+    def _filter_sql(self, column, operator, value):
+        if operator == 'or':
+            return "({})".format(" OR ".join(self._filter_sql(*condition) for condition in value))
+        if operator == 'in':
+            return "{} IN UNNEST([{}])".format(
+                column, ', '.join(format_value(column, item) for item in value))
+        if operator in ('is null', 'is not null'):
+            return "{} {}".format(column, operator.upper())
+        return "{} {} {}".format(column, operator, format_value(column, value))
+
+    def where_sql(self):
+        """
+        :return: SQL conditions of WHERE clause
+        """
+        return "\n        AND ".join(self._filter_sql(*condition) for condition in self.filters)
+
+    def _render(self, select, keys, order_by):
+        query = "\n        SELECT " + ",\n               ".join(select)
+        query += "\n        FROM `{}`".format(self.table)
+        if self.sample_percent is not None:
+            query += " TABLESAMPLE SYSTEM ({} PERCENT)".format(self.sample_percent)
+        if self.filters:
+            query += "\n        WHERE " + self.where_sql()
+        if keys:
+            query += "\n        GROUP BY " + ", ".join(keys)
+        if order_by:
+            query += "\n        ORDER BY " + ", ".join(order_by)
+        return query + "\n        "
+
+    def to_sql(self):
+        select = ["{} AS {}".format(column, alias) for alias, column in self.keys]
+        select += ["{} AS {}".format(self._scaled(self._measure_sql(function, argument))
+                                     if function in ('count', 'sum') else
+                                     self._measure_sql(function, argument), alias)
+                   for alias, function, argument in self.measures]
+        return self._render(select, [column for _, column in self.keys], self.order_by)
+
+    def partial_states(self):
+        """
+        :return: list of PartialState needed to compute measures
+        """
+        states = []
+        for alias, function, argument in self.measures:
+            if function == 'count':
+                if argument is None:
+                    states.append(PartialState(
+                        alias + '__n', "COUNT(*)",
+                        lambda get_column: np.ones(get_column.rows, dtype=np.int64), np.int64))
+                else:
+                    states.append(PartialState(
+                        alias + '__n', "COUNT({})".format(format_argument(argument)),
+                        lambda get_column, argument=argument:
+                        _not_null(_values(argument, get_column)).astype(np.int64), np.int64))
+            elif function in ('sum', 'avg'):
+                numeric_type = event_column_types.get(argument) == 'INTEGER'
+                states.append(PartialState(
+                    alias + '__sum', "SUM({})".format(format_argument(argument)),
+                    lambda get_column, argument=argument: _filled(_values(argument, get_column)),
+                    np.int64 if numeric_type else np.float64))
+                if function == 'avg':
+                    states.append(PartialState(
+                        alias + '__n', "COUNT({})".format(format_argument(argument)),
+                        lambda get_column, argument=argument:
+                        _not_null(_values(argument, get_column)).astype(np.int64), np.int64))
+            elif function == 'corr':
+                x, y = argument
+                both = "{0} IS NOT NULL AND {1} IS NOT NULL".format(
+                    format_argument(x), format_argument(y))
+
+                def pair(get_column, x=x, y=y):
+                    x_values = _values(x, get_column).astype(np.float64)
+                    y_values = _values(y, get_column).astype(np.float64)
+                    valid = ~(np.isnan(x_values) | np.isnan(y_values))
+                    return np.where(valid, x_values, 0.), np.where(valid, y_values, 0.), valid
+
+                states += [
+                    PartialState(alias + '__n', "COUNTIF({})".format(both),
+                                 lambda get_column, pair=pair: pair(get_column)[2].astype(np.int64),
+                                 np.int64),
+                    PartialState(alias + '__sx', "SUM(IF({}, {}, 0))".format(both, format_argument(x)),
+                                 lambda get_column, pair=pair: pair(get_column)[0], np.float64),
+                    PartialState(alias + '__sy', "SUM(IF({}, {}, 0))".format(both, format_argument(y)),
+                                 lambda get_column, pair=pair: pair(get_column)[1], np.float64),
+                    PartialState(alias + '__sxx', "SUM(IF({0}, {1} * {1}, 0))".format(both, format_argument(x)),
+                                 lambda get_column, pair=pair: pair(get_column)[0] ** 2, np.float64),
+                    PartialState(alias + '__syy', "SUM(IF({0}, {1} * {1}, 0))".format(both, format_argument(y)),
+                                 lambda get_column, pair=pair: pair(get_column)[1] ** 2, np.float64),
+                    PartialState(alias + '__sxy', "SUM(IF({}, {} * {}, 0))".format(
+                        both, format_argument(x), format_argument(y)),
+                                 lambda get_column, pair=pair: pair(get_column)[0] * pair(get_column)[1],
+                                 np.float64),
+                ]
+        return states
+
+    def to_partial_sql(self, extra_keys=()):
+        """
+        :param extra_keys: list of tuples (alias, column) of additional grouping columns
+        i.e. [('MonthYear', 'MonthYear')] to get partial results for each month
+        :return: SQL which returns partial states instead of final measures
+        """
+        keys = list(extra_keys) + self.keys
+        select = ["{} AS {}".format(column, alias) for alias, column in keys]
+        # all states are scaled by the same factor, so averages and correlations don't change
+        select += ["{} AS {}".format(self._scaled(state.sql), state.name) for state in self.partial_states()]
+        return self._render(select, [column for _, column in keys], [])
+
+    def finalize(self, partial):
+        """
+        Computes measures from partial states
+        :param partial: DataFrame with key columns and partial states
+        (result of to_partial_sql or local engine)
+        :return: DataFrame with the same columns as to_sql() result
+        """
+        df = pd.DataFrame({alias: partial[alias].values for alias, _ in self.keys},
+                          columns=[alias for alias, _ in self.keys])
+        for alias, function, _ in self.measures:
+            if function == 'count':
+                df[alias] = partial[alias + '__n'].values.astype(np.int64)
+            elif function == 'sum':
+                df[alias] = partial[alias + '__sum'].values
+            elif function == 'avg':
+                count = partial[alias + '__n'].values.astype(np.float64)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    df[alias] = np.where(count > 0, partial[alias + '__sum'].values / count, np.nan)
+            elif function == 'corr':
+                n = partial[alias + '__n'].values.astype(np.float64)
+                sx, sy = partial[alias + '__sx'].values, partial[alias + '__sy'].values
+                sxx, syy = partial[alias + '__sxx'].values, partial[alias + '__syy'].values
+                sxy = partial[alias + '__sxy'].values
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    corr = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx ** 2) * (n * syy - sy ** 2))
+                df[alias] = np.where(n > 1, corr, np.nan)
+        return sort_result(df, self.order_by)
+
+    def month_bounds(self):
+        start, end = None, None
+        for column, operator, value in self.filters:
+            if column not in ('MonthYear', 'SQLDATE') or isinstance(value, Column):
+                continue
+            if operator == 'in':
+                months = [int(item) if column == 'MonthYear' else int(item) // 100 for item in value]
+                low, high = min(months), next_month(max(months))
+            else:
+                value = int(value)
+                month = value if column == 'MonthYear' else value // 100
+                low, high = None, None
+                if operator in ('>=', '='):
+                    low = month
+                if operator == '>':
+                    low = next_month(month) if column == 'MonthYear' else month
+                if operator in ('<=', '='):
+                    high = next_month(month)
+                if operator == '<':
+                    high = month if column == 'MonthYear' or value % 100 == 1 else next_month(month)
+            if low is not None:
+                start = low if start is None else max(start, low)
+            if high is not None:
+                end = high if end is None else min(end, high)
+        return start, end
+
+
+class JoinQuery(QueryPlan):
+    """
+    Join of results of two query plans by key columns
+    """
+
+    def __init__(self, left, right, on, how='inner', order_by=()):
+        """
+        :param left: left QueryPlan
+        :param right: right QueryPlan
+        :param on: list of result column names present in both plans
+        :param how: "inner" or "left"
+        :param order_by: list of columns to sort result by
+        """
+        assert how in ('inner', 'left'), "Unknown join type " + how
+        self.left = left
+        self.right = right
+        self.on = list(on)
+        self.how = how
+        self.order_by = list(order_by)
+
+    def columns(self):
+        return self.left.columns() + [column for column in self.right.columns()
+                                      if column not in self.on]
+
+    def sampled(self, percent):
+        return JoinQuery(self.left.sampled(percent), self.right.sampled(percent),
+                         self.on, self.how, self.order_by)
+
+    def to_sql(self):
+        query = """
+        SELECT {columns}
+        FROM ({left}) AS l
+        {join} ({right}) AS r
+        USING ({on})""".format(
+            columns=', '.join(self.columns()),
+            left=self.left.to_sql(),
+            right=self.right.to_sql(),
+            join='LEFT JOIN' if self.how == 'left' else 'JOIN',
+            on=', '.join(self.on))
+        if self.order_by:
+            query += "\n        ORDER BY " + ", ".join(self.order_by)
+        return query + "\n        "
+
+    def join(self, left_df, right_df):
+        """
+        Joins results of subqueries with SQL semantics (NULL keys never match)
+        :return: DataFrame with the same columns as to_sql() result
+        """
+        valid_right = right_df[self.on].notnull().all(axis=1)
+        right_df = right_df[valid_right]
+        if self.how == 'inner':
+            left_df = left_df[left_df[self.on].notnull().all(axis=1)]
+        df = left_df.merge(right_df, on=self.on, how=self.how)
+        return sort_result(df[self.columns()], self.order_by)
+
+    def month_bounds(self):
+        left_start, left_end = self.left.month_bounds()
+        right_start, right_end = self.right.month_bounds()
+        start = None if left_start is None or right_start is None else min(left_start, right_start)
+        end = None if left_end is None or right_end is None else max(left_end, right_end)
+        return start, end
+
+
+def sort_result(df, order_by):
+    """
+    Sorts DataFrame the same way as BigQuery ORDER BY (NULLs first)
+    :param df: DataFrame
+    :param order_by: list of column names
+    :return: sorted DataFrame with default index
+    """
+    if order_by:
+        df = df.sort_values(list(order_by), kind='mergesort', na_position='first')
+    return df.reset_index(drop=True)
@@ -0,0 +1,78 @@
+"""
+Splitting of month ranges into shards executed concurrently.
+Events of different months differ in size by orders of magnitude
+(first years of GDELT have few events per month), so shards are built
+from contiguous months of similar total cost. Cost of month is learned
+from latencies of earlier shards which included it.
+"""
+import threading
+
+
+class ShardPlanner:
+    """
+    Observed cost (seconds of query time) of each month and splitting of months into shards
+    """
+
+    def __init__(self, min_shard_seconds=0, smoothing=0.5):
+        """
+        :param min_shard_seconds: shards aren't made cheaper than this, so short ranges
+        aren't split into many small queries, used after costs of months are known
+        :param smoothing: weight of new observation in moving average of month cost
+        """
+        self.min_shard_seconds = min_shard_seconds
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.costs = {}
+
+    def record(self, months, seconds):
+        """
+        Spreads time of shard query over its months proportionally to their known costs
+        :param months: list of int months of shard
+        :param seconds: time of shard query
+        :return: nothing
+        """
+        if not months:
+            return
+        weights = self.month_costs(months)
+        total = sum(weights)
+        with self.lock:
+            for month, weight in zip(months, weights):
+                cost = seconds * weight / total if total > 0 else seconds / len(months)
+                old = self.costs.get(month)
+                self.costs[month] = cost if old is None else \
+                    self.smoothing * cost + (1 - self.smoothing) * old
+
+    def month_costs(self, months):
+        """
+        :param months: list of int months
+        :return: list of costs of months, months without observations get mean cost of known months
+        (1 if no month is known)
+        """
+        with self.lock:
+            known = list(self.costs.values())
+            default = sum(known) / len(known) if known else 1.
+            return [self.costs.get(month, default) for month in months]
+
+    def split(self, months, shards):
+        """
+        :param months: list of int months
+        :param shards: maximal number of shards
+        :return: list of lists of contiguous months with similar total costs
+        """
+        months = sorted(months)
+        if shards <= 1 or len(months) <= 1:
+            return [months] if months else []
+        costs = self.month_costs(months)
+        with self.lock:
+            observed = any(month in self.costs for month in months)
+        target = sum(costs) / min(shards, len(months))
+        if observed:
+            target = max(target, self.min_shard_seconds)
+        # month belongs to shard in which middle of its cost falls
+        result = {}
+        accumulated = 0.
+        for month, cost in zip(months, costs):
+            shard = min(shards - 1, int((accumulated + cost / 2) / target)) if target > 0 else 0
+            result.setdefault(shard, []).append(month)
+            accumulated += cost
+        return [result[shard] for shard in sorted(result)]
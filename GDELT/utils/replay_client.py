@@ -0,0 +1,253 @@
+"""
+Recording of queries and replaying them without BigQuery, for offline load and latency tests.
+Recording client wraps real client and saves result rows, schema, processed bytes
+and latency profile (time until result is ready and time of reading its pages)
+of each query into one file per query. Replay client serves saved results
+with the same (or scaled) latencies, so the whole server can be driven
+at production concurrency without paying for queries.
+"""
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+import threading
+import collections
+from concurrent.futures import CancelledError
+from google.api_core import exceptions as api_exceptions
+
+from .local_client import SchemaField, Row, RowIterator, QueryJob
+
+# number of replayed results kept in memory
+loaded_recordings = 16
+
+
+def recording_key(query, dry_run=False):
+    """
+    :param query: SQL query
+    :param dry_run: True for recording of estimate of query
+    :return: name of recording file, queries which differ only in whitespace have the same name
+    """
+    text = ('dry_run:' if dry_run else '') + ' '.join(query.split())
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def write_recording(path, key, recording):
+    """
+    Writes recording atomically, so concurrent replays never see partial file
+    :param path: directory of recordings
+    :param key: result of recording_key
+    :param recording: dictionary with query, schema, rows, bytes and latencies
+    :return: nothing
+    """
+    os.makedirs(path, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=path, suffix='.tmp')
+    with os.fdopen(descriptor, 'wb') as target:
+        pickle.dump(recording, target, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, os.path.join(path, key + '.pkl'))
+
+
+def read_recording(path, key):
+    """
+    :return: recording written by write_recording, None if there is no such
+    """
+    try:
+        with open(os.path.join(path, key + '.pkl'), 'rb') as source:
+            return pickle.load(source)
+    except FileNotFoundError:
+        return None
+
+
+class RecordingJob:
+    """
+    Query job which saves result of wrapped job when it is read
+    """
+
+    def __init__(self, job, path, started):
+        self._job = job
+        self.path = path
+        self.started = started
+        self.query = job.query
+        # result is read by one stream, so it is recorded completely
+        self.destination = None
+
+    @property
+    def total_bytes_processed(self):
+        return self._job.total_bytes_processed
+
+    @property
+    def total_bytes_billed(self):
+        return self._job.total_bytes_billed
+
+    def cancel(self):
+        return self._job.cancel()
+
+    def result(self, page_size=None):
+        """
+        Waits for result of wrapped job, reads all its pages and saves them with their latencies
+        :return: RowIterator of recorded rows
+        """
+        row_iterator = self._job.result(page_size=page_size)
+        query_seconds = time.time() - self.started
+        rows = []
+        page_seconds = []
+        read_started = time.time()
+        for page in row_iterator.pages:
+            rows.extend(tuple(row.values()) for row in page)
+            page_seconds.append(time.time() - read_started)
+            read_started = time.time()
+        schema = [(field.name, field.field_type) for field in row_iterator.schema]
+        write_recording(self.path, recording_key(self.query), {
+            'query': self.query,
+            'schema': schema,
+            'rows': rows,
+            'total_bytes_processed': self._job.total_bytes_processed,
+            'total_bytes_billed': self._job.total_bytes_billed,
+            'query_seconds': query_seconds,
+            'download_seconds': sum(page_seconds),
+        })
+        return RowIterator([SchemaField(name, field_type) for name, field_type in schema], rows,
+                           page_size=page_size or 10000)
+
+
+class RecordingClient:
+    """
+    Client which passes queries to wrapped client and records them
+    """
+
+    def __init__(self, client, path):
+        """
+        :param client: BigQuery client or its stand-in
+        :param path: directory of recordings
+        """
+        self.client = client
+        self.path = path
+
+    def query(self, query, job_config=None):
+        started = time.time()
+        job = self.client.query(query, job_config=job_config)
+        if getattr(job_config, 'dry_run', False):
+            write_recording(self.path, recording_key(query, True), {
+                'query': query,
+                'total_bytes_processed': job.total_bytes_processed,
+                'query_seconds': time.time() - started,
+            })
+            return job
+        return RecordingJob(job, self.path, started)
+
+    def list_rows(self, *args, **kwargs):
+        return self.client.list_rows(*args, **kwargs)
+
+
+class ReplayRowIterator(RowIterator):
+    """
+    RowIterator which delays each page by recorded download time of its rows
+    """
+
+    def __init__(self, schema, rows, page_size, row_seconds):
+        super().__init__(schema, rows, page_size=page_size)
+        self.row_seconds = row_seconds
+
+    @property
+    def pages(self):
+        for start in range(0, len(self._rows), self.page_size):
+            page = self._rows[start:start + self.page_size]
+            time.sleep(len(page) * self.row_seconds)
+            yield [Row(values) for values in page]
+
+
+class ReplayJob(QueryJob):
+    """
+    Job of recorded query, its result is ready after recorded (scaled) query time
+    since submission, unless job is cancelled
+    """
+
+    def __init__(self, client, key, recording, dry_run):
+        super().__init__(recording['query'], dry_run, recording.get('total_bytes_processed') or 0,
+                         destination=None if dry_run else '_replay_results.{}'.format(key))
+        if recording.get('total_bytes_billed') is not None:
+            self.total_bytes_billed = recording['total_bytes_billed']
+        self.client = client
+        self.key = key
+        self.ready_at = time.time() + recording['query_seconds'] * client.latency_scale
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        return True
+
+    def result(self, page_size=None):
+        if self.dry_run:
+            raise Exception("Dry run job has no result")
+        if self.cancelled.wait(max(0., self.ready_at - time.time())):
+            raise CancelledError()
+        return self.client.list_rows(self.destination, page_size=page_size)
+
+
+class ReplayClient:
+    """
+    Client with interface of google.cloud.bigquery.Client which serves recorded queries
+    """
+
+    def __init__(self, path, latency_scale=1.):
+        """
+        :param path: directory of recordings
+        :param latency_scale: recorded latencies are multiplied by it, 0 for no delays
+        """
+        self.path = path
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        # key -> recording of recently replayed queries
+        self.recordings = collections.OrderedDict()
+
+    def _recording(self, key, query=None, required=True):
+        """
+        :return: recording of key, None if it doesn't exist and isn't required
+        :raise NotFound if required recording doesn't exist
+        """
+        with self.lock:
+            if key in self.recordings:
+                self.recordings.move_to_end(key)
+                return self.recordings[key]
+        recording = read_recording(self.path, key)
+        if recording is None:
+            if not required:
+                return None
+            raise api_exceptions.NotFound("No recording of query {}".format(
+                ' '.join(query.split()) if query is not None else key))
+        with self.lock:
+            self.recordings[key] = recording
+            while len(self.recordings) > loaded_recordings:
+                self.recordings.popitem(last=False)
+        return recording
+
+    def query(self, query, job_config=None):
+        """
+        :param query: SQL query which was recorded
+        :param job_config: optional QueryJobConfig, only dry_run is used
+        :return: ReplayJob
+        :raise NotFound if query wasn't recorded
+        """
+        if getattr(job_config, 'dry_run', False):
+            recording = self._recording(recording_key(query, True), required=False)
+            if recording is not None:
+                time.sleep(recording['query_seconds'] * self.latency_scale)
+            else:
+                # estimate of query which was recorded only when executed
+                recording = self._recording(recording_key(query), query)
+            return ReplayJob(self, None, recording, True)
+        key = recording_key(query)
+        return ReplayJob(self, key, self._recording(key, query), False)
+
+    def list_rows(self, table, selected_fields=None, start_index=0, max_results=None, page_size=None):
+        """
+        Reads range of rows of recorded result, the same as BigQuery list_rows,
+        pages are delayed by recorded download time of their rows
+        """
+        recording = self._recording(table.split('.')[-1])
+        rows = recording['rows']
+        end = len(rows) if max_results is None else start_index + max_results
+        schema = selected_fields or [SchemaField(name, field_type) for name, field_type in recording['schema']]
+        row_seconds = recording['download_seconds'] / len(rows) if rows else 0.
+        return ReplayRowIterator(schema, rows[start_index:end], page_size or 10000,
+                                 row_seconds * self.latency_scale)
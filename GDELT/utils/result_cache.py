@@ -0,0 +1,393 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+
+from .code_dictionary import is_code_dtype
+
+index_file = "index.sqlite3"
+meta_file = "meta.json"
+
+
+def normalize_query(query):
+    """
+    :param query: string SQL query
+    :return: query with collapsed whitespace,
+    so formatting differences don't produce different cache entries
+    """
+    return ' '.join(query.split())
+
+
+def query_key(query):
+    """
+    :param query: string SQL query
+    :return: hex digest used as cache key
+    """
+    return hashlib.sha1(normalize_query(query).encode('utf-8')).hexdigest()
+
+
+def typed_query(query, dtypes=None):
+    """
+    :param query: string SQL query
+    :param dtypes: optional dictionary column name -> numpy dtype which overrides types of result
+    :return: text identifying cache entry of result read with dtypes, query itself if dtypes
+    don't change stored columns (code columns are stored as strings)
+    """
+    overrides = sorted((name, np.dtype(dtype).str) for name, dtype in (dtypes or {}).items()
+                       if not is_code_dtype(dtype))
+    if not overrides:
+        return query
+    return '{} /* dtypes: {} */'.format(query, ', '.join('{} {}'.format(name, dtype) for name, dtype in overrides))
+
+
+def write_columns(path, df):
+    """
+    Writes each column of DataFrame into separate .npy file.
+    String columns are dictionary encoded (int32 codes + unicode values),
+    so every column can be memory-mapped on read
+    :param path: directory for files
+    :param df: DataFrame with plain (not MultiIndex) columns
+    :return: list of column descriptions to be saved as metadata
+    """
+    columns = []
+    for i, name in enumerate(df.columns):
+        values = df[name].values
+        column = {'name': name, 'file': '{}.npy'.format(i)}
+        if values.dtype == object or not isinstance(values, np.ndarray):
+            codes, uniques = pd.factorize(values if isinstance(values, pd.Categorical)
+                                          else np.asarray(values, dtype=object))
+            if all(isinstance(value, str) for value in uniques):
+                column['kind'] = 'strings'
+                column['values_file'] = '{}.values.npy'.format(i)
+                np.save(os.path.join(path, column['file']), codes.astype(np.int32))
+                np.save(os.path.join(path, column['values_file']),
+                        np.array(list(uniques), dtype=str))
+            else:
+                column['kind'] = 'object'
+                np.save(os.path.join(path, column['file']),
+                        np.asarray(values, dtype=object), allow_pickle=True)
+        else:
+            column['kind'] = 'array'
+            np.save(os.path.join(path, column['file']), values)
+        columns.append(column)
+    return columns
+
+
+def open_column(path, column):
+    """
+    Opens column written by write_columns or by ChunkedResult.
+    Columns with "dtype" in description are raw binary files of this dtype,
+    columns of kind "pickled" are sequences of pickled arrays
+    :param path: directory with files
+    :param column: column description
+    :return: tuple (values, dictionary): numeric values or codes of strings memory-mapped
+    copy-on-write when possible, dictionary is array of strings of string column, None otherwise
+    """
+    file_path = os.path.join(path, column['file'])
+    if column['kind'] == 'object':
+        return np.load(file_path, allow_pickle=True), None
+    if column['kind'] == 'pickled':
+        parts = []
+        with open(file_path, 'rb') as source:
+            for _ in range(column['chunks']):
+                parts.append(pickle.load(source))
+        return (np.concatenate(parts) if parts else np.empty(0, dtype=object)), None
+    if 'dtype' in column:
+        if column['rows'] == 0:
+            values = np.empty(0, dtype=column['dtype'])
+        else:
+            values = np.memmap(file_path, dtype=column['dtype'], mode='c', shape=(column['rows'],))
+    else:
+        values = np.load(file_path, mmap_mode='c')
+    if column['kind'] == 'strings':
+        return values, np.load(os.path.join(path, column['values_file'])).astype(object)
+    return values, None
+
+
+def decode_column(values, dictionary, start=None, stop=None):
+    """
+    :param values: values returned by open_column
+    :param dictionary: dictionary returned by open_column
+    :param start: first row, by default 0
+    :param stop: row after last one, by default end of column
+    :return: numpy array with values of rows [start, stop), string columns are decoded
+    """
+    values = values[start:stop]
+    if dictionary is None:
+        return values
+    decoded = np.empty(values.shape[0], dtype=object)
+    decoded[:] = None
+    known = values >= 0
+    decoded[known] = dictionary[values[known]]
+    return decoded
+
+
+def categorical_column(values, dictionary):
+    """
+    :param values: values returned by open_column
+    :param dictionary: dictionary returned by open_column
+    :return: numeric values, string columns as pandas Categorical with stored codes
+    and dictionary as categories, so strings aren't decoded for each row
+    """
+    if dictionary is None:
+        return values
+    return pd.Categorical.from_codes(values, categories=pd.Index(dictionary, dtype=object))
+
+
+def decode_categoricals(df, keep=()):
+    """
+    Decodes Categorical columns into object arrays of strings (None for NULL)
+    :param df: DataFrame, i.e. returned by read_columns
+    :param keep: names of columns which stay Categorical
+    :return: the same DataFrame
+    """
+    for name in df.columns:
+        if name not in keep and isinstance(df[name].dtype, pd.CategoricalDtype):
+            values = df[name].array
+            df[name] = decode_column(values.codes, values.categories.to_numpy(dtype=object))
+    return df
+
+
+def read_columns(path, columns, decoders=None):
+    """
+    Reads columns written by write_columns.
+    Numeric columns are memory-mapped copy-on-write, so they aren't copied
+    and can still be modified by caller, string columns are returned as Categoricals
+    of their stored codes and dictionary
+    :param path: directory with files
+    :param columns: list of column descriptions
+    :param decoders: optional dictionary column name -> function (values, dictionary) -> array,
+    used instead of categorical_column for arguments returned by open_column
+    :return: DataFrame
+    """
+    decoders = decoders or {}
+    data = {}
+    for column in columns:
+        decoder = decoders.get(column['name'], categorical_column)
+        data[column['name']] = decoder(*open_column(path, column))
+    return pd.DataFrame(data, columns=[column['name'] for column in columns], copy=False)
+
+
+def directory_size(path):
+    """
+    :param path: directory
+    :return: total size of files in directory in bytes
+    """
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+class ResultCache:
+    """
+    Persistent cache of query results.
+    Each entry is a directory of memory-mappable column files,
+    entries are tracked by SQLite index, so cache survives restarts
+    and can be shared by all processes on the host.
+    Cache is bounded by byte budget with least recently used eviction,
+    each entry can have its own time to live.
+    """
+
+    def __init__(self, path, max_bytes, default_ttl=None):
+        """
+        :param path: directory for cache files
+        :param max_bytes: maximal total size of stored results
+        :param default_ttl: time to live of entries in seconds, None for no expiration
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        os.makedirs(self.path, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    directory TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    expires REAL)""")
+
+    def _connect(self):
+        connection = sqlite3.connect(os.path.join(self.path, index_file),
+                                     timeout=30,
+                                     isolation_level=None)
+        return _Transaction(connection)
+
+    def get(self, query, decoders=None):
+        """
+        :param query: string SQL query
+        :param decoders: optional decoders of columns, the same as in read_columns
+        :return: cached DataFrame or None if there is no valid entry
+        """
+        entry = self.get_entry(query)
+        if entry is None:
+            return None
+        try:
+            return read_columns(*entry, decoders=decoders)
+        except (IOError, OSError, ValueError):
+            # entry was replaced or evicted by other process
+            return None
+
+    def get_entry(self, query):
+        """
+        :param query: string SQL query
+        :return: tuple (directory of entry, list of column descriptions)
+        or None if there is no valid entry
+        """
+        key = query_key(query)
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT directory, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            directory, expires = row
+            if expires is not None and expires <= now:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._remove_directory(directory)
+                return None
+            connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        entry_path = os.path.join(self.path, directory)
+        try:
+            with open(os.path.join(entry_path, meta_file), 'r') as source:
+                return entry_path, json.load(source)['columns']
+        except (IOError, OSError, ValueError):
+            return None
+
+    def contains(self, query):
+        """
+        :param query: string SQL query
+        :return: True if cache has valid entry for query
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT expires FROM entries WHERE key = ?", (query_key(query),)).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    def put(self, query, df, ttl=-1):
+        """
+        Stores query result. Replaces previous entry for the same query
+        :param query: string SQL query
+        :param df: DataFrame with result of query
+        :param ttl: time to live in seconds, None for no expiration,
+        by default ttl of cache is used
+        :return: nothing
+        """
+        tmp_path = self.make_tmp_directory()
+        try:
+            columns = write_columns(tmp_path, df)
+            self.put_directory(query, tmp_path, columns, ttl)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def make_tmp_directory(self):
+        """
+        :return: new directory inside cache, which can be moved into cache by put_directory
+        """
+        tmp_path = os.path.join(self.path, 'tmp-' + uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        return tmp_path
+
+    def put_directory(self, query, path, columns, ttl=-1):
+        """
+        Stores query result which is already written into directory,
+        directory is moved into cache. Replaces previous entry for the same query
+        :param query: string SQL query
+        :param path: directory with column files
+        :param columns: list of column descriptions
+        :param ttl: time to live in seconds, None for no expiration,
+        by default ttl of cache is used
+        :return: True if result was stored, False if it is larger than cache
+        (directory is left in place then)
+        """
+        if ttl == -1:
+            ttl = self.default_ttl
+        key = query_key(query)
+        directory = '{}.{}'.format(key, uuid.uuid4().hex)
+        with open(os.path.join(path, meta_file), 'w') as target:
+            json.dump({'query': normalize_query(query), 'columns': columns}, target)
+        size = directory_size(path)
+        if size > self.max_bytes:
+            return False
+        shutil.move(path, os.path.join(self.path, directory))
+
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT directory FROM entries WHERE key = ?", (key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (key, directory, size, now, now, expires))
+            if row is not None:
+                self._remove_directory(row[0])
+            self._evict(connection, now)
+        return True
+
+    def invalidate(self, query):
+        """
+        Removes entry for query if it exists
+        :param query: string SQL query
+        :return: nothing
+        """
+        key = query_key(query)
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT directory FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._remove_directory(row[0])
+
+    def _evict(self, connection, now):
+        """
+        Removes expired entries, then least recently used entries
+        until total size fits into byte budget.
+        Must be called inside transaction
+        """
+        expired = connection.execute(
+            "SELECT key, directory FROM entries WHERE expires IS NOT NULL AND expires <= ?",
+            (now,)).fetchall()
+        for key, directory in expired:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._remove_directory(directory)
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        for key, directory, size in connection.execute(
+                "SELECT key, directory, size FROM entries ORDER BY accessed").fetchall():
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._remove_directory(directory)
+            total_size -= size
+            if total_size <= self.max_bytes:
+                break
+
+    def _remove_directory(self, directory):
+        shutil.rmtree(os.path.join(self.path, directory), ignore_errors=True)
+
+
+class _Transaction:
+    """
+    Context manager for SQLite connection,
+    which holds write lock of database during block and closes connection after it
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.connection.execute("COMMIT")
+            else:
+                self.connection.execute("ROLLBACK")
+        finally:
+            self.connection.close()
@@ -0,0 +1,176 @@
+import zlib
+import time
+import pickle
+import threading
+import collections
+
+from .utils import job_result_ttl, job_results_max_bytes
+
+# zlib level of stored results, plot html compresses several times already at low levels
+compression_level = 3
+
+# kinds of stored values
+text_value = 0
+bytes_value = 1
+object_value = 2
+
+
+class JobExpired(Exception):
+    """
+    Raised for job id whose result was evicted from result store (or which is unknown,
+    i.e. it was submitted before restart of server), request has to be submitted again
+    """
+
+    def __init__(self, job_uuid):
+        super().__init__("Result of job {} expired, submit request again".format(job_uuid))
+        self.job_uuid = job_uuid
+
+
+def compress_value(value):
+    """
+    :param value: string (html or JSON), bytes or other picklable object
+    :return: tuple (kind of value, compressed bytes)
+    """
+    if isinstance(value, str):
+        return text_value, zlib.compress(value.encode('utf-8'), compression_level)
+    if isinstance(value, bytes):
+        return bytes_value, zlib.compress(value, compression_level)
+    return object_value, zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), compression_level)
+
+
+def decompress_value(kind, data):
+    """
+    :return: value compressed by compress_value
+    """
+    data = zlib.decompress(data)
+    if kind == text_value:
+        return data.decode('utf-8')
+    if kind == bytes_value:
+        return data
+    return pickle.loads(data)
+
+
+class ResultStore:
+    """
+    In-memory store of compressed results with TTL of each entry
+    and total size limit, least recently used entries are evicted first.
+    Expired entries are removed by every operation of store (not only by put),
+    so they don't stay in memory of idle server
+    """
+
+    def __init__(self, max_bytes=job_results_max_bytes, ttl=job_result_ttl, on_evict=None):
+        """
+        :param max_bytes: maximal total size of compressed entries, None for no limit
+        :param ttl: default seconds for which entry is kept, None to keep entries until evicted by size
+        :param on_evict: function called with key of each expired or evicted entry
+        (not called for deleted or replaced entries), it is called without lock of store
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        # key -> tuple (kind, compressed bytes, expiration time), in order of use
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+
+    def put(self, key, value, ttl=None):
+        """
+        Compresses and stores value, expired and least recently used entries are evicted
+        :param key: hashable key
+        :param value: value accepted by compress_value
+        :param ttl: seconds for which entry is kept, default ttl of store if None
+        :return: nothing
+        """
+        kind, data = compress_value(value)
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (kind, data, expires)
+            self.nbytes += len(data)
+            evicted = self._evict()
+        self._notify(evicted)
+
+    def get(self, key):
+        """
+        :param key: key of entry
+        :return: decompressed value, entry becomes the most recently used
+        :raise KeyError if there is no such entry or it expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            expired = entry is not None and entry[2] is not None and entry[2] <= time.time()
+            if entry is not None and not expired:
+                self.entries.move_to_end(key)
+            elif expired:
+                self._remove(key)
+        if entry is None or expired:
+            if expired:
+                self._notify([key])
+            raise KeyError(key)
+        return decompress_value(entry[0], entry[1])
+
+    def __contains__(self, key):
+        self.expire()
+        with self.lock:
+            return key in self.entries
+
+    def expire(self):
+        """
+        Removes expired entries, on_evict is called for each of them
+        :return: number of removed entries
+        """
+        with self.lock:
+            expired = self._expire()
+        self._notify(expired)
+        return len(expired)
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+            expired = self._expire()
+        self._notify(expired)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[1])
+
+    def _expire(self):
+        """
+        Removes expired entries, must hold lock
+        :return: list of removed keys
+        """
+        now = time.time()
+        expired = [key for key, (_, _, expires) in self.entries.items()
+                   if expires is not None and expires <= now]
+        for key in expired:
+            self._remove(key)
+        return expired
+
+    def _evict(self):
+        """
+        Removes expired entries and least recently used entries over size limit, must hold lock
+        :return: list of removed keys
+        """
+        evicted = self._expire()
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            self._remove(key)
+            evicted.append(key)
+        return evicted
+
+    def _notify(self, keys):
+        if self.on_evict is not None:
+            for key in keys:
+                self.on_evict(key)
+
+    def get_stats(self):
+        """
+        :return: dictionary with number of entries and their compressed size
+        """
+        with self.lock:
+            expired = self._expire()
+            stats = {'entries': len(self.entries), 'bytes': self.nbytes}
+        self._notify(expired)
+        return stats
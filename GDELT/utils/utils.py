@@ -3,6 +3,30 @@ import pandas as pd
 from google.cloud import bigquery
 import functools
 import threading
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, FIRST_COMPLETED
+from multiprocessing.dummy import Pool
+from .columnar import rows_to_dataframe, format_result_dataframe, schema_dtypes, iter_page_columns, \
+    rechunk_columns, columns_to_dataframe
+from .result_cache import ResultCache, typed_query, decode_categoricals
+from .chunked_result import ChunkedResult
+from .code_dictionary import global_dictionary, code_dtype, is_code_dtype
+from .query_plan import QueryPlan, JoinQuery, next_month
+from .month_partials import plan_months, months_query, split_months, merge_partials
+from .watermark import BackgroundRefresher, is_closed, range_ttl
+from .local_client import LocalClient
+from .replay_client import RecordingClient, ReplayClient
+from .client_pool import ClientPool
+from .parallel_download import read_result
+from .hedging import LatencyHistory, is_transient, is_timeout, backoff_delays
+from .range_shards import ShardPlanner
+from .micro_batch import QueryBatcher
+from .estimates import EstimateMemo
+from ..storage.event_store import EventStore
+from ..storage.local_engine import LocalEngine
+from ..storage.rollup import RollupCube
+from ..storage.config import local_store_path, rollup_path
 
 resource_path = "GDELT/resources"
 bigquery_credentials = "google_cloud_credentials.json"
@@ -20,6 +44,121 @@ fips_iso = "fips-iso-country.csv"
 actor1_geo_count_file = "actor1_geo_count.csv"
 actor2_geo_count_file = "actor2_geo_count.csv"
 
+# on-disk query result cache, set path to None to disable caching
+result_cache_path = "GDELT/cache/results"
+result_cache_max_bytes = 4 * 1024 ** 3
+result_cache_ttl = 24 * 60 * 60
+# query plans over month ranges are cached as partial aggregates of each month,
+# so ranges which overlap with already executed ones fetch only missing months
+month_partials_enabled = True
+# results which include open (current) month live only for short time
+# and are refreshed in background while they are requested,
+# results of closed months never expire
+open_month_ttl = 15 * 60
+open_month_refresh_window = 60 * 60
+
+# backend for queries given as query plans: "bigquery" or "local".
+# Local backend reads local event store and falls back to BigQuery
+# if store doesn't have all data needed by query
+query_backend = "local"
+# paths of local event store and rollup cube are set in GDELT/storage/config.py
+
+# client executing SQL queries: "bigquery", "local" (stand-in client
+# which runs queries in SQLite over local event store, for development and tests)
+# or "replay" (serves queries recorded in recordings_path with recorded latencies
+# multiplied by replay_latency_scale, for offline load tests, see GDELT/utils/load_test.py)
+query_client = "bigquery"
+# if True, results and latencies of queries executed by client are recorded into recordings_path
+record_queries = False
+recordings_path = "GDELT/cache/recordings"
+replay_latency_scale = 1.
+
+# maximal estimated bytes processed by queries of one function request,
+# None for no limit. Budgets of single functions can be set by function name
+query_bytes_budget = 500 * 1024 ** 3
+function_bytes_budgets = {
+    # 'event_density_timeline': 100 * 1024 ** 3,
+}
+
+# dry run estimates of queries are kept for estimate_ttl seconds (events table grows,
+# so they get outdated), estimates of ranges including open month for open_month_ttl.
+# At most estimate_memo_size least recently used estimates are kept
+estimate_ttl = 6 * 60 * 60
+estimate_memo_size = 10000
+
+# number of BigQuery clients in pool, it is also the maximal number
+# of queries executed at the same time by async API of QueryExecutor
+query_concurrency = 8
+
+# results fetched from BigQuery are read by chunks of this number of rows,
+# result which takes more memory than result_memory_max_bytes is spilled
+# to temporary files (inside result cache directory if cache is enabled)
+result_chunk_rows = 100000
+result_memory_max_bytes = 256 * 1024 ** 2
+spill_path = None
+# results with at least this number of rows are downloaded by several
+# parallel read streams (each reads range of rows of result table),
+# None to always read result by one stream
+parallel_download_rows = 1000000
+download_streams = 4
+
+# query which hasn't finished by this percentile of latencies of earlier queries
+# of the same function is submitted again, the first finished job is used
+# and the other one is cancelled. None to disable hedging.
+# Latencies of latency_history_size latest queries of each function are kept,
+# queries aren't hedged before hedge_min_samples of them are known
+hedge_percentile = 95
+hedge_min_delay = 2
+latency_history_size = 200
+hedge_min_samples = 20
+# months of query plans fetched from BigQuery are split into at most range_shards
+# contiguous shards of similar cost, which are executed concurrently and merged.
+# Cost of months is learned from time of earlier shards, shards aren't made
+# cheaper than range_shard_min_seconds. 1 to fetch all months with one query.
+# Sharding trades cost for latency: events table isn't partitioned, so every shard
+# is billed for whole columns it reads and n shards cost n times more (estimates
+# of function cost include all shards, so requests are rejected by budget sooner).
+# Months are therefore sharded only with local client or if events_table_partitioned
+# is set (copy of events table partitioned or clustered by MonthYear, where shard
+# reads only its months), with BigQuery events table they are fetched with one query
+range_shards = query_concurrency
+range_shard_min_seconds = 5
+events_table_partitioned = False
+
+# concurrent queries which differ only in country filter (i.e. the same function
+# opened for different countries) are collected for batch_window seconds
+# and fetched with one query grouped by country, None to disable batching.
+# Query waits only if query of the same shape came in the last 10 windows,
+# otherwise it is fetched at once (single requests aren't delayed)
+batch_window = 0.1
+batch_max_values = 50
+
+# percent of events table read by sampled preview of function result
+# (see FunctionUtil.get_preview), None to disable previews
+preview_sample_percent = 1
+
+# function jobs are kept in job broker database at job_broker_path (shared by all
+# web server processes) and executed by worker processes started with
+# python -m GDELT.utils.job_broker, None to execute them in pool of web server process.
+# Task of worker which stopped reporting for job_lease seconds is executed again,
+# at most job_max_attempts times
+job_broker_path = None
+job_worker_threads = 4
+job_poll_interval = 0.2
+job_lease = 30
+job_max_attempts = 3
+
+# finished results of function jobs (plot html) are kept compressed for job_result_ttl seconds,
+# least recently used results are evicted when they take more than job_results_max_bytes.
+# Job ids of evicted results get "expired" status, so request has to be submitted again
+job_result_ttl = 60 * 60
+job_results_max_bytes = 256 * 1024 ** 2
+
+# transient errors of queries are retried with exponential backoff with jitter
+query_retries = 3
+retry_base_delay = 1
+retry_max_delay = 30
+
 lock = threading.Lock()
 
 
@@ -50,20 +189,373 @@ class Singleton(type):
 
 class QueryExecutor(metaclass=Singleton):
     """
-    class for execution of BigQuery queries
+    class for execution of queries in BigQuery or in local event store
     """
 
     def __init__(self):
-        self.client = bigquery.Client.from_service_account_json(
-            resource_path + '/' + bigquery_credentials)
+        self._client = None
+        self.client_lock = threading.Lock()
+        self._local_engine = None
+        self.engine_lock = threading.Lock()
+        self.rollup = RollupCube(rollup_path, open_ttl=open_month_ttl) if rollup_path is not None else None
+        self.cache = None
+        if result_cache_path is not None:
+            self.cache = ResultCache(result_cache_path,
+                                     max_bytes=result_cache_max_bytes,
+                                     default_ttl=result_cache_ttl)
+        self.refresher = BackgroundRefresher(interval=open_month_ttl * 0.8,
+                                             window=open_month_refresh_window)
+        self.estimates = EstimateMemo(estimate_memo_size, estimate_ttl)
+        self.accounting = threading.local()
+        self.usage = {}
+        self.usage_lock = threading.Lock()
+        self.clients = ClientPool(self._create_client, query_concurrency)
+        self.async_executor = None
+        self.hedge_executor = None
+        self.latencies = LatencyHistory(latency_history_size, hedge_min_samples)
+        self.shard_planner = ShardPlanner(range_shard_min_seconds)
+        self.shard_pool = None
+        self.batcher = QueryBatcher(self._fetch_partials, batch_window, batch_max_values)
+
+    @property
+    def client(self):
+        """
+        BigQuery client is created on first use,
+        so queries answered by local backend don't need credentials
+        """
+        with self.client_lock:
+            if self._client is None:
+                self._client = self._new_client()
+            return self._client
+
+    @property
+    def local_engine(self):
+        """
+        Engine of local event store is created on first use,
+        so executor of BigQuery backend doesn't start its scanning threads
+        """
+        with self.engine_lock:
+            if self._local_engine is None:
+                self._local_engine = LocalEngine(EventStore(local_store_path))
+            return self._local_engine
+
+    def _create_client(self):
+        """
+        Creates client for pool, local stand-in and replay clients are shared
+        as all their queries are executed over one in-memory database or recordings
+        """
+        if query_client in ('local', 'replay'):
+            return self.client
+        return self._new_client()
+
+    def _new_client(self):
+        """
+        :return: client of query_client type, which records its queries if record_queries is set
+        """
+        if query_client == 'local':
+            client = LocalClient(self.local_engine.store)
+        elif query_client == 'replay':
+            client = ReplayClient(recordings_path, replay_latency_scale)
+        else:
+            client = bigquery.Client.from_service_account_json(resource_path + '/' + bigquery_credentials)
+        if record_queries:
+            client = RecordingClient(client, recordings_path)
+        return client
+
+    def set_current_function(self, function_name):
+        """
+        Sets name of function which queries of current thread are accounted to
+        :param function_name: name of function, None for queries outside of functions
+        :return: nothing
+        """
+        self.accounting.function_name = function_name
+
+    def set_sample_percent(self, percent):
+        """
+        Sets sampling of query plans executed by current thread, used for previews of functions.
+        Plans answered from rollup cube or local store stay exact
+        :param percent: percent of table read by queries, None for exact queries
+        :return: nothing
+        """
+        self.accounting.sample_percent = percent
+
+    def _usage_entry(self):
+        function_name = getattr(self.accounting, 'function_name', None) or 'background'
+        return self.usage.setdefault(function_name, {
+            'requests': 0,
+            'queries': 0,
+            'bytes_estimated': 0,
+            'bytes_processed': 0,
+            'bytes_billed': 0,
+        })
+
+    def record_estimate(self, bytes_estimated):
+        """
+        Accounts estimated bytes of one function request
+        :param bytes_estimated: bytes which request was expected to process
+        :return: nothing
+        """
+        with self.usage_lock:
+            entry = self._usage_entry()
+            entry['requests'] += 1
+            entry['bytes_estimated'] += bytes_estimated
+
+    def get_usage(self):
+        """
+        :return: dictionary function name -> dictionary with number of requests and queries,
+        estimated, processed and billed bytes
+        """
+        with self.usage_lock:
+            return {name: dict(entry) for name, entry in self.usage.items()}
+
+    def run_query(self, query, page_size=None):
+        """
+        Executes SQL query and accounts billed bytes to current function
+        :param query: string SQL query
+        :param page_size: number of rows in pages of result, by default chosen by BigQuery
+        :return: RowIterator of result
+        """
+        return self.run_query_job(query, page_size)[1]
+
+    def run_query_job(self, query, page_size=None):
+        """
+        The same as run_query. Transient errors are retried query_retries times,
+        query which is slow for current function is hedged (see hedge_percentile)
+        :return: tuple (QueryJob, RowIterator of result)
+        """
+        return self._with_retries(self._hedged_query, query, page_size)
+
+    def _with_retries(self, method, *args):
+        """
+        Calls method, transient errors are retried with exponential backoff with jitter
+        :return: result of method
+        """
+        delays = backoff_delays(query_retries, retry_base_delay, retry_max_delay)
+        while True:
+            try:
+                return method(*args)
+            except Exception as e:
+                delay = next(delays, None)
+                if delay is None or not is_transient(e):
+                    raise
+                time.sleep(delay)
+
+    def _hedged_query(self, query, page_size):
+        """
+        Executes query, if it isn't finished by hedge_percentile of latencies of current function,
+        the same query is submitted again. The first result is used, other job is cancelled.
+        Latency of query is recorded from the first submission to the first result (so slow
+        jobs which were hedged and cancelled count with time seen by caller), queries which
+        timed out or were cancelled are recorded with time until their error
+        :return: tuple (QueryJob, RowIterator of result)
+        """
+        function_name = getattr(self.accounting, 'function_name', None)
+        hedge_after = None
+        if hedge_percentile is not None:
+            hedge_after = self.latencies.percentile(function_name, hedge_percentile)
+            if hedge_after is not None:
+                hedge_after = max(hedge_after, hedge_min_delay)
+        with self.client_lock:
+            if self.hedge_executor is None:
+                self.hedge_executor = ThreadPoolExecutor(max_workers=2 * query_concurrency)
+        jobs = []
+        finished = threading.Event()
+        started = time.time()
+        attempts = [self.hedge_executor.submit(self._query_attempt, query, page_size,
+                                               function_name, jobs, finished)]
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=hedge_after if len(attempts) == 1 else None,
+                                 return_when=FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None:
+                    finished.set()
+                    query_job, result = attempt.result()
+                    for job in list(jobs):
+                        if job is not query_job:
+                            self._cancel_job(job)
+                    self.latencies.record(function_name, time.time() - started)
+                    return query_job, result
+                error = attempt.exception()
+            if not done:
+                attempts.append(self.hedge_executor.submit(self._query_attempt, query, page_size,
+                                                           function_name, jobs, finished))
+                pending.add(attempts[-1])
+        if is_timeout(error):
+            # true latency is unknown, but at least as long
+            self.latencies.record(function_name, time.time() - started)
+        raise error
+
+    def _query_attempt(self, query, page_size, function_name, jobs, finished):
+        """
+        Submits query and waits for its result, billed bytes are accounted to function_name
+        :param jobs: list to which submitted job is added, so it can be cancelled
+        :param finished: Event set when other attempt of the same query succeeded
+        :return: tuple (QueryJob, RowIterator of result)
+        """
+        self.set_current_function(function_name)
+        query_job = None
+        try:
+            with self.clients.client() as client:
+                if finished.is_set():
+                    raise CancelledError()
+                query_job = client.query(query)
+                jobs.append(query_job)
+                if finished.is_set():
+                    self._cancel_job(query_job)
+                result = query_job.result(page_size=page_size)
+            return query_job, result
+        finally:
+            if query_job is not None:
+                with self.usage_lock:
+                    entry = self._usage_entry()
+                    entry['queries'] += 1
+                    entry['bytes_processed'] += query_job.total_bytes_processed or 0
+                    entry['bytes_billed'] += query_job.total_bytes_billed or 0
+            self.set_current_function(None)
+
+    @staticmethod
+    def _cancel_job(query_job):
+        try:
+            query_job.cancel()
+        except Exception:
+            # job is already finished or can't be cancelled, its result isn't used anyway
+            pass
+
+    def dry_run(self, query, end=None):
+        """
+        :param query: string SQL query
+        :param end: month after last month read by query, None if unknown or unbounded
+        (estimate of such query is kept only for open_month_ttl)
+        :return: number of bytes which query would process
+        """
+        key = ' '.join(query.split())
+        estimate_bytes = self.estimates.get(key)
+        if estimate_bytes is None:
+            job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+
+            def estimate():
+                with self.clients.client() as client:
+                    return client.query(query, job_config=job_config).total_bytes_processed or 0
+
+            estimate_bytes = self._with_retries(estimate)
+            ttl = estimate_ttl if range_ttl(end, open_month_ttl) is None else min(estimate_ttl, open_month_ttl)
+            self.estimates.put(key, estimate_bytes, ttl)
+        return estimate_bytes
+
+    def estimate_bytes(self, query, backend=None):
+        """
+        Estimates bytes processed by get_result_dataframe,
+        queries answered from cache, rollup cube or local store cost nothing
+        :param query: string query or QueryPlan
+        :param backend: "bigquery" or "local", overrides query_backend
+        :return: number of bytes
+        """
+        if isinstance(query, QueryPlan):
+            if self.rollup is not None and self.rollup.can_answer(query):
+                return 0
+            if (backend or query_backend) == 'local' and self.local_engine.can_execute(query):
+                return 0
+            if self.uses_month_partials(query):
+                return self._estimate_months(query)
+            _, end = query.month_bounds()
+            query = query.to_sql()
+        else:
+            end = None
+        if self.cache is not None and self.cache.contains(query):
+            return 0
+        return self.dry_run(query, end)
+
+    def _estimate_months(self, plan):
+        if isinstance(plan, JoinQuery):
+            return self._estimate_months(plan.left) + self._estimate_months(plan.right)
+        missing = [month for month, month_plan in plan_months(plan).items()
+                   if self.cache is None or not self.cache.contains(month_plan.to_partial_sql())]
+        # shards of unpartitioned table scan their columns again
+        return sum(self.dry_run(months_query(plan, shard), next_month(max(shard)))
+                   for shard in self.shard_planner.split(missing, self.shard_limit()))
+
+    def _run_in_executor(self, method, *args, **kwargs):
+        """
+        Runs blocking method of executor in thread of async executor,
+        queries are accounted to function of calling thread
+        :return: awaitable result of method
+        """
+        with self.client_lock:
+            if self.async_executor is None:
+                self.async_executor = ThreadPoolExecutor(max_workers=query_concurrency)
+        function_name = getattr(self.accounting, 'function_name', None)
+        sample_percent = getattr(self.accounting, 'sample_percent', None)
+
+        def call():
+            self.set_current_function(function_name)
+            self.set_sample_percent(sample_percent)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.set_current_function(None)
+                self.set_sample_percent(None)
+
+        return asyncio.get_event_loop().run_in_executor(self.async_executor, call)
+
+    async def fetch(self, query, **kwargs):
+        """
+        Async variant of get_result_dataframe, queries of concurrent fetches
+        are executed at the same time (at most query_concurrency of them)
+        :param query: string query or QueryPlan for execution
+        :param kwargs: other parameters of get_result_dataframe
+        :return: DataFrame with result of query
+        """
+        return await self._run_in_executor(self.get_result_dataframe, query, **kwargs)
+
+    async def estimate(self, query, backend=None):
+        """
+        Async variant of estimate_bytes
+        """
+        return await self._run_in_executor(self.estimate_bytes, query, backend)
+
+    @staticmethod
+    async def gather(*awaitables):
+        """
+        :param awaitables: coroutines, i.e. fetch(query) calls
+        :return: list of their results in the same order
+        """
+        return list(await asyncio.gather(*awaitables))
+
+    def run(self, awaitable):
+        """
+        Runs coroutine from synchronous code (i.e. Function.get_plot) in new event loop
+        :param awaitable: coroutine
+        :return: its result
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(awaitable)
+        finally:
+            loop.close()
+
+    def fetch_all(self, queries, **kwargs):
+        """
+        Executes independent queries concurrently, so their network wait time overlaps
+        :param queries: list of string queries or QueryPlans
+        :param kwargs: other parameters of get_result_dataframe, the same for all queries
+        :return: list of DataFrames with results in order of queries
+        """
+        return self.run(self.gather(*[self.fetch(query, **kwargs) for query in queries]))
 
     def get_result_dataframe(self,
                              query,
                              index_col_name=None,
                              datetime_cols=None,
-                             month_year_cols=None):
+                             month_year_cols=None,
+                             dtypes=None,
+                             use_cache=True,
+                             backend=None,
+                             months=None,
+                             categorical_cols=None):
         """
-        :param query: string query for execution
+        :param query: string query or QueryPlan for execution
         :param index_col_name: list of string names of columns
         which will be a index for dataframe
         :param datetime_cols: list of string names of columns
@@ -73,31 +565,325 @@ class QueryExecutor(metaclass=Singleton):
         which will be parsed as pd.Timestamp.
         Time format is the same as MonthYear column: YYYYMM.
         Will be parsed as first day of month
+        :param dtypes: optional dictionary column name -> numpy dtype
+        to override types taken from result schema
+        :param use_cache: if False query is always executed,
+        result still replaces cached one
+        :param backend: "bigquery" or "local", overrides query_backend
+        for this query. Only QueryPlan queries can be executed locally
+        :param months: tuple (first month, month after last one) of data read
+        by string query, chooses time to live of cached result.
+        Range of QueryPlan is taken from its filters
+        :param categorical_cols: list of string names of code columns
+        which will be decoded as pandas Categorical sharing codes
+        of process-wide code dictionary (see Utils().get_code_dictionary())
         :return:
         pandas DataFrame with result of query
         """
-        query_job = self.client.query(query)
-        rows = []
-        for row in query_job:
-            rows.append(pd.Series(dict(row.items())))
-        df = pd.DataFrame(rows)
-        del(rows)
-        if datetime_cols is not None:
-            for datetime_col in datetime_cols:
-                df[datetime_col] = pd.to_datetime(df[datetime_col],
-                                                  format='%Y%m%d',
-                                                  errors='ignore')
-        if month_year_cols is not None:
-            for month_year_col in month_year_cols:
-                df[month_year_col] = df[month_year_col].apply(
-                    lambda date: pd.Timestamp(
-                        year=int(date / 100),
-                        month=int(date % 100),
-                        day=1))
-        if index_col_name is not None:
-            df.index = df[index_col_name]
-            df.drop([index_col_name], inplace=True, axis=1)
-        return (df)
+        decoders = None
+        if categorical_cols is not None:
+            code_dictionary = Utils().get_code_dictionary()
+            decoders = {name: code_dictionary.decode_column for name in categorical_cols}
+            dtypes = dict(dtypes or {})
+            dtypes.update({name: code_dtype for name in categorical_cols})
+        df, query, months = self._execute_locally(query, dtypes, use_cache, backend, months)
+        if df is None:
+            self._register_refresh(query, dtypes, months)
+        if df is None and self.cache is not None and use_cache:
+            df = self.cache.get(typed_query(query, dtypes), decoders=decoders)
+            if df is not None:
+                # cached string columns are Categoricals of stored codes,
+                # functions get strings unless columns are read as categorical
+                df = decode_categoricals(df, categorical_cols or ())
+        if df is None:
+            df = self.fetch_to_cache(query, dtypes, months)
+        return format_result_dataframe(df,
+                                       index_col_name=index_col_name,
+                                       datetime_cols=datetime_cols,
+                                       month_year_cols=month_year_cols,
+                                       categorical_cols=categorical_cols)
+
+    def _execute_locally(self, query, dtypes, use_cache, backend, months):
+        """
+        Executes QueryPlan from rollup cube, local event store or cached partials of months
+        :return: tuple (DataFrame or None if query has to be executed in BigQuery,
+        string SQL query, months range of query)
+        """
+        df = None
+        sample_percent = getattr(self.accounting, 'sample_percent', None)
+        if isinstance(query, QueryPlan) and sample_percent is not None:
+            query = query.sampled(sample_percent)
+        if months is None:
+            months = query.month_bounds() if isinstance(query, QueryPlan) else (None, None)
+        if isinstance(query, QueryPlan):
+            if self.rollup is not None and self.rollup.can_answer(query):
+                df = self.rollup.execute(query)
+            elif (backend or query_backend) == 'local' and self.local_engine.can_execute(query):
+                df = self.local_engine.execute(query)
+            elif self.uses_month_partials(query):
+                df = self.execute_by_months(query, use_cache)
+            if df is not None and dtypes is not None:
+                df = df.astype({name: dtype for name, dtype in dtypes.items() if not is_code_dtype(dtype)})
+            query = query.to_sql()
+        return df, query, months
+
+    def get_result_chunks(self,
+                          query,
+                          dtypes=None,
+                          use_cache=True,
+                          backend=None,
+                          months=None):
+        """
+        Variant of get_result_dataframe for results which may not fit into memory.
+        Parameters have the same meaning as in get_result_dataframe
+        :return: complete ChunkedResult, which can be read by chunks several times.
+        It should be closed after use (i.e. used in with statement)
+        """
+        df, query, months = self._execute_locally(query, dtypes, use_cache, backend, months)
+        if df is not None:
+            return ChunkedResult.from_dataframe(df)
+        self._register_refresh(query, dtypes, months)
+        result = self._cached_result(query, dtypes) if use_cache else None
+        if result is None:
+            result, chunks = self.stream_query(query, dtypes, months)
+            for _ in chunks:
+                pass
+        return result
+
+    def iter_result_chunks(self,
+                           query,
+                           chunk_rows=None,
+                           dtypes=None,
+                           use_cache=True,
+                           backend=None,
+                           months=None):
+        """
+        Streaming variant of get_result_dataframe for functions which reduce result incrementally.
+        Results fetched from BigQuery are returned while pages of result arrive
+        :param chunk_rows: number of rows of chunks, by default result_chunk_rows.
+        Other parameters have the same meaning as in get_result_dataframe
+        :return: generator of DataFrames with parts of result
+        """
+        chunk_rows = chunk_rows or result_chunk_rows
+        df, query, months = self._execute_locally(query, dtypes, use_cache, backend, months)
+        result = ChunkedResult.from_dataframe(df) if df is not None else None
+        if result is None:
+            self._register_refresh(query, dtypes, months)
+        if result is None and use_cache:
+            result = self._cached_result(query, dtypes)
+        if result is None:
+            result, chunks = self.stream_query(query, dtypes, months)
+            with result:
+                for columns in rechunk_columns(chunks, chunk_rows):
+                    yield columns_to_dataframe(columns, result.column_dtypes)
+            return
+        with result:
+            for chunk in result.iter_chunks(chunk_rows):
+                yield chunk
+
+    def _cached_result(self, query, dtypes=None):
+        if self.cache is None:
+            return None
+        entry = self.cache.get_entry(typed_query(query, dtypes))
+        if entry is None:
+            return None
+        try:
+            return ChunkedResult.from_directory(*entry)
+        except (IOError, OSError, ValueError):
+            # entry was replaced or evicted by other process
+            return None
+
+    def stream_query(self, query, dtypes=None, months=(None, None)):
+        """
+        Executes string query in BigQuery, result is read by pages of result_chunk_rows rows
+        and collected in ChunkedResult, which is spilled to disk when it gets larger
+        than result_memory_max_bytes. Complete result is cached.
+        Results with at least parallel_download_rows rows are read by download_streams parallel streams
+        :param query: string SQL query
+        :param dtypes: optional dictionary column name -> numpy dtype
+        :param months: tuple (first month, month after last one) of data read by query
+        :return: tuple (ChunkedResult, generator of lists of column arrays of pages).
+        Result is complete after generator is exhausted
+        """
+        query_job, row_iterator = self.run_query_job(query, page_size=result_chunk_rows)
+        column_dtypes = schema_dtypes(row_iterator.schema, dtypes)
+        result_spill_path = spill_path or (self.cache.path if self.cache is not None else None)
+        result = ChunkedResult(column_dtypes,
+                               max_bytes=result_memory_max_bytes,
+                               spill_path=result_spill_path)
+        total_rows = row_iterator.total_rows or 0
+        if parallel_download_rows is not None and download_streams > 1 \
+                and total_rows >= parallel_download_rows \
+                and getattr(query_job, 'destination', None) is not None:
+            pages = read_result(row_iterator, self.clients, query_job.destination, column_dtypes,
+                                download_streams, page_size=result_chunk_rows,
+                                max_bytes=result_memory_max_bytes, spill_path=result_spill_path)
+        else:
+            pages = iter_page_columns(row_iterator, column_dtypes)
+
+        def chunks():
+            for columns in pages:
+                result.append(columns)
+                yield columns
+            result.finish()
+            self._cache_result(query, result, dtypes, months)
+
+        return result, chunks()
+
+    def fetch_to_cache(self, query, dtypes=None, months=(None, None)):
+        """
+        Executes string query in BigQuery and caches result.
+        Results of closed months never expire, results which include open month
+        expire soon and are refreshed in background
+        :param query: string SQL query
+        :param dtypes: optional dictionary column name -> numpy dtype
+        :param months: tuple (first month, month after last one) of data read by query
+        :return: DataFrame with result of query, memory-mapped if result was spilled to disk
+        """
+        result, chunks = self.stream_query(query, dtypes, months)
+        with result:
+            for _ in chunks:
+                pass
+            return result.to_dataframe()
+
+    def _cache_result(self, query, result, dtypes, months):
+        if self.cache is None:
+            return
+        start, end = months
+        if start is None and end is None:
+            result.save_to_cache(self.cache, typed_query(query, dtypes))
+        else:
+            result.save_to_cache(self.cache, typed_query(query, dtypes), range_ttl(end, open_month_ttl))
+
+    def _register_refresh(self, query, dtypes, months):
+        """
+        Keeps cached result of requested query which includes open month refreshed in background,
+        until it isn't requested for open_month_refresh_window. Refresh itself doesn't extend the window
+        :param query: string SQL query
+        :param dtypes: dtypes of request
+        :param months: tuple (first month, month after last one) of data read by query
+        :return: nothing
+        """
+        start, end = months
+        if self.cache is None or (start is None and end is None) or range_ttl(end, open_month_ttl) is None:
+            return
+        self.refresher.register(typed_query(query, dtypes), lambda: self.fetch_to_cache(query, dtypes, months))
+
+    def uses_month_partials(self, plan):
+        """
+        :param plan: QueryPlan
+        :return: True if plan is executed by months, which are cached
+        as partial aggregates or fetched by concurrent shards
+        """
+        if self.cache is not None:
+            return month_partials_enabled and self.can_split_months(plan)
+        return self.shard_limit() > 1 and self.can_split_months(plan)
+
+    @staticmethod
+    def shard_limit():
+        """
+        :return: maximal number of shards of months fetched by one query plan,
+        1 if shards would scan whole columns of unpartitioned events table again
+        """
+        if query_client == 'local' or events_table_partitioned:
+            return range_shards
+        return 1
+
+    def can_split_months(self, plan):
+        """
+        :param plan: QueryPlan
+        :return: True if plan is bounded by month range, so it can be executed by months
+        """
+        if isinstance(plan, JoinQuery):
+            return self.can_split_months(plan.left) and self.can_split_months(plan.right)
+        # partials of samples aren't reused, sampled plans are executed with one query
+        return plan.sample_percent is None and plan_months(plan) is not None
+
+    def execute_by_months(self, plan, use_cache=True):
+        """
+        Executes plan from cached partial aggregates of each month,
+        months which aren't cached are fetched from BigQuery by concurrent shards
+        :param plan: QueryPlan accepted by can_split_months
+        :param use_cache: if False all months are fetched
+        :return: DataFrame with result of plan
+        """
+        if isinstance(plan, JoinQuery):
+            return plan.join(self.execute_by_months(plan.left, use_cache),
+                             self.execute_by_months(plan.right, use_cache))
+        month_plans = plan_months(plan)
+        partials = {}
+        if use_cache and self.cache is not None and month_partials_enabled:
+            for month, month_plan in month_plans.items():
+                partial = self.cache.get(month_plan.to_partial_sql())
+                if partial is not None:
+                    partials[month] = partial
+        missing = [month for month in month_plans if month not in partials]
+        if missing:
+            partials.update(self.fetch_months(plan, missing))
+        if self.cache is not None and month_partials_enabled:
+            for month, month_plan in month_plans.items():
+                if not is_closed(month):
+                    self.refresher.register(month_plan.to_partial_sql(),
+                                            lambda month=month: self.fetch_months(plan, [month]))
+        return merge_partials(plan, [partials[month] for month in sorted(partials)])
+
+    def fetch_months(self, plan, months):
+        """
+        Fetches partial aggregates of plan for months from BigQuery and caches them,
+        closed months are cached without expiration.
+        Concurrent requests which differ only in country filter are fetched
+        with one query (see batch_window)
+        :param plan: AggregateQuery
+        :param months: list of int months
+        :return: dictionary month -> DataFrame with partial states
+        """
+        month_plans = plan_months(plan)
+        fetched = None
+        if batch_window is not None:
+            fetched = self.batcher.submit(plan, months)
+        if fetched is None:
+            fetched = self._fetch_partials(plan, months)
+        if self.cache is not None and month_partials_enabled:
+            for month, partial in fetched.items():
+                ttl = None if is_closed(month) else open_month_ttl
+                self.cache.put(month_plans[month].to_partial_sql(), partial, ttl)
+        return fetched
+
+    def _fetch_partials(self, plan, months):
+        """
+        Fetches partial aggregates of plan for months from BigQuery by concurrent shards
+        :param plan: AggregateQuery
+        :param months: list of int months
+        :return: dictionary month -> DataFrame with partial states
+        """
+        shards = self.shard_planner.split(months, self.shard_limit())
+        if len(shards) == 1:
+            return self._fetch_shard(plan, shards[0])
+        with self.client_lock:
+            if self.shard_pool is None:
+                self.shard_pool = Pool(range_shards)
+        function_name = getattr(self.accounting, 'function_name', None)
+
+        def fetch(shard):
+            self.set_current_function(function_name)
+            try:
+                return self._fetch_shard(plan, shard)
+            finally:
+                self.set_current_function(None)
+
+        fetched = {}
+        for shard_partials in self.shard_pool.map(fetch, shards):
+            fetched.update(shard_partials)
+        return fetched
+
+    def _fetch_shard(self, plan, months):
+        """
+        :return: dictionary month -> DataFrame with partial states of months of one shard
+        """
+        started = time.time()
+        partial = rows_to_dataframe(self.run_query(months_query(plan, months)))
+        self.shard_planner.record(months, time.time() - started)
+        return split_months(partial, months)
 
 
 class Utils(metaclass=Singleton):
@@ -200,6 +986,37 @@ class Utils(metaclass=Singleton):
             del (cameo_religion_df)
             return self.cameo_religion_id_to_name_mapping
 
+    def get_cameo_type_id_to_name_mapping(self):
+        """
+        :return: pandas Series with actor type name as values
+        and CAMEO type code as indexes
+        """
+        if hasattr(self, "cameo_type_id_to_name_mapping"):
+            return self.cameo_type_id_to_name_mapping
+        else:
+            cameo_type_df = pd.read_csv(resource_path + '/' + cameo_type, sep='\t')
+            self.cameo_type_id_to_name_mapping = cameo_type_df.groupby('CODE')['LABEL'].first()
+            del (cameo_type_df)
+            return self.cameo_type_id_to_name_mapping
+
+    def get_code_dictionary(self):
+        """
+        :return: CodeDictionary shared by all query results of process,
+        with codes and names of FIPS countries, CAMEO countries, CAMEO event codes and actor types
+        """
+        if hasattr(self, "code_dictionary"):
+            return self.code_dictionary
+        else:
+            cameo_eventcodes_df = pd.read_csv(resource_path + '/' + cameo_eventcodes, sep='\t', dtype='str')
+            global_dictionary.load_domain('fips_country', self.get_fips_country_id_to_name_mapping())
+            global_dictionary.load_domain('cameo_country', self.get_cameo_country_id_to_name_mapping())
+            global_dictionary.load_domain(
+                'cameo_eventcode', cameo_eventcodes_df.groupby('CAMEOEVENTCODE')['EVENTDESCRIPTION'].first())
+            global_dictionary.load_domain('cameo_type', self.get_cameo_type_id_to_name_mapping())
+            del (cameo_eventcodes_df)
+            self.code_dictionary = global_dictionary
+            return self.code_dictionary
+
     def get_fips_country_id_to_name_mapping(self):
         """
         :return: pandas Series with country name as values
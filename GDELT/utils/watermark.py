@@ -0,0 +1,98 @@
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+from .query_plan import next_month
+
+# events of a day are still published during the next day,
+# so month is closed only after this delay from its end
+watermark_delay = 24 * 60 * 60
+
+
+def open_month(now=None):
+    """
+    :param now: unix time, by default current time
+    :return: int first month (YYYYMM) which can still get new events,
+    all earlier months are closed and never change
+    """
+    now = time.time() if now is None else now
+    day = datetime.fromtimestamp(now, timezone.utc) - timedelta(seconds=watermark_delay)
+    return day.year * 100 + day.month
+
+
+def is_closed(month, now=None):
+    """
+    :param month: int month in format YYYYMM
+    :param now: unix time, by default current time
+    :return: True if data of month doesn't change anymore
+    """
+    return int(month) < open_month(now)
+
+
+def closed_since(month):
+    """
+    :param month: int month in format YYYYMM
+    :return: unix time after which month is closed
+    """
+    end = next_month(int(month))
+    return datetime(end // 100, end % 100, 1, tzinfo=timezone.utc).timestamp() + watermark_delay
+
+
+def range_ttl(end, open_ttl, now=None):
+    """
+    :param end: month after last month of range, None if range is unbounded
+    :param open_ttl: time to live of data of open month
+    :param now: unix time, by default current time
+    :return: None (never expires) if all months of range are closed, open_ttl otherwise
+    """
+    if end is not None and int(end) <= open_month(now):
+        return None
+    return open_ttl
+
+
+class BackgroundRefresher:
+    """
+    Periodically refreshes cached results of open month while they are requested.
+    Each result is registered with function which fetches it again and updates cache
+    """
+
+    def __init__(self, interval, window):
+        """
+        :param interval: time between refreshes in seconds
+        :param window: result is refreshed until it wasn't requested for this time
+        """
+        self.interval = interval
+        self.window = window
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.thread = None
+
+    def register(self, key, refresh):
+        """
+        Registers result or marks it as requested again, should be called only by requests
+        (not by refresh functions), so result stops being refreshed when nobody asks for it
+        :param key: identifier of cached result, i.e. its query
+        :param refresh: function without arguments which updates result in cache
+        :return: nothing
+        """
+        with self.lock:
+            self.jobs[key] = (refresh, time.time())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self.lock:
+                for key in [key for key, (_, requested) in self.jobs.items()
+                            if now - requested > self.window]:
+                    del self.jobs[key]
+                jobs = [refresh for refresh, _ in self.jobs.values()]
+            for refresh in jobs:
+                try:
+                    refresh()
+                except Exception:
+                    # result is fetched again on next request
+                    pass
@@ -4,6 +4,8 @@ from django.utils.safestring import mark_safe
 from django.views.decorators.csrf import csrf_exempt
 import json
 from ..functions.function_utils import FunctionUtil
+from ..utils.utils import QueryExecutor, preview_sample_percent
+from ..utils.result_store import JobExpired
 
 
 @csrf_exempt
@@ -49,37 +51,75 @@ def wait_for_plot(request):
     """
     After receiving a request, tries to wait while job is completed synchronously
     :param request: POST request with JSON body with "job_uuid" parameter
-    :return: JSON response with status field
+    and optional "preview" parameter, if it is true request waits only
+    until approximate preview or exact result can be shown
+    :return: JSON response with status field ("expired" if result of job
+    was evicted and request has to be submitted again)
     and optional "message" field with error description
     """
     params = json.loads(request.body)
     try:
-        FunctionUtil().function_pool.wait_result(params['job_uuid'])
+        if params.get('preview'):
+            FunctionUtil().function_pool.wait_first(params['job_uuid'])
+        else:
+            FunctionUtil().function_pool.wait_result(params['job_uuid'])
         return JsonResponse({"status": "ok"})
+    except JobExpired as e:
+        return JsonResponse({"status": "expired",
+                             "message": str(e)})
     except Exception as e:
         raise e
         return JsonResponse({"status": "error",
                              "message": str(e.args)})
 
 
+@csrf_exempt
+def release_job(request):
+    """
+    Detaches job id of user who left page before result was shown,
+    job is still finished for other users waiting for the same request
+    :param request: POST request with JSON body with "job_uuid" parameter
+    :return: JSON response with status field
+    """
+    params = json.loads(request.body)
+    FunctionUtil().function_pool.release(params['job_uuid'])
+    return JsonResponse({"status": "ok"})
+
+
 def draw_plot(request, function, job_uuid):
     """
     Must be called only if POST request to wait_for_plot was successful
     :param request: GET request with empty body
     :param function: function name
     :param job_uuid: job id
-    :return: page with plot embedded or JSON with error description
+    :return: page with plot embedded or JSON with error description.
+    Approximate preview is marked on page, which is reloaded when exact plot is ready
     """
     try:
         fu = FunctionUtil()
         title = fu.get_function_by_name(function).get_name()
-        plot = mark_safe(fu.function_pool.get_result(job_uuid))
+        plot, approximate = fu.function_pool.get_latest(job_uuid)
         context = {
             'title': title,
-            'plot': plot
+            'plot': mark_safe(plot),
+            'approximate': approximate,
+            'job_uuid': job_uuid,
+            'sample_percent': preview_sample_percent,
         }
         return render(request, 'plot.html', context)
+    except JobExpired as e:
+        return JsonResponse({"status": "expired",
+                             "message": str(e)})
     except Exception as e:
         raise e
         return JsonResponse({"status": "error",
                              "message": str(e.args)})
+
+
+def query_usage(request):
+    """
+    :param request: GET request without content
+    :return: JSON with number of requests and queries, estimated,
+    processed and billed bytes for each function
+    """
+    return JsonResponse(QueryExecutor().get_usage())
@@ -0,0 +1,52 @@
+"""
+Fixtures of tests: small local event store in temporary directory
+and QueryExecutor which executes its queries by local client over it.
+
+Run from main directory of project:
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from GDELT.storage.event_store import EventStore, store_columns
+from GDELT.utils import utils
+
+countries = np.array(['US', 'PL', 'UK', 'FR', None], dtype=object)
+months = [201301, 201302]
+
+
+@pytest.fixture
+def store(tmp_path):
+    """
+    :return: EventStore with random events of two months
+    """
+    rng = np.random.default_rng(0)
+    event_store = EventStore(str(tmp_path / 'events'))
+    for month in months:
+        rows = 2000
+        columns = {'SQLDATE': month * 100 + rng.integers(1, 29, rows), 'MonthYear': np.full(rows, month)}
+        for column, column_type in store_columns:
+            if column in columns:
+                continue
+            if column_type == 'code':
+                columns[column] = countries[rng.integers(0, len(countries), rows)]
+            elif column == 'QuadClass':
+                columns[column] = rng.integers(1, 5, rows)
+            else:
+                columns[column] = rng.integers(1, 10, rows).astype(np.float64)
+        event_store.write_fragment(month, 'test', columns)
+    return event_store
+
+
+@pytest.fixture
+def executor(store, monkeypatch):
+    """
+    :return: new QueryExecutor with local client over store, without caches and batching
+    """
+    for name, value in [('local_store_path', store.path), ('rollup_path', None), ('result_cache_path', None),
+                        ('query_client', 'local'), ('query_backend', 'bigquery'), ('batch_window', None),
+                        ('record_queries', False)]:
+        monkeypatch.setattr(utils, name, value)
+    utils.Singleton._instances.pop(utils.QueryExecutor, None)
+    yield utils.QueryExecutor()
+    utils.Singleton._instances.pop(utils.QueryExecutor, None)
@@ -0,0 +1,90 @@
+import time
+import threading
+import pytest
+
+from GDELT.utils import utils
+from GDELT.utils.local_client import LocalClient
+from GDELT.utils.hedging import LatencyHistory, backoff_delays
+
+query = "SELECT COUNT(*) AS n FROM `gdelt-bq.full.events`"
+
+
+class DelayedJob:
+    """
+    Query job of local client whose result is returned after delay, unless it is cancelled
+    """
+
+    def __init__(self, job, delay):
+        self.job = job
+        self.delay = delay
+        self.cancelled = threading.Event()
+        self.total_bytes_processed = job.total_bytes_processed
+        self.total_bytes_billed = job.total_bytes_billed
+        self.destination = job.destination
+
+    def cancel(self):
+        self.cancelled.set()
+        return True
+
+    def result(self, page_size=None):
+        if self.cancelled.wait(self.delay):
+            raise RuntimeError("job was cancelled")
+        return self.job.result(page_size)
+
+
+@pytest.fixture
+def delays(executor, monkeypatch):
+    """
+    :return: list of delays of next queries of local client, empty list for fast queries
+    """
+    delays = []
+    query_method = LocalClient.query
+
+    def delayed_query(self, sql, job_config=None):
+        job = query_method(self, sql, job_config)
+        return DelayedJob(job, delays.pop(0) if delays else 0.01)
+
+    monkeypatch.setattr(LocalClient, 'query', delayed_query)
+    monkeypatch.setattr(utils, 'hedge_min_delay', 0.05)
+    executor.latencies.min_samples = 5
+    return delays
+
+
+def test_latency_percentile_needs_samples():
+    history = LatencyHistory(size=3, min_samples=2)
+    history.record('f', 1.)
+    assert history.percentile('f', 95) is None
+    for seconds in [5., 6., 7.]:
+        history.record('f', seconds)
+    # only the latest size latencies are kept
+    assert history.percentile('f', 0) == 5.
+
+
+def test_backoff_delays_are_bounded():
+    delays = list(backoff_delays(5, 1, 4))
+    assert len(delays) == 5
+    assert all(0 <= delay <= min(4, 2 ** attempt) for attempt, delay in enumerate(delays))
+
+
+def test_slow_query_is_hedged(executor, delays):
+    executor.set_current_function('f')
+    for _ in range(5):
+        executor.run_query(query)
+    delays[:] = [5, 0.01]
+    started = time.time()
+    rows = [row.values() for row in executor.run_query(query)]
+    assert time.time() - started < 2
+    assert rows == [(4000,)]
+
+
+def test_hedged_latency_is_measured_from_first_submission(executor, delays):
+    executor.set_current_function('f')
+    for _ in range(5):
+        executor.run_query(query)
+    threshold = executor.latencies.percentile('f', utils.hedge_percentile)
+    for _ in range(5):
+        delays[:] = [5, 0.01]
+        executor.run_query(query)
+    # hedged queries are recorded with hedge delay, so threshold doesn't drift down
+    recorded = list(executor.latencies.latencies['f'])[-5:]
+    assert min(recorded) >= max(threshold, utils.hedge_min_delay)
@@ -0,0 +1,127 @@
+import time
+import sqlite3
+import pytest
+
+from GDELT.utils.job_broker import JobBroker, BrokerPool, JobError, preview_task, result_task
+from GDELT.utils.result_store import JobExpired
+
+lease = 0.1
+
+
+@pytest.fixture
+def broker(tmp_path):
+    return JobBroker(str(tmp_path / 'jobs.sqlite3'), lease=lease, max_attempts=2, ttl=60, max_bytes=None)
+
+
+def job_row(broker, job_uuid):
+    """
+    :return: tuple (expires, accessed) of job of job id
+    """
+    with sqlite3.connect(broker.path) as connection:
+        return connection.execute("""
+            SELECT jobs.expires, jobs.accessed FROM jobs JOIN aliases ON aliases.job_id = jobs.id
+            WHERE aliases.job_uuid = ?""", (job_uuid,)).fetchone()
+
+
+def test_finished_result_is_returned(broker):
+    job_uuid = broker.submit(['f', {}])
+    job_id, kind, args = broker.claim('w1')
+    assert (kind, args) == (result_task, ['f', {}])
+    assert broker.claim('w2') is None
+    broker.finish(job_id, kind, 'w1', value='<div></div>')
+    assert BrokerPool(broker).get_result(job_uuid) == '<div></div>'
+
+
+def test_preview_is_claimed_first(broker):
+    broker.submit(['f', {}], preview=True)
+    assert broker.claim('w1')[1] == preview_task
+    assert broker.claim('w1')[1] == result_task
+
+
+def test_identical_running_jobs_are_shared(broker):
+    first = broker.submit(['f', {'x': 1}], key=['f', 1])
+    second = broker.submit(['f', {'x': 1}], key=['f', 1])
+    job_id, kind, _ = broker.claim('w1')
+    assert broker.claim('w2') is None
+    broker.finish(job_id, kind, 'w1', value='plot')
+    pool = BrokerPool(broker)
+    assert pool.get_result(first) == pool.get_result(second) == 'plot'
+    # finished job isn't shared anymore
+    broker.submit(['f', {'x': 1}], key=['f', 1])
+    assert broker.claim('w1') is not None
+
+
+def test_task_of_dead_worker_is_claimed_again(broker):
+    job_uuid = broker.submit(['f', {}])
+    job_id, kind, _ = broker.claim('dead')
+    assert broker.claim('w2') is None
+    time.sleep(2 * lease)
+    assert broker.claim('w2')[:2] == (job_id, kind)
+    broker.finish(job_id, kind, 'w2', value='plot')
+    assert BrokerPool(broker).get_result(job_uuid) == 'plot'
+
+
+def test_heartbeat_keeps_task_claimed(broker):
+    broker.submit(['f', {}])
+    broker.claim('w1')
+    for _ in range(4):
+        time.sleep(lease / 2)
+        broker.heartbeat('w1')
+    assert broker.claim('w2') is None
+
+
+def test_finish_of_stale_worker_is_ignored(broker):
+    job_uuid = broker.submit(['f', {}])
+    job_id, kind, _ = broker.claim('stale')
+    time.sleep(2 * lease)
+    broker.claim('w2')
+    broker.finish(job_id, kind, 'stale', value='stale plot')
+    assert broker.tasks(job_uuid)[result_task][0] == 'running'
+    broker.finish(job_id, kind, 'w2', value='plot')
+    assert BrokerPool(broker).get_result(job_uuid) == 'plot'
+
+
+def test_task_fails_after_max_attempts(broker):
+    job_uuid = broker.submit(['f', {}])
+    for worker in ['dead1', 'dead2']:
+        assert broker.claim(worker) is not None
+        time.sleep(2 * lease)
+    assert broker.claim('w3') is None
+    status, _, error = broker.tasks(job_uuid, with_values=True)[result_task]
+    assert status == 'error' and error
+    with pytest.raises(JobError):
+        BrokerPool(broker).get_result(job_uuid)
+    # failed job expires and is evicted the same way as finished ones
+    expires, accessed = job_row(broker, job_uuid)
+    assert expires is not None and accessed is not None
+
+
+def test_error_of_task_is_raised(broker):
+    job_uuid = broker.submit(['f', {}])
+    job_id, kind, _ = broker.claim('w1')
+    broker.finish(job_id, kind, 'w1', error='ValueError: bad parameter')
+    with pytest.raises(JobError, match='bad parameter'):
+        BrokerPool(broker).get_result(job_uuid)
+
+
+def test_release_deletes_finished_job(broker):
+    first = broker.submit(['f', {}], key='f')
+    second = broker.submit(['f', {}], key='f')
+    job_id, kind, _ = broker.claim('w1')
+    broker.finish(job_id, kind, 'w1', value='plot')
+    assert broker.release(first) == 1
+    assert BrokerPool(broker).get_result(second) == 'plot'
+    assert broker.release(second) == 0
+    with pytest.raises(JobExpired):
+        broker.tasks(second)
+
+
+def test_expired_jobs_are_purged(tmp_path):
+    broker = JobBroker(str(tmp_path / 'jobs.sqlite3'), lease=lease, ttl=0.05, max_bytes=None)
+    job_uuid = broker.submit(['f', {}])
+    job_id, kind, _ = broker.claim('w1')
+    broker.finish(job_id, kind, 'w1', value='plot')
+    time.sleep(0.1)
+    with pytest.raises(JobExpired):
+        broker.tasks(job_uuid)
+    assert broker.purge() == 1
@@ -0,0 +1,98 @@
+import time
+import threading
+import pandas as pd
+import pytest
+
+from GDELT.utils.micro_batch import QueryBatcher, batch_filter
+from GDELT.utils.month_partials import merge_partials
+from GDELT.utils.query_plan import AggregateQuery
+
+# keys of plans: batched columns as keys, only month (batched columns are added keys), no keys
+plan_keys = [
+    [('MonthYear', 'MonthYear'), ('Actor1', 'Actor1Geo_CountryCode'), ('Actor2', 'Actor2Geo_CountryCode')],
+    [('MonthYear', 'MonthYear')],
+    [],
+]
+
+
+def country_plan(keys, country, end=201303):
+    return AggregateQuery(
+        keys=keys,
+        measures=[('Count', 'count', None), ('Tone', 'avg', 'AvgTone')],
+        filters=[('MonthYear', '>=', 201301),
+                 ('MonthYear', '<', end),
+                 (None, 'or', [('Actor1Geo_CountryCode', '=', country),
+                               ('Actor2Geo_CountryCode', '=', country)])],
+        order_by=[alias for alias, _ in keys])
+
+
+def merged(plan, partials):
+    return merge_partials(plan, [partials[month] for month in sorted(partials)]).reset_index(drop=True)
+
+
+def test_batch_filter_of_or_filter():
+    position, columns, value = batch_filter(country_plan(plan_keys[0], 'US'))
+    assert (position, columns, value) == (2, ['Actor1Geo_CountryCode', 'Actor2Geo_CountryCode'], 'US')
+
+
+@pytest.mark.parametrize('keys', plan_keys)
+@pytest.mark.parametrize('months', [[201301], [201301, 201302]])
+def test_batched_slices_equal_unbatched_results(executor, keys, months):
+    end = max(months) + 1
+    countries = ['US', 'PL', 'UK']
+    expected = {country: merged(country_plan(keys, country, end),
+                                executor._fetch_partials(country_plan(keys, country, end), months))
+                for country in countries}
+    fetched = []
+
+    def fetch(plan, fetch_months):
+        fetched.append(plan)
+        return executor._fetch_partials(plan, fetch_months)
+
+    batcher = QueryBatcher(fetch, window=0.2, max_values=10, recent=60)
+    # the first request of shape isn't delayed, requests coming after it are batched
+    batcher.submit(country_plan(keys, 'FR', end), months)
+    results = {}
+
+    def request(country):
+        plan = country_plan(keys, country, end)
+        results[country] = merged(plan, batcher.submit(plan, months))
+
+    threads = [threading.Thread(target=request, args=(country,)) for country in countries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(fetched) == 2
+    for country in countries:
+        pd.testing.assert_frame_equal(expected[country], results[country],
+                                      check_dtype=False, check_categorical=False)
+
+
+def test_lone_request_isnt_delayed(executor):
+    batcher = QueryBatcher(executor._fetch_partials, window=1, max_values=10)
+    started = time.time()
+    batcher.submit(country_plan(plan_keys[1], 'US'), [201301])
+    assert time.time() - started < 1
+
+
+def test_batch_error_is_raised_to_all_requests():
+    def fetch(plan, months):
+        raise ValueError("query failed")
+
+    batcher = QueryBatcher(fetch, window=0.2, max_values=10, recent=60)
+    errors = []
+
+    def request(country):
+        try:
+            batcher.submit(country_plan(plan_keys[1], country), [201301])
+        except ValueError as e:
+            errors.append(e)
+
+    request('FR')
+    threads = [threading.Thread(target=request, args=(country,)) for country in ['US', 'PL']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
@@ -0,0 +1,41 @@
+import os
+import time
+import pytest
+
+from GDELT.utils.result_store import ResultStore
+
+
+def test_values_are_restored():
+    store = ResultStore(max_bytes=None, ttl=None)
+    for key, value in [('html', '<div></div>'), ('bytes', b'\x00\x01'), ('object', {'x': [1, 2]})]:
+        store.put(key, value)
+        assert store.get(key) == value
+
+
+def test_least_recently_used_entries_are_evicted():
+    evicted = []
+    store = ResultStore(max_bytes=2500, ttl=None, on_evict=evicted.append)
+    # random bytes don't compress
+    store.put('a', os.urandom(1000))
+    store.put('b', os.urandom(1000))
+    store.get('a')
+    store.put('c', os.urandom(1000))
+    assert evicted == ['b']
+    assert 'a' in store and 'c' in store
+
+
+@pytest.mark.parametrize('operation', [
+    lambda store: 'other' in store,
+    lambda store: store.delete('other'),
+    lambda store: store.get_stats(),
+    lambda store: store.expire(),
+])
+def test_expired_entries_are_removed_without_put(operation):
+    evicted = []
+    store = ResultStore(max_bytes=None, ttl=0.05, on_evict=evicted.append)
+    store.put('a', 'plot')
+    store.put('b', 'plot', ttl=60)
+    time.sleep(0.1)
+    operation(store)
+    assert evicted == ['a']
+    assert store.get_stats()['entries'] == 1